@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import json
+import logging
+import os
+import threading
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# names of the state values of a device, stored in redis as '<device>:<name>'
+# like earlier versions did
+SEQUENCE = 'seq no'
+EVENT_COUNT = 'badge event count'
+PAYLOAD = 'payload'
+KEY = '{}:{}'
+
+# accept ARGV[1] if it follows the stored sequence number and count the
+# event. returns {last seq no, event count}, event count -1 if not accepted
+ADVANCE_SEQUENCE_SCRIPT = """
+local last = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) ~= last + 1 then
+    return {last, -1}
+end
+redis.call('SET', KEYS[1], ARGV[1])
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('SET', KEYS[2], 0)
+    return {last, 0}
+end
+return {last, redis.call('INCR', KEYS[2])}
+"""
+
+
+class DeviceStateStore(ABC):
+    """
+    state kept per device between messages, e.g. the sequence numbers of
+    PIOT time terminals. converters are shared by all worker threads, so
+    every operation is atomic on its own.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+
+    @abstractmethod
+    def advance_sequence(self, device, seq_no: int) -> tuple:
+        """
+        accept seq_no if it follows the stored sequence number of device and
+        count the event. returns (last seq no, event count), event count is
+        None if seq_no was not accepted. the first counted event is 0.
+        """
+
+    @abstractmethod
+    def set_sequence(self, device, seq_no: int):
+        """set the sequence number of device, e.g. after the device reported its own"""
+
+    @abstractmethod
+    def set_payload(self, device, payload: str):
+        """keep the latest payload of device for debugging"""
+
+    @abstractmethod
+    def load(self, device) -> dict:
+        """sequence number and event count of device by name, empty if unknown"""
+
+    @abstractmethod
+    def save(self, states: dict):
+        """write the state values of several devices, {device: {name: value}}"""
+
+    def close(self):
+        """write pending state and release the connections"""
+
+
+class MemoryStateStore(DeviceStateStore):
+    """
+    state in a dict of this process, e.g. for tests or a single relay
+    without redis. the state is lost on restart.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def advance_sequence(self, device, seq_no: int) -> tuple:
+        sequence_key = KEY.format(device, SEQUENCE)
+        count_key = KEY.format(device, EVENT_COUNT)
+        with self._lock:
+            last_seq_no = self.values.get(sequence_key, 0)
+            if seq_no != last_seq_no + 1:
+                return last_seq_no, None
+            self.values[sequence_key] = seq_no
+            event_count = self.values[count_key] + 1 if count_key in self.values else 0
+            self.values[count_key] = event_count
+        return last_seq_no, event_count
+
+    def set_sequence(self, device, seq_no: int):
+        with self._lock:
+            self.values[KEY.format(device, SEQUENCE)] = seq_no
+
+    def set_payload(self, device, payload: str):
+        with self._lock:
+            self.values[KEY.format(device, PAYLOAD)] = payload
+
+    def load(self, device) -> dict:
+        with self._lock:
+            return {
+                name: self.values[KEY.format(device, name)]
+                for name in (SEQUENCE, EVENT_COUNT) if KEY.format(device, name) in self.values}
+
+    def save(self, states: dict):
+        with self._lock:
+            for device, state in states.items():
+                for name, value in state.items():
+                    self.values[KEY.format(device, name)] = value
+
+
+class RedisStateStore(DeviceStateStore):
+    """
+    state in redis, shared by all relays. accepting a sequence number is
+    one round trip running ADVANCE_SEQUENCE_SCRIPT, the connections come
+    from a pool shared by all threads. servers without scripting (e.g.
+    fakeredis without lupa) are served with an optimistic transaction.
+
+    client may be any redis client (e.g. fakeredis.FakeStrictRedis with
+    decode_responses=True), otherwise one is created for host and port.
+    with write_behind the payloads are collected and the latest one per
+    device is written every write_behind seconds in one pipeline, instead
+    of one round trip per message.
+    """
+
+    def __init__(self, client=None, host='127.0.0.1', port=6379, db=0, password=None,
+                 max_connections=10, write_behind=None):
+        super().__init__()
+        if client is None:
+            if redis is None:
+                raise ImportError('the redis state store needs the redis package')
+            # blocks instead of failing if all connections are in use
+            pool = redis.BlockingConnectionPool(
+                host=host,
+                port=port,
+                db=db,
+                password=password,
+                max_connections=max_connections,
+                decode_responses=True)
+            client = redis.Redis(connection_pool=pool)
+        self.client = client
+        self._advance_script = client.register_script(ADVANCE_SEQUENCE_SCRIPT)
+        self._scripting = True
+        self.write_behind = write_behind
+        # latest payload by device, written by the write behind thread
+        self._payloads = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if write_behind:
+            self._thread = threading.Thread(
+                target=self._write_behind_loop,
+                name='device-state-write-behind',
+                daemon=True)
+            self._thread.start()
+
+    def advance_sequence(self, device, seq_no: int) -> tuple:
+        keys = (KEY.format(device, SEQUENCE), KEY.format(device, EVENT_COUNT))
+        if self._scripting:
+            try:
+                last_seq_no, event_count = self._advance_script(keys=keys, args=(seq_no,))
+            except redis.exceptions.ResponseError as err:
+                if 'unknown command' not in str(err):
+                    raise
+                self.logger.warning(f'redis server has no scripting ({err}), using transactions')
+                self._scripting = False
+            else:
+                return int(last_seq_no), None if event_count < 0 else int(event_count)
+        return self._advance_transaction(keys, seq_no)
+
+    def _advance_transaction(self, keys, seq_no: int) -> tuple:
+        sequence_key, count_key = keys
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(sequence_key, count_key)
+                    last_seq_no = int(pipe.get(sequence_key) or 0)
+                    if seq_no != last_seq_no + 1:
+                        return last_seq_no, None
+                    event_count = pipe.get(count_key)
+                    event_count = 0 if event_count is None else int(event_count) + 1
+                    pipe.multi()
+                    pipe.set(sequence_key, seq_no)
+                    pipe.set(count_key, event_count)
+                    pipe.execute()
+                    return last_seq_no, event_count
+                except redis.exceptions.WatchError:
+                    # changed by another relay in the meantime
+                    continue
+
+    def set_sequence(self, device, seq_no: int):
+        self.client.set(KEY.format(device, SEQUENCE), seq_no)
+
+    def set_payload(self, device, payload: str):
+        if not self.write_behind:
+            self.client.set(KEY.format(device, PAYLOAD), payload)
+            return
+        with self._lock:
+            self._payloads[device] = payload
+
+    def load(self, device) -> dict:
+        names = (SEQUENCE, EVENT_COUNT)
+        values = self.client.mget([KEY.format(device, name) for name in names])
+        return {name: int(value) for name, value in zip(names, values) if value is not None}
+
+    def save(self, states: dict):
+        pipe = self.client.pipeline(transaction=False)
+        for device, state in states.items():
+            for name, value in state.items():
+                pipe.set(KEY.format(device, name), value)
+        pipe.execute()
+
+    def flush(self):
+        """write the collected payloads"""
+        with self._lock:
+            payloads, self._payloads = self._payloads, {}
+        if not payloads:
+            return
+        try:
+            self.save({device: {PAYLOAD: payload} for device, payload in payloads.items()})
+        except redis.exceptions.RedisError as err:
+            self.logger.warning(f'writing the payloads of {len(payloads)} devices failed: {err}')
+
+    def _write_behind_loop(self):
+        while not self._stopped.wait(self.write_behind):
+            self.flush()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self.client.close()
+
+
+
+class CachedStateStore(DeviceStateStore):
+    """
+    write through cache of the device state in front of another store
+    (the backend). the state of a device is read from the backend once and
+    then served from memory, changes are written to the backend by a
+    background thread every write_interval seconds in one batch. the
+    state of at most maxsize devices is kept, the least recently used
+    device is evicted.
+
+    the cache assumes that no other relay or worker process changes the
+    state of its devices, otherwise it serves stale sequence numbers and
+    overwrites the changes of the others. the relay does not cache with
+    shared subscriptions. with snapshot_path the cached state is written to that file
+    every snapshot_interval seconds and on close. without backend the
+    snapshot is loaded on start, so the state survives a restart without
+    redis; maxsize then has to hold all devices and payloads are not kept.
+    with a backend the backend is newer than the last snapshot after a
+    crash, the snapshot is not loaded.
+    """
+
+    def __init__(self, backend: DeviceStateStore = None, maxsize=10000, write_interval=0.1,
+                 snapshot_path=None, snapshot_interval=60):
+        super().__init__()
+        if maxsize < 1:
+            raise ValueError(f'cache needs room for at least one device, got {maxsize}')
+        self.backend = backend
+        self.maxsize = maxsize
+        self.write_interval = write_interval
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.hits = 0
+        self.misses = 0
+        # device -> {name: value}, least recently used first
+        self._states = OrderedDict()
+        # changes not yet written to the backend, {device: {name: value}}
+        self._dirty = {}
+        # changes being written by flush
+        self._writing = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        if snapshot_path and backend is None:
+            self._load_snapshot()
+        self._threads = []
+        if backend is not None:
+            self._start_thread(self._write_loop, 'device-state-write-through')
+        if snapshot_path and snapshot_interval:
+            self._start_thread(self._snapshot_loop, 'device-state-snapshot')
+
+    def __len__(self):
+        return len(self._states)
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _state(self, device) -> dict:
+        """cached state of device, loaded from the backend on a miss. called with the lock held"""
+        state = self._states.get(device)
+        if state is not None:
+            self._states.move_to_end(device)
+            self.hits += 1
+            return state
+        self.misses += 1
+        # loading with the lock held keeps a device from being loaded twice,
+        # misses are rare once the devices are cached
+        state = self.backend.load(device) if self.backend is not None else {}
+        # changes of an evicted device may not have reached the backend yet
+        for pending in (self._writing, self._dirty):
+            if device in pending:
+                state = dict(state, **pending[device])
+        self._states[device] = state
+        if len(self._states) > self.maxsize:
+            self._states.popitem(last=False)
+        return state
+
+    def _changed(self, device, values: dict):
+        """queue changed values for the backend. called with the lock held"""
+        if self.backend is not None:
+            self._dirty.setdefault(device, {}).update(values)
+
+    def advance_sequence(self, device, seq_no: int) -> tuple:
+        with self._lock:
+            state = self._state(device)
+            last_seq_no = state.get(SEQUENCE, 0)
+            if seq_no != last_seq_no + 1:
+                return last_seq_no, None
+            event_count = state[EVENT_COUNT] + 1 if EVENT_COUNT in state else 0
+            state[SEQUENCE] = seq_no
+            state[EVENT_COUNT] = event_count
+            self._changed(device, {SEQUENCE: seq_no, EVENT_COUNT: event_count})
+        return last_seq_no, event_count
+
+    def set_sequence(self, device, seq_no: int):
+        with self._lock:
+            self._state(device)[SEQUENCE] = seq_no
+            self._changed(device, {SEQUENCE: seq_no})
+
+    def set_payload(self, device, payload: str):
+        # only written through, it is not read back
+        with self._lock:
+            self._changed(device, {PAYLOAD: payload})
+
+    def load(self, device) -> dict:
+        with self._lock:
+            return dict(self._state(device))
+
+    def save(self, states: dict):
+        with self._lock:
+            for device, state in states.items():
+                self._state(device).update(
+                    (name, value) for name, value in state.items() if name != PAYLOAD)
+                self._changed(device, state)
+
+    def flush(self):
+        """write the changed state to the backend"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._writing = dirty
+        if not dirty:
+            return
+        try:
+            self.backend.save(dirty)
+        except Exception as err:
+            self.logger.warning(f'writing the state of {len(dirty)} devices failed: {err}. retrying..')
+            with self._lock:
+                # keep changes made in the meantime
+                for device, values in dirty.items():
+                    self._dirty[device] = dict(values, **self._dirty.get(device, {}))
+                self._writing = {}
+            return
+        with self._lock:
+            self._writing = {}
+
+    def _write_loop(self):
+        while not self._stopped.wait(self.write_interval):
+            self.flush()
+
+    def snapshot(self):
+        """write the cached state to snapshot_path"""
+        with self._lock:
+            states = list(self._states.items())
+        path = f'{self.snapshot_path}.tmp'
+        with open(path, 'w') as snapshot_file:
+            json.dump(states, snapshot_file)
+        # a crash while writing leaves the previous snapshot intact
+        os.replace(path, self.snapshot_path)
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                states = json.load(snapshot_file)
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            self.logger.error(f'ignoring device state snapshot {self.snapshot_path}: {err}')
+            return
+        # least recently used first, the newest are kept if maxsize shrank
+        for device, state in states[-self.maxsize:]:
+            self._states[device] = state
+        self.logger.info(f'loaded the state of {len(self._states)} devices from {self.snapshot_path}')
+
+    def _snapshot_loop(self):
+        while not self._stopped.wait(self.snapshot_interval):
+            try:
+                self.snapshot()
+            except OSError as err:
+                self.logger.warning(f'writing device state snapshot {self.snapshot_path} failed: {err}')
+
+    def close(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.backend is not None:
+            self.flush()
+            self.backend.close()
+        if self.snapshot_path:
+            self.snapshot()
+
+
+# store of the converters created without one, see default_store
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def default_store() -> DeviceStateStore:
+    """the store set by the relay, redis on localhost if none was set"""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = RedisStateStore()
+        return _default_store
+
+
+def set_default_store(store: DeviceStateStore):
+    global _default_store
+    with _default_lock:
+        _default_store = store
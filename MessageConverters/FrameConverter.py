@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import base64
+import inspect
+import json
+import threading
+from collections import OrderedDict
+
+from MessageConverters.MessageConverter import MessageConverter
+
+# field of the converted message with the downlink prepared by the device
+# converter, taken out of the message by the relay before publishing
+DOWNLINK = 'downlink'
+# field of 'preconverted' with the records decoded from the frame
+ENTRIES = 'entries'
+
+
+def decodes_frames(device_class) -> bool:
+    """True if device_class decodes the frames of one device: _convert(payload, port)"""
+    return 'port' in inspect.signature(device_class._convert).parameters
+
+
+class FrameConverter(MessageConverter):
+    """
+    message api for the converters of device frames (PIOT, UC11XX, MCF, ..),
+    which are created per device and decode the raw frame of a port.
+    the frame is taken from the fields TTN_V3 puts into 'preconverted', the
+    port from the uplink.
+    the records decoded from the frame are added to them as they are, with
+    their tags and times, since a frame may hold several records with the
+    same fields (e.g. a PIOT time sync and a badge event):
+        "entries": [{"fields": {..}, "tags": {..}}, ..]
+    a downlink the device converter prepared for the frame (decode_frame)
+    is added to the message:
+        "downlink": {"f_port": 85, "frm_payload": "ogEA"}
+    one device converter is kept per device_id, up to max_devices.
+    """
+
+    def __init__(self, device_class, max_devices=10000):
+        super().__init__()
+        self.device_class = device_class
+        self.max_devices = max_devices
+        # device_id -> device converter, least recently used first
+        self._devices = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def _device(self, device_id):
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is not None:
+                self._devices.move_to_end(device_id)
+                return device
+            device = self.device_class(device_id)
+            self._devices[device_id] = device
+            if len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+            return device
+
+    def _convert(self, message):
+        message_json = json.loads(message.decode('utf-8'))
+        return json.dumps(self._convert_message(message_json)).encode('utf-8')
+
+    def _convert_message(self, message_json):
+        preconverted = message_json.get('preconverted')
+        if not preconverted or not preconverted.get('device_id'):
+            raise ValueError(f'{self.device_class.__name__} needs the fields of TTN_V3 in preconverted')
+        port = (message_json.get('uplink_message') or {}).get('f_port')
+        frame = base64.b64decode(preconverted.get('payload') or '')
+        entries, downlink = self._device(preconverted['device_id']).decode_frame(frame, port)
+        preconverted[ENTRIES] = list(entries or ())
+        if downlink is not None:
+            message_json[DOWNLINK] = {
+                'f_port': port,
+                'frm_payload': base64.b64encode(bytes(downlink)).decode('ascii')}
+        return message_json
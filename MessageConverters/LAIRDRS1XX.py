@@ -1,14 +1,12 @@
 #!/usr/bin/python3
 
 import time
-from MessageConverters.MessageConverter import MessageConverter
+from MessageConverters.MessageConverter import MessageConverter, DecodeContext
 import logging
 from datetime import datetime, timedelta
 
 class LAIRDRS1XX(MessageConverter):
 
-    downlinkMessage= None
-    
     def __init__(self, devicename):
         super().__init__(devicename)
 
@@ -63,14 +61,15 @@ class LAIRDRS1XX(MessageConverter):
             ))
         return payload_bytes
     
-    def _hasDownlinkMessage(self):
-        return self.downlinkMessage is not None
+    def _convert(self, payload, port) :
+        return self.decode_frame(payload, port)[0]
 
-    def _getDownlinkMessage(self):
-        return self.downlinkMessage   
+    def decode_frame(self, payload, port) :
+        ctx = DecodeContext(payload)
+        publ_array = self.__decode(ctx, payload)
+        return publ_array, ctx.downlink_message
 
-    def _convert(self, payload, port) :
-        self.downlinkMessage= None
+    def __decode(self, ctx, payload) :
         publ_array = []
         try:
             params = {}
@@ -138,7 +137,7 @@ class LAIRDRS1XX(MessageConverter):
                 msgType = payload_list.pop(0)
                 options = payload_list.pop(0)
                 if options == 1: #request for downlink 'setUTC'
-                    self.downlinkMessage = self.__prepareSetUTC()
+                    ctx.downlink_message = self.__prepareSetUTC()
                 alarmMsgCount = payload_list.pop(0)
                 backlogMsgCount = int.from_bytes( [payload_list.pop(0),payload_list.pop(0)], byteorder='big')
                 batteryCapacity = payload_list.pop(0)
@@ -182,7 +181,7 @@ class LAIRDRS1XX(MessageConverter):
                 msgType = payload_list.pop(0)
                 options = payload_list.pop(0)
                 if options == 1: #request for downlink 'setUTC'
-                    self.downlinkMessage = self.__prepareSetUTC()
+                    ctx.downlink_message = self.__prepareSetUTC()
                 batteryType = payload_list.pop(0)
                 readSensorPeriod = int.from_bytes( [payload_list.pop(0),payload_list.pop(0)], byteorder='big')
                 sensorAggregate = payload_list.pop(0)
@@ -2,8 +2,14 @@
 
 import time
 from MessageConverters.MessageConverter import MessageConverter
+from MessageConverters.PayloadReader import PayloadReader
 import logging
 from datetime import datetime
+import struct
+
+# battery, SHT20 temperature (signed), SHT20 humidity,
+# ext sensor model (ignored), DS18B20 temperature (signed)
+LAYOUT = struct.Struct('>HhHxh')
 
 
 class LHT65(MessageConverter):
@@ -48,49 +54,25 @@ class LHT65(MessageConverter):
             }
         ]
         '''
-        payload_list = list(bytearray(payload))
+        payload = PayloadReader(payload)
         publ_array = []
         curr_time = int(time.time())
         entry = {}
-        if (len(payload_list) == 0):
+        if (len(payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         fields = {}
         try:
+            battery, temp_sht, hum_sht, temp_ds = payload.read(LAYOUT)
             # battery voltage
-            value = (
-                payload_list.pop(0) << 8 |
-                payload_list.pop(0))
-            value &= 0x3FFF
-            fields['batV'] = value/1000
-            
+            fields['batV'] = (battery & 0x3FFF)/1000
             # SHT20,temperature,units:℃
-            value = (
-                payload_list.pop(0) << 8 |
-                payload_list.pop(0))
-            # check if minus value
-            if(value & 0x8000):
-                value -= 1 << 16
-            fields['temp_SHT'] = value/100
-
+            fields['temp_SHT'] = temp_sht/100
             # SHT20,Humidity,units:%
-            value = (
-                payload_list.pop(0) << 8 |
-                payload_list.pop(0))
-            fields['hum_SHT'] = value/10
-
-            # ignore byte 6 (ext sensor model)
-            payload_list.pop(0)
-
+            fields['hum_SHT'] = hum_sht/10
             # DS18B20,temperature,units:℃
-            value = (
-                payload_list.pop(0) << 8 |
-                payload_list.pop(0))
-             # check if minus value
-            if(value & 0x8000):
-                value -= 1 << 16
-            fields['temp_ds'] = value/100
-            
+            fields['temp_ds'] = temp_ds/100
+
             entry['fields'] = fields
             publ_array.append(entry)
         except Exception as err:
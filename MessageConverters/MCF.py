@@ -1,10 +1,16 @@
 #!/usr/bin/python3
 
-from MessageConverters.MessageConverter import MessageConverter
+from MessageConverters.MessageConverter import MessageConverter, DecodeContext
+from MessageConverters.PayloadReader import PayloadReader
 import logging
 from datetime import datetime
 from datetime import timezone
+import struct
 
+# active energy (sent twice), reactive energy, apparent energy, running time
+POWER = struct.Struct('<IIIII')
+# inputs, outputs, events
+IO = struct.Struct('<III')
 
 class MCF(MessageConverter):
     msg_types = {
@@ -25,301 +31,226 @@ class MCF(MessageConverter):
     def __init__(self, devicename=None):
         super().__init__(devicename)
 
-    def __parse_time(self):
-        a = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        value = list(a.to_bytes(4, byteorder='little'))
-        self.logger.info(f"time payload: {value}")
+    def __parse_time(self, ctx):
+        value = ctx.payload.bytes(4)
+        info = self.logger.isEnabledFor(logging.INFO)
+        if info:
+            self.logger.info(f"time payload: {list(value)}")
         year = 2000 + (value[3] >> 1)
         month = ((value[3] & 0x01) << 3) | (value[2] >> 5)
         day = value[2] & 0x1f
         hours = value[1] >> 3
         minutes = ((value[1] & 0x7) << 3) | (value[0] >> 5)
         seconds = value[0] & 0x1f
-        self.logger.info(
-            f'year : {year}, '
-            f'month : {month}, '
-            f'day : {day}, '
-            f'hours : {hours}, '
-            f'minutes : {minutes}, '
-            f'seconds : {seconds}')
+        if info:
+            self.logger.info(
+                f'year : {year}, '
+                f'month : {month}, '
+                f'day : {day}, '
+                f'hours : {hours}, '
+                f'minutes : {minutes}, '
+                f'seconds : {seconds}')
         # datetime(year, month, day, hour, minute, second, microsecond)
         date_time_obj = datetime(year, month, day, hours, minutes, seconds)
 
         return int(datetime.timestamp(date_time_obj))
 
-    def parse_time_sync_request(self):
+    def parse_time_sync_request(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         fields = {}
         # sync id
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
+        value = ctx.payload.u32le()
         fields['sync_id'] = value
         # sync version
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16)
+        value = ctx.payload.u24le()
         fields['sync version'] = value
         # application type
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8)
+        value = ctx.payload.u16le()
         fields["app_type"] = value
         # option
-        value = self.payload.pop(0)
+        value = ctx.payload.u8()
         fields["option"] = value
         entry['fields'] = fields
         return entry
 
-    def parse_t_p_rh(self):
+    def parse_t_p_rh(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         fields = {}
         # time
-        fields['time'] = self.__parse_time()
+        fields['time'] = self.__parse_time(ctx)
         # temperature
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8) / 100
+        value = ctx.payload.u16le() / 100
         fields['temperature'] = value
         # humidity
-        value = self.payload.pop(0) / 2
+        value = ctx.payload.u8() / 2
         fields["humidity"] = value
         # pressure1
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16)
+        value = ctx.payload.u24le()
         fields["pressure"] = value
         entry['fields'] = fields
         return entry
 
-    def parse_uart(self):
+    def parse_uart(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         self.logger.warn("parse function not implemented - skipping.")
         return entry
 
-    def parse_power(self):
+    def parse_power(self, ctx):
         # TODO: there is a 2nd payload version woth more data..
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         fields = {}
         # time
-        fields['time'] = self.__parse_time()
-        # active energy
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        fields['active_energy'] = value
-        # active energy
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        fields['active_energy'] = value
-        # reactive energy
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        fields['reactive_energy'] = value
-        # apparent energy
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        fields['apparent_energy'] = value
-        # running_time
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        fields['running_time'] = value
+        fields['time'] = self.__parse_time(ctx)
+        _, active, reactive, apparent, running_time = ctx.payload.read(POWER)
+        fields['active_energy'] = active
+        fields['reactive_energy'] = reactive
+        fields['apparent_energy'] = apparent
+        fields['running_time'] = running_time
         entry['fields'] = fields
         return entry
 
-    def parse_io(self):
+    def parse_io(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         fields = {}
         # time
-        fields['time'] = self.__parse_time()
-        # inputs
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        fields['inputs'] = bin(value)[2:]
-        # outputs
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        fields['outputs'] = bin(value)[2:]
-        # events
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        fields['events'] = bin(value)[2:]
+        fields['time'] = self.__parse_time(ctx)
+        inputs, outputs, events = ctx.payload.read(IO)
+        fields['inputs'] = bin(inputs)[2:]
+        fields['outputs'] = bin(outputs)[2:]
+        fields['events'] = bin(events)[2:]
         entry['fields'] = fields
         return entry
 
-    def parse_report_data(self):
+    def parse_report_data(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         self.logger.warn("parse function not implemented - skipping.")
         return entry
 
-    def parse_t_p_rh_lux_voc(self):
+    def parse_t_p_rh_lux_voc(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         fields = {}
         # first part is identical with t_p_rh
-        fields.update(self.parse_t_p_rh()['fields'])
+        fields.update(self.parse_t_p_rh(ctx)['fields'])
         # illuminance
-        value = value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8)
+        value = ctx.payload.u16le()
         fields['illuminance'] = value
         # voc
-        value = value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8)
+        value = ctx.payload.u16le()
         fields['voc'] = value
         entry['fields'] = fields
         return entry
 
-    def parse_analog_data(self):
+    def parse_analog_data(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         self.logger.warn("parse function not implemented - skipping.")
         return entry
 
-    def parse_t_p_rh_lux_voc_co2(self):
+    def parse_t_p_rh_lux_voc_co2(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         fields = {}
         # first part is identical with t_p_rh
-        fields.update(self.parse_t_p_rh_lux_voc()['fields'])
+        fields.update(self.parse_t_p_rh_lux_voc(ctx)['fields'])
         # co2
-        value = value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8)
+        value = ctx.payload.u16le()
         fields['co2'] = value
         entry['fields'] = fields
         return entry
 
-    def parse_special_data(self):
+    def parse_special_data(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         self.logger.warn("parse function not implemented - skipping.")
         return entry
 
-    def parse_digital_data(self):
+    def parse_digital_data(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         fields = {}
         # type
-        value = self.payload.pop(0)
+        value = ctx.payload.u8()
         fields['type'] = value
         if value == 0:
             for num in range(16):
-                if (self.payload):
-                    value = value = (
-                        self.payload.pop(0) |
-                        self.payload.pop(0) << 8)
+                if (ctx.payload):
+                    value = ctx.payload.u16le()
                     fields[f'input_{num}'] = value
         elif (value == 1):
             # time
-            fields['time'] = self.__parse_time()
+            fields['time'] = self.__parse_time(ctx)
             # frequency
-            value = (
-                self.payload.pop(0) |
-                self.payload.pop(0) << 8)
+            value = ctx.payload.u16le()
             fields['frequency'] = value/10
             # battery pecentage (optional)
-            if (self.payload):
-                value = self.payload.pop(0)
+            if (ctx.payload):
+                value = ctx.payload.u8()
                 fields['battery_percentage'] = value          
         elif (value == 2):
             for num in range(5):
-                if (self.payload):
-                    fields[f'time_{num}'] = self.__parse_time()
-                    value = value = (
-                        self.payload.pop(0) |
-                        self.payload.pop(0) << 8)
+                if (ctx.payload):
+                    fields[f'time_{num}'] = self.__parse_time(ctx)
+                    value = ctx.payload.u16le()
                     fields[f'input_{num}'] = value
             # battery pecentage (optional)
-            if (self.payload):
-                value = self.payload.pop(0)
+            if (ctx.payload):
+                value = ctx.payload.u8()
                 fields['battery_percentage'] = value
         else:
             self.logger.warn(f'unknown type "{value}" - skipping.')
         entry['fields'] = fields
         return entry
 
-    def parse_serial_data(self):
+    def parse_serial_data(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         self.logger.warn("parse function not implemented - skipping.")
         return entry
 
-    def parse_length_error(self):
+    def parse_length_error(self, ctx):
         entry = {}
-        if (len(self.payload) == 0):
+        if (len(ctx.payload) == 0):
             self.logger.warn("message has no content - skipping.")
             return entry
         fields = {}
         # ignore seq no
-        self.payload.pop(0) | self.payload.pop(0) << 8
+        ctx.payload.u16le()
         # bat level
-        value = self.payload.pop(0)
+        value = ctx.payload.u8()
         fields['batt_level'] = str(value)
         # hw&fw version
-        value = self.payload.pop(0)
+        value = ctx.payload.u8()
         fields['hwfw'] = str(value)
         entry['fields'] = fields
         return entry
@@ -350,39 +281,43 @@ class MCF(MessageConverter):
         '''
         publ_array = []
         dt = datetime.utcnow()
-        self.current_ts = int(dt.replace(tzinfo=timezone.utc).timestamp())
-        self.current_time = dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-        self.payload = list(bytearray(payload))
-        self.logger.debug(
-            "decoding payload {}. servertime is {} (ts: {})".format(
-                    payload,
-                    self.current_time,
-                    self.current_ts))
+        ctx = DecodeContext(
+            PayloadReader(payload),
+            int(dt.replace(tzinfo=timezone.utc).timestamp()),
+            dt.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug(
+                "decoding payload {}. servertime is {} (ts: {})".format(
+                        payload,
+                        ctx.time,
+                        ctx.ts))
         try:
-            self.cursor = 0
-            while len(self.payload) > 0:
+            while len(ctx.payload) > 0:
                 # header
-                messagetype_byte = self.payload.pop(0)
-                self.logger.debug("message type: {}".format(
-                    hex(messagetype_byte)))
+                messagetype_byte = ctx.payload.u8()
+                if debug:
+                    self.logger.debug("message type: {}".format(
+                        hex(messagetype_byte)))
                 messagetype = self.msg_types.get(messagetype_byte, None)
                 if messagetype:
                     method_name = "parse_" + messagetype
-                    method = getattr(self, method_name, lambda: None)
+                    method = getattr(self, method_name, None)
                     if method:
-                        entry = method()
-                        self.payload = []
+                        entry = method(ctx)
+                        ctx.payload.skip()
                         if entry:
                             # add common tags and fields
-                            entry["ts"] = self.current_time
+                            entry["ts"] = ctx.time
                             if "tags" not in entry:
                                 entry["tags"] = {}
                             entry["tags"]["devicename"] = self.devicename
                             entry["tags"]["messagetype"] = messagetype
-                            self.logger.debug(
-                                "method_name: {}, result:{}".format(
-                                    method_name,
-                                    entry))
+                            if debug:
+                                self.logger.debug(
+                                    "method_name: {}, result:{}".format(
+                                        method_name,
+                                        entry))
                             publ_array.extend([entry])
                     else:
                         self.logger.exception(
@@ -6,8 +6,8 @@ import logging
 from datetime import datetime
 
 class MCF88LW12CO2(MessageConverter):
-    def __init__(self):
-        MessageConverter.__init__(self)
+    def __init__(self, devicename = None):
+        MessageConverter.__init__(self, devicename)
 
     def __toTime(self, byteArray):
         year = 2000 + (byteArray[3] >> 1)
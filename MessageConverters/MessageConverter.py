@@ -2,13 +2,37 @@
 from abc import ABC, abstractmethod
 import logging
 
+
+class DecodeContext:
+    """
+    state of a single conversion. converters are shared by all worker
+    threads, so everything belonging to the message being decoded
+    (payload cursor, server time, prepared downlink) is kept here and
+    passed along instead of being stored on the converter.
+    """
+
+    __slots__ = ('payload', 'ts', 'time', 'downlink_message')
+
+    def __init__(self, payload=None, ts=None, time=None):
+        self.payload = payload
+        self.ts = ts
+        self.time = time
+        self.downlink_message = None
+
+
 class MessageConverter(ABC):
 
+    # True if _convert_message takes the time settings of the route
+    # (see Timestamps.uplink_millis) as second argument
+    uses_timestamp = False
+
     def __init__(self, devicename=None):
         super().__init__()
         self.devicename = devicename
         self.downlinkMessage = None
         self.logger = logging.getLogger(__name__)
+        # number of failed conversions, exported as metric by the relay
+        self.error_count = 0
         self.logger.debug(
             f'message converter initialized. {type(self)}'
             )
@@ -19,24 +43,67 @@ class MessageConverter(ABC):
         """
         abstract method to decode payload.
         must be implemented in subclass and return decoded payload as
-        dict.
+        dict. converters are called from several threads at once, per
+        message state belongs into a DecodeContext, not on self.
+        """
+
+    def decode_frame(self, payload: bytes, port) -> tuple:
         """
+        decode a frame with the _convert(payload, port) of a device converter.
+        returns (entries, downlink). converters preparing downlinks override
+        it and return the downlink of this frame, None if there is none.
+        """
+        return self._convert(payload, port), None
+
+    def _convert_message(self, message: dict) -> dict:
+        """
+        method to decode an already parsed json message.
+        may be implemented in subclass to let the relay pass the decoded
+        message from converter to converter instead of bytes.
+        must return the converted message.
+        """
+        raise NotImplementedError
+
+    @property
+    def accepts_message(self) -> bool:
+        """True if the subclass implements the message api (_convert_message)"""
+        return type(self)._convert_message is not MessageConverter._convert_message
+
     def convert(self, payload_bytes: bytes):
         try:
-            self.logger.debug(
-                f'message converter - message has type {type(payload_bytes)} / length {len(payload_bytes)}'
-            )
-            self.logger.debug(
-                f"message converter - message before conversion: {payload_bytes.decode(encoding='utf-8')}")
+            # rendering the payload is expensive, only do it if it gets logged
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                self.logger.debug(
+                    f'message converter - message has type {type(payload_bytes)} / length {len(payload_bytes)}'
+                )
+                self.logger.debug(
+                    f"message converter - message before conversion: {payload_bytes.decode(encoding='utf-8', errors='replace')}")
             converted_message = self._convert(payload_bytes)
-            self.logger.debug(
-                f'message converter - converted message has type {type(converted_message)} / length {len(converted_message)}'
-            )
-            self.logger.debug(
-                f"message converter - message after conversion: {converted_message.decode(encoding='utf-8')}")
+            if debug:
+                self.logger.debug(
+                    f'message converter - converted message has type {type(converted_message)} / length {len(converted_message)}'
+                )
+                self.logger.debug(
+                    f"message converter - message after conversion: {converted_message.decode(encoding='utf-8', errors='replace')}")
             return converted_message
         except Exception:
+            self.error_count += 1
             self.logger.exception("Error while trying to decode payload..")
             return payload_bytes
-        
 
+    def convert_message(self, message: dict, timestamp=None) -> dict:
+        try:
+            if self.uses_timestamp:
+                converted_message = self._convert_message(message, timestamp)
+            else:
+                converted_message = self._convert_message(message)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(
+                    f'message converter - converted message has type {type(converted_message)}'
+                )
+            return converted_message
+        except Exception:
+            self.error_count += 1
+            self.logger.exception("Error while trying to decode message..")
+            return message
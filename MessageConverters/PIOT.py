@@ -3,15 +3,16 @@
 import time
 from datetime import timezone
 from datetime import datetime
-import redis
+import struct
 
-from MessageConverters.MessageConverter import MessageConverter
-# connect to redis
-_redis = redis.StrictRedis(
-    charset="utf-8",
-    decode_responses=True,
-    host='127.0.0.1',
-    port=6379)
+from MessageConverters.MessageConverter import MessageConverter, DecodeContext
+from MessageConverters.PayloadReader import PayloadReader
+from MessageConverters.DeviceState import default_store
+
+# seq no, device time
+TIME_SYNC = struct.Struct('<HI')
+# current seq no, next seq no, last ack no
+ACK_NOT_FOUND = struct.Struct('<HHH')
 
 
 class PIOT(MessageConverter):
@@ -24,49 +25,45 @@ class PIOT(MessageConverter):
             0x07: "ack_not_found"
         }
 
-    def __init__(self, devicename):
+    def __init__(self, devicename, state=None):
         super().__init__(devicename)
-        self.payload = None
-        self.downlink_message = None
-        self.current_ts = None
+        # sequence numbers of the device, in the store configured by the relay (device-state)
+        self.state = state if state is not None else default_store()
 
-    def send_downlink(self, msg):
+    def send_downlink(self, ctx, msg):
         # downlink has to wait some time because of stupid implementation on device side
         # time.sleep(1.8)
         self.logger.debug(f'downlink msg: {msg}')
-        self.downlink_message = msg
+        ctx.downlink_message = msg
 
 
-    def parse_status(self):
+    def parse_status(self, ctx):
         """parse badge_event payload"""
         entry = {}
-        if len(self.payload) == 0:
+        if len(ctx.payload) == 0:
             self.logger.warning("parse message has no content - skipping.")
             return entry
         fields = {}
         # ignore seq no
-        self.payload.pop(0)
-        self.payload.pop(0)
+        ctx.payload.skip(2)
         # bat level
-        value = self.payload.pop(0)
+        value = ctx.payload.u8()
         fields['batt_level'] = str(value)
         # hw&fw version
-        value = self.payload.pop(0)
+        value = ctx.payload.u8()
         fields['hwfw'] = str(value)
         entry['fields'] = fields
         return entry
 
-    def parse_badge_event(self):
+    def parse_badge_event(self, ctx):
         """parse badge_event payload"""
         entry = {}
         fields = {}
         # seq no
-        value = self.payload.pop(0) | self.payload.pop(0) << 8
+        value = ctx.payload.u16le()
         fields['seq no'] = value
-        # validate seq_no
-        last_seq_no = 0
-        if _redis.exists('{}:seq no'.format(self.devicename)):
-            last_seq_no = int(_redis.get('{}:seq no'.format(self.devicename)))
+        # validate seq_no, the expected one is stored and counted at once
+        last_seq_no, event_count = self.state.advance_sequence(self.devicename, fields['seq no'])
         self.logger.debug(
             'current seq_no is {}, '
             'last seq_no was {}'.format(fields['seq no'], last_seq_no))
@@ -81,8 +78,8 @@ class PIOT(MessageConverter):
             downlink_list = bytearray()
             downlink_list.append(0xA2)  # type is ACK_MESSAGE
             downlink_list.extend(last_seq_no.to_bytes(2, 'little'))  # seq_no
-            self.send_downlink(downlink_list)
-            self.payload = []
+            self.send_downlink(ctx, downlink_list)
+            ctx.payload.skip()
             return entry
         elif fields['seq no'] < last_seq_no + 1:
             self.logger.warn(
@@ -90,17 +87,11 @@ class PIOT(MessageConverter):
                 'packet was already received, skip this..')
             # seq_no from device is too low,
             # packet was already received, skip this..
-            self.payload = []
+            ctx.payload.skip()
             return entry
 
         # seq_no from device is as expected
         self.logger.info("seq_no from device is as expected")
-        _redis.set('{}:seq no'.format(self.devicename), fields['seq no'])
-        event_count = 0
-        if _redis.exists('{}:badge event count'.format(self.devicename)):
-            event_count = int(_redis.get('{}:badge event count'.format(
-                self.devicename))) + 1
-        _redis.set('{}:badge event count'.format(self.devicename), event_count)
         # sent confirmation every 10th badge event
         if event_count % 10 == 0:
             self.logger.info(
@@ -111,40 +102,26 @@ class PIOT(MessageConverter):
             downlink_list = bytearray()
             downlink_list.append(0xA2)  # type is ACK_MESSAGE
             downlink_list.extend(fields['seq no'].to_bytes(2, 'little'))
-            self.send_downlink(downlink_list)
+            self.send_downlink(ctx, downlink_list)
 
         # time
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
+        value = ctx.payload.u32le()
         fields['ts'] = value
         entry['fields'] = fields
         tags = {}
         # badge uuid
-        value = ''.join(format(x, '02x') for x in self.payload)
-        self.payload = []
+        value = ctx.payload.bytes().hex()
         tags['uuid'] = value
         entry['tags'] = tags
         return entry
 
-    def parse_time_sync(self):
+    def parse_time_sync(self, ctx):
         """parse time_sync payload"""
         entry = {}
         fields = {}
-        # seq no
-        value = self.payload.pop(0) | self.payload.pop(0) << 8
-        fields['seq no'] = value
-        # time
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8 |
-            self.payload.pop(0) << 16 |
-            self.payload.pop(0) << 24)
-        fields['ts'] = value
+        fields['seq no'], fields['ts'] = ctx.payload.read(TIME_SYNC)
         # timediff
-        fields['ts_diff'] = self.current_ts - fields['ts']
+        fields['ts_diff'] = ctx.ts - fields['ts']
         entry['fields'] = fields
 
         # prepare downlink with time delta
@@ -159,51 +136,37 @@ class PIOT(MessageConverter):
             '(servertime: {}, '
             'devicetime: {}'.format(
                 timedelta,
-                self.current_ts,
+                ctx.ts,
                 fields['ts']))
         downlink_list.extend(timedelta.to_bytes(4, 'little'))  # timedelta
         downlink_list.extend(fields['seq no'].to_bytes(2, 'little'))  # seq_no
-        self.send_downlink(downlink_list)
+        self.send_downlink(ctx, downlink_list)
         return entry
 
-    def parse_ack_not_found(self):
+    def parse_ack_not_found(self, ctx):
         """parse ack_not_found payload"""
         entry = {}
         fields = {}
-        # current seq no
-        value = self.payload.pop(0) | self.payload.pop(0) << 8
-        fields['curr seq no'] = value
-        # next seq no
-        value = self.payload.pop(0) | self.payload.pop(0) << 8
-        fields['next seq no'] = value
-        # last ack no
-        value = self.payload.pop(0) | self.payload.pop(0) << 8
-        fields['last_ack_no'] = value
+        fields['curr seq no'], fields['next seq no'], fields['last_ack_no'] = ctx.payload.read(ACK_NOT_FOUND)
         # sync last event no
         self.logger.warn(
             'syncing seq no to {}. '
             'current seq no on server was {}'.format(
                 fields['curr seq no'],
                 fields['last_ack_no']))
-        _redis.set('{}:seq no'.format(
-            self.devicename), fields['curr seq no'])
+        self.state.set_sequence(self.devicename, fields['curr seq no'])
         # prepare downlink with current seq_no
         downlink_list = bytearray()
         downlink_list.append(0xA2)  # type is ACK_MESSAGE
         downlink_list.extend(fields['curr seq no'].to_bytes(2, 'little'))
-        self.send_downlink(downlink_list)
+        self.send_downlink(ctx, downlink_list)
         entry['fields'] = fields
         return entry
 
-    def _hasDownlinkMessage(self):
-        """True if downlink payload is available"""
-        return self.downlink_message is not None
-
-    def _getDownlinkMessage(self):
-        """Get prepared message for downlink"""
-        return self.downlink_message
-
     def _convert(self, payload, port):
+        return self.decode_frame(payload, port)[0]
+
+    def decode_frame(self, payload, port):
         '''
         decode payload from PIOT to gwu format
         ldc publish format:
@@ -223,15 +186,16 @@ class PIOT(MessageConverter):
         ]
         '''
         publ_array = []
-        self.current_ts = int(
-            datetime.utcnow().replace(tzinfo=timezone.utc).timestamp())
-        self.payload = payload
-        # set a key
-        _redis.set('{}:payload'.format(self.devicename), str(payload))
+        ctx = DecodeContext(
+            PayloadReader(payload),
+            int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()))
+        # latest payload for debugging, as list of the byte values like
+        # earlier versions wrote it
+        self.state.set_payload(self.devicename, str(list(payload)))
         try:
-            while len(self.payload) > 0:
+            while len(ctx.payload) > 0:
                 # header
-                messagetype_byte = self.payload.pop(0)
+                messagetype_byte = ctx.payload.u8()
                 self.logger.debug("message type: {}".format(
                     hex(messagetype_byte)
                     )
@@ -239,9 +203,9 @@ class PIOT(MessageConverter):
                 messagetype = self.msg_types.get(messagetype_byte, None)
                 if messagetype:
                     method_name = "parse_" + messagetype
-                    method = getattr(self, method_name, lambda: None)
+                    method = getattr(self, method_name, None)
                     if method:
-                        entry = method()
+                        entry = method(ctx)
                         if entry:
                             # add common tags and fields
                             if "tags" not in entry:
@@ -265,4 +229,4 @@ class PIOT(MessageConverter):
         except Exception:
             self.logger.exception("Error while trying to decode payload..")
 
-        return publ_array
+        return publ_array, ctx.downlink_message
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import struct
+
+# precompiled layouts of the single field readers
+U16BE = struct.Struct('>H')
+U16LE = struct.Struct('<H')
+I16BE = struct.Struct('>h')
+I16LE = struct.Struct('<h')
+U32BE = struct.Struct('>I')
+U32LE = struct.Struct('<I')
+I32BE = struct.Struct('>i')
+I32LE = struct.Struct('<i')
+_u16be = U16BE.unpack_from
+_u16le = U16LE.unpack_from
+_i16be = I16BE.unpack_from
+_i16le = I16LE.unpack_from
+_u32be = U32BE.unpack_from
+_u32le = U32LE.unpack_from
+_i32be = I32BE.unpack_from
+_i32le = I32LE.unpack_from
+
+
+class PayloadReader:
+    """
+    cursor over a binary payload, used by the byte level converters.
+    reading a field neither copies nor shifts the remaining bytes like
+    list.pop(0) does. bytes payloads are read in place, other buffers are
+    copied once. len() is the number of unread bytes.
+
+    fixed layouts of several fields are read at once with a precompiled
+    struct.Struct, e.g.
+        LAYOUT = struct.Struct('>HhHxh')
+        battery, temperature, humidity, ext_temperature = reader.read(LAYOUT)
+    reading past the end raises struct.error (IndexError for u8).
+    """
+
+    __slots__ = ('_data', '_pos')
+
+    def __init__(self, payload):
+        if not isinstance(payload, bytes):
+            # bytearray, memoryview or list of byte values
+            payload = bytes(payload)
+        self._data = payload
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._data) - self._pos
+
+    def u8(self) -> int:
+        pos = self._pos
+        # indexing raises IndexError past the end
+        value = self._data[pos]
+        self._pos = pos + 1
+        return value
+
+    def i8(self) -> int:
+        value = self.u8()
+        return value - 256 if value & 0x80 else value
+
+    def u16be(self) -> int:
+        pos = self._pos
+        value, = _u16be(self._data, pos)
+        self._pos = pos + 2
+        return value
+
+    def u16le(self) -> int:
+        pos = self._pos
+        value, = _u16le(self._data, pos)
+        self._pos = pos + 2
+        return value
+
+    def i16be(self) -> int:
+        pos = self._pos
+        value, = _i16be(self._data, pos)
+        self._pos = pos + 2
+        return value
+
+    def i16le(self) -> int:
+        pos = self._pos
+        value, = _i16le(self._data, pos)
+        self._pos = pos + 2
+        return value
+
+    def u24be(self) -> int:
+        return self.u8() << 16 | self.u16be()
+
+    def u24le(self) -> int:
+        return self.u16le() | self.u8() << 16
+
+    def u32be(self) -> int:
+        pos = self._pos
+        value, = _u32be(self._data, pos)
+        self._pos = pos + 4
+        return value
+
+    def u32le(self) -> int:
+        pos = self._pos
+        value, = _u32le(self._data, pos)
+        self._pos = pos + 4
+        return value
+
+    def i32be(self) -> int:
+        pos = self._pos
+        value, = _i32be(self._data, pos)
+        self._pos = pos + 4
+        return value
+
+    def i32le(self) -> int:
+        pos = self._pos
+        value, = _i32le(self._data, pos)
+        self._pos = pos + 4
+        return value
+
+    def read(self, layout: struct.Struct) -> tuple:
+        """read all fields of a precompiled layout"""
+        values = layout.unpack_from(self._data, self._pos)
+        self._pos += layout.size
+        return values
+
+    def bytes(self, count=None) -> bytes:
+        """read count bytes, all remaining bytes if count is None"""
+        end = len(self._data) if count is None else self._pos + count
+        if end > len(self._data):
+            raise IndexError('read past the end of the payload')
+        value = self._data[self._pos:end]
+        self._pos = end
+        return value
+
+    def skip(self, count=None):
+        """skip count bytes, all remaining bytes if count is None"""
+        self._pos = len(self._data) if count is None else min(self._pos + count, len(self._data))
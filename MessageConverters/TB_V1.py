@@ -3,8 +3,9 @@
 import time
 import base64
 import json
-from datetime import datetime
+import logging
 from MessageConverters.MessageConverter import MessageConverter
+from MessageConverters.Timestamps import uplink_millis
 
 
 '''
@@ -15,17 +16,23 @@ example payload tb v1:
 
 class TB_V1(MessageConverter):
 
+    uses_timestamp = True
+
     def __init__(self):
         super().__init__()
 
     def _convert(self, message):
         message_json = json.loads(message.decode('utf-8'))
-        self.logger.debug(f'before converter json: {json.dumps(message_json, indent=4)}')
+        return json.dumps(self._convert_message(message_json)).encode('utf-8')
+
+    def _convert_message(self, message_json, timestamp=None):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'before converter json: {json.dumps(message_json, indent=4)}')
+        preconverted = message_json.get('preconverted')
         tb_msg = {}
-        if message_json.get('preconverted'):
-          tb_msg["values"] = message_json.get('preconverted')
-          time_rcv = message_json.get('preconverted').get("received_at")
-          if time_rcv:
-            tb_msg["ts"] = int(datetime.strptime(time_rcv[0:26] + time_rcv[-1],"%Y-%m-%dT%H:%M:%S.%f%z").timestamp() * 1000)
-        self.logger.debug(f'after converter json: {json.dumps(tb_msg, indent=4)}')
-        return json.dumps(tb_msg).encode('utf-8')
+        # a message without the fields of TTN_V3 is sent as it is
+        tb_msg["values"] = preconverted if preconverted else message_json
+        tb_msg["ts"] = uplink_millis(message_json, timestamp)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'after converter json: {json.dumps(tb_msg, indent=4)}')
+        return tb_msg
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import logging
+import struct
+
+
+class TLVDecoder:
+    """
+    table driven decoder for type-length-value payloads of channel/type
+    based sensors (ELSYS, Milesight, ...). a device profile maps the type
+    byte of a record to the layout of its value:
+
+        PROFILE = {
+            # type: (struct format, field name(s)[, divisor[, offset]])
+            0x01: ('h', 'temperature', 10),
+            0x03: ('BBB', ('acceleration_x', 'acceleration_y', 'acceleration_z'), None, -62),
+            # type: (value size, function(value bytes) -> fields)
+            0x13: (65, parse_grideye),
+        }
+
+    every value of a record is divided by divisor and offset is added, if
+    given. the profile is compiled once into a dispatch table indexed by
+    the type byte, so decoding a payload needs no attribute lookups.
+
+    header is the size of the record header, the type is read from its
+    first byte and masked with type_mask, further header bytes (e.g. the
+    channel type of Milesight sensors) are skipped.
+    """
+
+    def __init__(self, name, profile, byteorder='>', header=1, type_mask=0xFF):
+        self.name = name
+        self.header = header
+        self.type_mask = type_mask
+        self.logger = logging.getLogger(__name__)
+        # type byte -> (size, unpack_from, names, divisor, offset, function)
+        self._table = [None] * 256
+        for type_byte, entry in profile.items():
+            self._table[type_byte] = self._compile(type_byte, entry, byteorder)
+
+    @staticmethod
+    def _compile(type_byte, entry, byteorder):
+        if isinstance(entry[0], int):
+            size, function = entry
+            return size, None, None, None, None, function
+        layout, names, divisor, offset = (tuple(entry) + (None, None))[:4]
+        layout = struct.Struct(byteorder + layout)
+        if isinstance(names, str):
+            names = (names,)
+        if len(names) != len(layout.unpack(bytes(layout.size))):
+            raise ValueError(f'type {type_byte:#04x}: {len(names)} field names for layout {layout.format}')
+        return layout.size, layout.unpack_from, names, divisor or None, offset or None, None
+
+    def decode(self, payload: bytes, fields=None, devicename=None) -> dict:
+        """decode all records of the payload into fields"""
+        if fields is None:
+            fields = {}
+        table = self._table
+        header = self.header
+        type_mask = self.type_mask
+        end = len(payload)
+        pos = 0
+        while end - pos >= header:
+            type_byte = payload[pos] & type_mask
+            pos += header
+            entry = table[type_byte]
+            if entry is None:
+                self.logger.error(f'{self.name}: unknown sensortype {type_byte:#04x} from device {devicename}')
+                continue
+            size, unpack_from, names, divisor, offset, function = entry
+            if end - pos < size:
+                self.logger.warning(
+                    f'{self.name}: payload from device {devicename} too short for sensortype {type_byte:#04x}. '
+                    f'expected {size} bytes, received {end - pos} bytes. -->skipping.')
+                break
+            if function is not None:
+                fields.update(function(payload[pos:pos + size]))
+            elif divisor is None and offset is None:
+                fields.update(zip(names, unpack_from(payload, pos)))
+            else:
+                for name, value in zip(names, unpack_from(payload, pos)):
+                    if divisor is not None:
+                        value = value / divisor
+                    if offset is not None:
+                        value = value + offset
+                    fields[name] = value
+            pos += size
+        return fields
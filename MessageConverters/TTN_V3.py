@@ -3,12 +3,12 @@
 import time
 import base64
 import json
+import logging
 from MessageConverters.MessageConverter import MessageConverter
 
 
-'''
-example payload ttn v3:
-
+# example payload ttn v3, also used by the benchmarks
+EXAMPLE_PAYLOAD = '''
 {
   "end_device_ids": {
     "device_id": "eui-24e124128b100001",
@@ -108,7 +108,11 @@ class TTN_V3(MessageConverter):
 
     def _convert(self, message):
         message_json = json.loads(message.decode('utf-8'))
-        self.logger.info(f' converter json: {json.dumps(message_json, indent=4)}')
+        return json.dumps(self._convert_message(message_json)).encode('utf-8')
+
+    def _convert_message(self, message_json):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f' converter json: {json.dumps(message_json, indent=4)}')
         ttnv3_fields = {}
         ttnv3_fields['received_at'] = message_json.get('received_at')
 
@@ -138,4 +142,4 @@ class TTN_V3(MessageConverter):
           ttnv3_fields['location_long'] = location.get('longitude')
           ttnv3_fields['location_alt'] = location.get('altitude')
         message_json['preconverted'] = ttnv3_fields
-        return json.dumps(message_json).encode('utf-8')
+        return message_json
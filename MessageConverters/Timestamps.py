@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import time
+from datetime import datetime
+
+# time sources of the routes. the relay passes the settings of the route
+# to converters using them (TB_V1):
+#   {"source": "gateway", "field": "ts", "received": 1629132078.19}
+# network: received_at of the network server (default)
+# gateway: time of the gateway, if it has one (gps time)
+# device:  time decoded from the payload, in the field of the route
+# relay:   time the relay received the message
+SOURCES = ('network', 'gateway', 'device', 'relay')
+
+# utc offset in seconds by timezone suffix, e.g. '+02:00'
+_offsets = {'Z': 0, 'z': 0}
+_MONTH_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _days_from_civil(year, month, day):
+    """days since 1970-01-01 of a date of the proleptic gregorian calendar"""
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def _offset(suffix: str) -> int:
+    try:
+        return _offsets[suffix]
+    except KeyError:
+        pass
+    if len(suffix) != 6 or suffix[0] not in '+-' or suffix[3] != ':':
+        raise ValueError(f'invalid utc offset {suffix}')
+    offset = int(suffix[1:3]) * 3600 + int(suffix[4:6]) * 60
+    offset = -offset if suffix[0] == '-' else offset
+    _offsets[suffix] = offset
+    return offset
+
+
+def parse_rfc3339(value: str) -> float:
+    """
+    seconds since the epoch of an rfc3339 time, e.g. received_at of ttn:
+        2021-08-16T16:41:18.188927828Z
+    the fixed layout is parsed directly, other iso 8601 times with
+    datetime.fromisoformat. fractions are cut to microseconds.
+    """
+    try:
+        if value[4] != '-' or value[7] != '-' or value[10] not in 'Tt ' or value[13] != ':' or value[16] != ':':
+            raise ValueError(value)
+        end = 19
+        micros = 0
+        if value[19] == '.':
+            end = 20
+            while value[end].isdigit():
+                end += 1
+            micros = int(value[20:min(end, 26)].ljust(6, '0'))
+        year = int(value[0:4])
+        month = int(value[5:7])
+        day = int(value[8:10])
+        hour = int(value[11:13])
+        minute = int(value[14:16])
+        second = int(value[17:19])
+        # out of range values are reported by fromisoformat
+        if not (1 <= month <= 12 and 1 <= day <= _MONTH_DAYS[month - 1]
+                or month == 2 and day == 29 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)):
+            raise ValueError(value)
+        if hour > 23 or minute > 59 or second > 59:
+            raise ValueError(value)
+        seconds = (
+            _days_from_civil(year, month, day) * 86400 + hour * 3600 + minute * 60 + second
+            - _offset(value[end:]))
+        return seconds + micros / 1e6
+    except (IndexError, ValueError):
+        pass
+    return _parse_iso(value)
+
+
+def _parse_iso(value: str) -> float:
+    # fromisoformat of python < 3.11 takes neither 'Z' nor more than 6 digits
+    if value[-1:] in 'Zz':
+        value = value[:-1] + '+00:00'
+    dot = value.find('.')
+    if dot != -1:
+        end = dot + 1
+        while end < len(value) and value[end].isdigit():
+            end += 1
+        value = value[:min(end, dot + 7)] + value[end:]
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        raise ValueError(f'time without utc offset: {value}')
+    return parsed.timestamp()
+
+
+def to_millis(value) -> int:
+    """
+    milliseconds since the epoch of an rfc3339 time or a number of
+    seconds or milliseconds since the epoch
+    """
+    if isinstance(value, str):
+        return int(parse_rfc3339(value) * 1000)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f'not a time: {value!r}')
+    # times after 1973 in milliseconds, before 5138 in seconds
+    return int(value) if value > 1e11 else int(value * 1000)
+
+
+def _gateway_time(message_json: dict):
+    """time of the first gateway of a ttn v3 uplink, None if it has none"""
+    rx_metadata = (message_json.get('uplink_message') or {}).get('rx_metadata')
+    return rx_metadata[0].get('time') if rx_metadata else None
+
+
+def uplink_millis(message_json: dict, timestamp=None) -> int:
+    """
+    time of an uplink in milliseconds since the epoch, from the source
+    chosen by the route (timestamp, see SOURCES) in a message of TTN_V3.
+    if the source has no valid time, the network time is used, then the
+    time the relay received the message, then the current time.
+    """
+    timestamp = timestamp or {}
+    source = timestamp.get('source', 'network')
+    if source != 'relay':
+        preconverted = message_json.get('preconverted') or {}
+        values = []
+        if source == 'gateway':
+            values.append(_gateway_time(message_json))
+        elif source == 'device':
+            values.append(preconverted.get(timestamp.get('field', 'ts')))
+        values.append(preconverted.get('received_at'))
+        for value in values:
+            if value is None:
+                continue
+            try:
+                return to_millis(value)
+            except (TypeError, ValueError):
+                pass
+    received = timestamp.get('received')
+    return int((received if received is not None else time.time()) * 1000)
@@ -2,7 +2,13 @@
 
 from datetime import timezone
 from datetime import datetime
-from MessageConverters.MessageConverter import MessageConverter
+import logging
+import struct
+from MessageConverters.MessageConverter import MessageConverter, DecodeContext
+from MessageConverters.PayloadReader import PayloadReader
+
+# current, min, max and average value of an analog input
+ANALOG_INPUT = struct.Struct('<HHHH')
 
 
 class UC11XX(MessageConverter):
@@ -17,87 +23,66 @@ class UC11XX(MessageConverter):
 
     def __init__(self, devicename):
         super().__init__(devicename)
-        self.payload = None
-        self.downlink_message = None
-        self.current_ts = None
 
-    def parse_digital_input(self, channel):
+    def parse_digital_input(self, ctx, channel):
         """parse digital_input payload"""
         entry = {}
-        if len(self.payload) == 0:
+        if len(ctx.payload) == 0:
             self.logger.warning("parse message has no content - skipping.")
             return entry
         fields = {}
         # input
-        value = self.payload.pop(0)
+        value = ctx.payload.u8()
         fields['digital_in_'+str(channel)] = int(value)
         entry['fields'] = fields
         return entry
 
-    def parse_digital_output(self, channel):
+    def parse_digital_output(self, ctx, channel):
         """parse digital_output payload"""
         entry = {}
-        if len(self.payload) == 0:
+        if len(ctx.payload) == 0:
             self.logger.warning("parse message has no content - skipping.")
             return entry
         fields = {}
         # input
-        value = self.payload.pop(0)
+        value = ctx.payload.u8()
         fields['digital_out_'+str(channel)] = int(value)
         entry['fields'] = fields
         return entry
 
-    def parse_analog_input(self, channel):
+    def parse_analog_input(self, ctx, channel):
         """parse analog_input payload"""
         entry = {}
-        if len(self.payload) == 0:
+        if len(ctx.payload) == 0:
             self.logger.warning("parse message has no content - skipping.")
             return entry
         fields = {}
         # input
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8)
-        fields['analog_in_act_'+str(channel)] = int(value)/100
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8)
-        fields['analog_in_min_'+str(channel)] = int(value)/100
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8)
-        fields['analog_in_max_'+str(channel)] = int(value)/100
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8)
-        fields['analog_in_avg_'+str(channel)] = int(value)/100
+        act, min_value, max_value, avg = ctx.payload.read(ANALOG_INPUT)
+        fields['analog_in_act_'+str(channel)] = act/100
+        fields['analog_in_min_'+str(channel)] = min_value/100
+        fields['analog_in_max_'+str(channel)] = max_value/100
+        fields['analog_in_avg_'+str(channel)] = avg/100
         entry['fields'] = fields
         return entry
 
-    def parse_analog_output(self, channel):
+    def parse_analog_output(self, ctx, channel):
         """parse analog_output payload"""
         entry = {}
-        if len(self.payload) == 0:
+        if len(ctx.payload) == 0:
             self.logger.warning("parse message has no content - skipping.")
             return entry
         fields = {}
         # input
-        value = (
-            self.payload.pop(0) |
-            self.payload.pop(0) << 8)
+        value = ctx.payload.u16le()
         fields['analog_out_'+str(channel)] = int(value)/100
         entry['fields'] = fields
         return entry
 
-    def _hasDownlinkMessage(self):
-        """True if downlink payload is available"""
-        return self.downlink_message is not None
-
-    def _getDownlinkMessage(self):
-        """Get prepared message for downlink"""
-        return self.downlink_message
-
     def _convert(self, payload, port):
+        return self.decode_frame(payload, port)[0]
+
+    def decode_frame(self, payload, port):
         '''
         decode payload from device to gwu format
         ldc publish format:
@@ -117,32 +102,35 @@ class UC11XX(MessageConverter):
         ]
         '''
         publ_array = []
-        self.current_ts = int(datetime.utcnow().replace(
-            tzinfo=timezone.utc).timestamp())
-        self.payload = payload
+        ctx = DecodeContext(
+            PayloadReader(payload),
+            int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()))
+        debug = self.logger.isEnabledFor(logging.DEBUG)
         try:
-            while len(self.payload) > 0:
+            while len(ctx.payload) > 0:
                 # header
-                message_channel = int(self.payload.pop(0))
-                message_type_byte = self.payload.pop(0)
-                self.logger.debug(
-                    "message channel: {}"
-                    "message type: {}".format(
-                        message_channel,
-                        hex(message_type_byte)
+                message_channel = int(ctx.payload.u8())
+                message_type_byte = ctx.payload.u8()
+                if debug:
+                    self.logger.debug(
+                        "message channel: {}"
+                        "message type: {}".format(
+                            message_channel,
+                            hex(message_type_byte)
+                        )
                     )
-                )
                 message_type = self.msg_types.get(message_type_byte, None)
                 if message_type:
                     method_name = "parse_" + message_type
-                    method = getattr(self, method_name, lambda: None)
+                    method = getattr(self, method_name, None)
                     if method:
-                        entry = method(message_channel)
+                        entry = method(ctx, message_channel)
                         if entry:
-                            self.logger.debug(
-                                "method_name: {}, result:{}".format(
-                                    method_name,
-                                    entry))
+                            if debug:
+                                self.logger.debug(
+                                    "method_name: {}, result:{}".format(
+                                        method_name,
+                                        entry))
                             publ_array.extend([entry])
                     else:
                         self.logger.exception(
@@ -155,4 +143,4 @@ class UC11XX(MessageConverter):
         except Exception:
             self.logger.exception("Error while trying to decode payload..")
 
-        return publ_array
+        return publ_array, ctx.downlink_message
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+
+
+class AsyncioEngine:
+    """
+    drives the network io of all paho clients from one asyncio event loop
+    instead of one loop_start() thread per client.
+    paho calls the socket hooks (on_socket_open, ...) and the engine watches
+    the sockets with add_reader / add_writer. keepalive and reconnect are
+    handled by one task per client.
+
+    message callbacks (on_message, ...) run on the event loop, so converters
+    doing blocking io should be combined with a worker pool.
+    """
+
+    def __init__(self, reconnect_min_delay=1, reconnect_max_delay=120):
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.logger = logging.getLogger(__name__)
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+        self._tasks = {}
+        self._running = False
+
+    def _call(self, func, *args):
+        # paho calls the socket hooks from whatever thread uses the client
+        # (publish from worker threads, reconnect in the executor, ..)
+        if self._thread is threading.current_thread():
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def add_client(self, client: mqtt.Client, name: str):
+        """
+        let the engine handle the network io of client. a client set up with
+        connect_async() is connected by the reconnect task of the engine.
+        """
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        sock = client.socket()
+        if sock:
+            self._call(self._add_reader, client, sock.fileno())
+            if client.want_write():
+                self._call(self._add_writer, client, sock.fileno())
+        self._call(self._start_misc_task, client, name)
+
+    def remove_client(self, client: mqtt.Client):
+        """stop handling the network io of client"""
+        self._call(self._remove_client, client)
+
+    def start(self):
+        """run the event loop in its own thread"""
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._loop.run_forever,
+            name='asyncio-engine',
+            daemon=True)
+        self._thread.start()
+        self.logger.info('asyncio engine started')
+
+    def stop(self, timeout=10):
+        """stop the event loop. the clients stay connected but their io is no longer handled"""
+        self._running = False
+        if self._thread:
+            self._loop.call_soon_threadsafe(self._cancel_tasks)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
+        self.logger.info('asyncio engine stopped')
+
+    def _cancel_tasks(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks = {}
+
+    def _start_misc_task(self, client, name):
+        self._tasks[client] = self._loop.create_task(self._misc_loop(client, name))
+
+    def _remove_client(self, client):
+        task = self._tasks.pop(client, None)
+        if task:
+            task.cancel()
+        sock = client.socket()
+        if sock:
+            self._loop.remove_reader(sock.fileno())
+            self._loop.remove_writer(sock.fileno())
+
+    def _add_reader(self, client, fd):
+        self._loop.add_reader(fd, client.loop_read)
+
+    def _add_writer(self, client, fd):
+        self._loop.add_writer(fd, client.loop_write)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._add_reader, client, sock.fileno())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self._loop.remove_reader, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self._add_writer, client, sock.fileno())
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self._loop.remove_writer, sock.fileno())
+
+    async def _misc_loop(self, client, name):
+        delay = self.reconnect_min_delay
+        while self._running:
+            if client.socket() is None:
+                if client._state == mqtt.mqtt_cs_disconnecting:
+                    # closed with disconnect(), e.g. on shutdown
+                    return
+                # connection lost, reconnect without blocking the loop
+                try:
+                    self.logger.info(f'reconnecting client for broker {name}..')
+                    await self._loop.run_in_executor(None, client.reconnect)
+                    delay = self.reconnect_min_delay
+                except (OSError, ValueError) as err:
+                    self.logger.warning(
+                        f'reconnect for broker {name} failed: {err}. retrying in {delay}s')
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.reconnect_max_delay)
+                    continue
+            else:
+                client.loop_misc()
+            await asyncio.sleep(1)
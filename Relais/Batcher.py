@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import logging
+import threading
+import time
+
+
+class Batcher:
+    """
+    collects items per key (e.g. the publish topic) and hands them over
+    to flush(key, items) as one batch, when max_items are collected or
+    max_delay seconds after the first item of the batch was added.
+    full batches are flushed in the thread adding the last item, expired
+    batches by the timer thread of the batcher.
+    """
+
+    def __init__(self, name, flush, max_items=100, max_delay=0.1):
+        if max_items < 1:
+            raise ValueError(f'batch needs at least one item, got {max_items}')
+        self.name = name
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.logger = logging.getLogger(__name__)
+        self._flush = flush
+        # key -> (deadline, items)
+        self._batches = {}
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def __len__(self):
+        """number of collected items"""
+        with self._condition:
+            return sum(len(items) for _, items in self._batches.values())
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._timer, name=f'{self.name}-batcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """flush all collected items and stop the timer thread"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def add(self, key, item):
+        with self._condition:
+            if not self._running:
+                # stopped, e.g. replaced on a configuration reload. nothing
+                # flushes collected items anymore, hand the item over at once.
+                items = [item]
+            else:
+                batch = self._batches.get(key)
+                if batch is None:
+                    batch = (time.monotonic() + self.max_delay, [])
+                    self._batches[key] = batch
+                    # wake up the timer for the new deadline
+                    self._condition.notify()
+                batch[1].append(item)
+                if len(batch[1]) < self.max_items:
+                    return
+                del self._batches[key]
+                items = batch[1]
+        self._emit(key, items)
+
+    def flush(self):
+        """flush all collected items"""
+        with self._condition:
+            batches = self._batches
+            self._batches = {}
+        for key, (_, items) in batches.items():
+            self._emit(key, items)
+
+    def _emit(self, key, items):
+        try:
+            self._flush(key, items)
+        except Exception:
+            self.logger.exception(f'failed to flush batch of {len(items)} items in batcher {self.name}')
+
+    def _timer(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                expired = [key for key, (deadline, _) in self._batches.items() if deadline <= now]
+                expired = [(key, self._batches.pop(key)[1]) for key in expired]
+                if not expired:
+                    timeout = min(
+                        (deadline for deadline, _ in self._batches.values()), default=now + 1) - now
+                    self._condition.wait(timeout)
+                    continue
+            for key, items in expired:
+                self._emit(key, items)
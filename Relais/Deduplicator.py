@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+import threading
+import time
+from collections import OrderedDict
+
+
+class Deduplicator:
+    """
+    remembers the keys of the messages seen during the last ttl seconds,
+    e.g. dev_eui and f_cnt of an uplink delivered by several gateways or
+    integrations. at most maxsize keys are kept, the oldest are forgotten
+    first. safe to use from several threads.
+    """
+
+    def __init__(self, ttl=60.0, maxsize=100000):
+        if maxsize < 1:
+            raise ValueError(f'deduplicator needs room for at least one key, got {maxsize}')
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # number of keys seen before
+        self.duplicates = 0
+        # key -> expiry, oldest first
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def seen(self, key) -> bool:
+        """True if key was seen during the last ttl seconds, otherwise it is remembered"""
+        now = time.monotonic()
+        with self._lock:
+            # all keys have the same ttl, the expired ones are at the front
+            while self._keys:
+                oldest, expiry = next(iter(self._keys.items()))
+                if expiry > now:
+                    break
+                del self._keys[oldest]
+            if key in self._keys:
+                self.duplicates += 1
+                return True
+            self._keys[key] = now + self.ttl
+            if len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+            return False
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import logging
+import re
+import yaml
+
+# converters for the model ids of the lorawan device repository, used if
+# auto-models is enabled: (brand_id, model_id prefix, converter)
+AUTO_MODELS = (
+    ('elsys', '', 'ELSYS'),
+    ('milesight-iot', 'am3', 'MS_AM3XX'),
+)
+_DEV_EUI = re.compile(r'[0-9a-fA-F]{16}$')
+
+
+class DeviceRegistry:
+    """
+    maps the devices of a mixed application to their payload converter.
+    a device is looked up in the message of TTN_V3 by the dev_eui and
+    device_id of 'preconverted', then by uplink_message.version_ids.model_id.
+    example file:
+
+        devices:
+          24e124128b123456: MS_AM3XX     # dev_eui
+          eui-a81758fffe0312ab: ELSYS    # device_id
+        models:
+          ers-co2: ELSYS                 # version_ids.model_id
+
+    with auto_models, devices of known models (AUTO_MODELS) get their
+    converter without being listed.
+    """
+
+    def __init__(self, devices=None, models=None, auto_models=False):
+        self.logger = logging.getLogger(__name__)
+        # device ids are matched as they are, dev_euis case insensitive
+        self._devices = {}
+        self._dev_euis = {}
+        for device, converter in (devices or {}).items():
+            device = str(device)
+            self._devices[device] = converter
+            if _DEV_EUI.match(device):
+                self._dev_euis[device.lower()] = converter
+        self._models = dict(models or {})
+        self.auto_models = auto_models
+        # (brand_id, model_id) -> converter, filled on first use
+        self._auto = {}
+
+    @classmethod
+    def load(cls, path, auto_models=False):
+        with open(path) as registry_file:
+            registry = yaml.safe_load(registry_file) or {}
+        return cls(registry.get('devices'), registry.get('models'), auto_models)
+
+    def __len__(self):
+        return len(self._devices) + len(self._models)
+
+    def converters(self) -> set:
+        """names of all converters the registry may return"""
+        names = set(self._devices.values()) | set(self._models.values())
+        if self.auto_models:
+            names.update(converter for _, _, converter in AUTO_MODELS)
+        return names
+
+    def lookup(self, message: dict):
+        """converter name of the device, None if the device is unknown"""
+        preconverted = message.get('preconverted') or {}
+        dev_eui = preconverted.get('dev_eui')
+        if dev_eui:
+            converter = self._dev_euis.get(dev_eui.lower())
+            if converter:
+                return converter
+        converter = self._devices.get(preconverted.get('device_id'))
+        if converter:
+            return converter
+        # the model is not published, it is read from the uplink
+        version_ids = (message.get('uplink_message') or {}).get('version_ids') or {}
+        model_id = version_ids.get('model_id')
+        if not model_id:
+            return None
+        converter = self._models.get(model_id)
+        if converter or not self.auto_models:
+            return converter
+        key = (version_ids.get('brand_id'), model_id)
+        try:
+            return self._auto[key]
+        except KeyError:
+            pass
+        converter = None
+        for brand_id, model_prefix, auto_converter in AUTO_MODELS:
+            if key[0] == brand_id and model_id.startswith(model_prefix):
+                converter = auto_converter
+                break
+        self._auto[key] = converter
+        return converter
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class DownlinkQueue:
+    """
+    hands the downlinks of the devices over to send(key, downlink), key
+    is the device, e.g. its downlink topic. a device gets at most one
+    downlink per min_interval seconds. downlinks added while the device
+    has to wait are coalesced, only the latest is sent when the interval
+    has passed. pending downlinks are sent by the timer thread of the queue.
+    """
+
+    def __init__(self, name, send, min_interval=10.0):
+        if min_interval < 0:
+            raise ValueError(f'min interval must not be negative, got {min_interval}')
+        self.name = name
+        self.min_interval = min_interval
+        self.logger = logging.getLogger(__name__)
+        # number of downlinks replaced by a later one
+        self.coalesced = 0
+        self._send = send
+        # key -> downlink waiting for the interval of the device to pass
+        self._pending = {}
+        # key -> time of the latest downlink, oldest first
+        self._sent = OrderedDict()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def __len__(self):
+        """number of pending downlinks"""
+        with self._condition:
+            return len(self._pending)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._timer, name=f'{self.name}-downlinks', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """send all pending downlinks and stop the timer thread"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        with self._condition:
+            pending = self._pending
+            self._pending = {}
+        for key, downlink in pending.items():
+            self._emit(key, downlink)
+
+    def add(self, key, downlink):
+        with self._condition:
+            if self._running:
+                if key in self._pending:
+                    self._pending[key] = downlink
+                    self.coalesced += 1
+                    return
+                now = time.monotonic()
+                self._expire(now)
+                if key in self._sent:
+                    self._pending[key] = downlink
+                    # wake up the timer for the new deadline
+                    self._condition.notify()
+                    return
+                self._sent[key] = now
+        self._emit(key, downlink)
+
+    def _expire(self, now):
+        """forget the devices whose interval has passed"""
+        while self._sent:
+            key, sent = next(iter(self._sent.items()))
+            if sent + self.min_interval > now or key in self._pending:
+                return
+            del self._sent[key]
+
+    def _emit(self, key, downlink):
+        try:
+            self._send(key, downlink)
+        except Exception:
+            self.logger.exception(f'failed to send downlink to {key} in downlink queue {self.name}')
+
+    def _timer(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                due = [key for key in self._pending if self._sent[key] + self.min_interval <= now]
+                for key in due:
+                    del self._sent[key]
+                    self._sent[key] = now
+                due = [(key, self._pending.pop(key)) for key in due]
+                if not due:
+                    timeout = min(
+                        (self._sent[key] + self.min_interval for key in self._pending), default=now + 1) - now
+                    self._condition.wait(timeout)
+                    continue
+            for key, downlink in due:
+                self._emit(key, downlink)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import logging
+import random
+
+from Relais.TopicMatcher import TopicMatcher
+
+# level for per message log lines, below DEBUG
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+
+class MessageLog:
+    """
+    decides which messages get per message log lines (TRACE level).
+    rendering topics and payloads for every message costs more than
+    converting them, so the lines are only built if TRACE is enabled
+    and the message is sampled.
+
+    sample rates are between 0 (never) and 1 (every message). the rate of
+    the first matching topic filter is used, sample_rate otherwise.
+    the default MessageLog traces nothing.
+    """
+
+    def __init__(self, logger: logging.Logger, sample_rate=0.0, topic_sample_rates=None):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.enabled = bool(sample_rate or topic_sample_rates)
+        self._topic_sample_rates = None
+        if topic_sample_rates:
+            self._topic_sample_rates = TopicMatcher()
+            for topic_filter, rate in topic_sample_rates.items():
+                self._topic_sample_rates.add(topic_filter, rate)
+
+    def sampled(self, topic: str = None) -> bool:
+        """
+        True if the message received on topic should be traced.
+        without topic (e.g. for packet logs) only sample_rate is used.
+        """
+        if not self.enabled or not self.logger.isEnabledFor(TRACE):
+            return False
+        rate = self.sample_rate
+        if topic is not None and self._topic_sample_rates:
+            rates = self._topic_sample_rates.match(topic)
+            if rates:
+                rate = rates[0]
+        return rate >= 1 or random.random() < rate
+
+    def trace(self, msg, *args):
+        self.logger.log(TRACE, msg, *args, stacklevel=2)
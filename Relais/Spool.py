@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import collections
+import logging
+import sqlite3
+import threading
+import time
+
+# seconds an acknowledgement waits for its mid to be tracked. the client
+# reuses mids after 65535 publishes, an older early ack must not match.
+EARLY_ACK_TTL = 0.5
+
+
+class Spool:
+    """
+    durable store-and-forward buffer for publishes, stored in sqlite (WAL mode).
+    a message is added before it is published and removed when the client
+    reports it as published (on_publish). messages still in the spool when
+    a broker (re)connects are published again.
+
+    writes are batched: added and acknowledged messages are collected in
+    memory and committed (and fsynced) together every flush_interval seconds
+    or when batch_size messages are pending. a message acknowledged before
+    its batch was committed never touches the disk.
+    """
+
+    def __init__(self, path, flush_interval=0.2, batch_size=500):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.logger = logging.getLogger(__name__)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # fsync on every commit, i.e. once per batch
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS spool ('
+            'id INTEGER PRIMARY KEY, broker TEXT, topic TEXT, payload BLOB, qos INTEGER, retain INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS spool_broker ON spool (broker, id)')
+        self._next_id = (self._db.execute('SELECT max(id) FROM spool').fetchone()[0] or 0) + 1
+        self._stored = self._db.execute('SELECT count(*) FROM spool').fetchone()[0]
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._inserts = {}
+        self._deletes = []
+        # broker -> {mid: (spool id, qos)} of published, not yet acknowledged messages
+        self._inflight = collections.defaultdict(dict)
+        # broker -> {mid: time} of acknowledgements that arrived before the mid
+        # was tracked (on_publish may run before publish returns), oldest first
+        self._early_acks = collections.defaultdict(collections.OrderedDict)
+        self._flush_needed = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._flush_loop, name='spool-flush', daemon=True)
+        self._thread.start()
+        if self._stored:
+            self.logger.info(f'spool {path} contains {self._stored} unpublished messages')
+
+    def __len__(self):
+        """number of messages not yet acknowledged"""
+        return self._stored + len(self._inserts) - len(self._deletes)
+
+    def add(self, broker: str, topic: str, payload: bytes, qos=0, retain=False) -> int:
+        """add a message to be published. returns its spool id"""
+        with self._lock:
+            spool_id = self._next_id
+            self._next_id += 1
+            self._inserts[spool_id] = (spool_id, broker, topic, payload, qos, int(retain))
+            if len(self._inserts) >= self.batch_size:
+                self._flush_needed.set()
+        return spool_id
+
+    def track(self, broker: str, mid: int, spool_id: int, qos=0):
+        """remember that the message with spool_id was published with mid"""
+        with self._lock:
+            early_acks = self._early_acks.get(broker)
+            acked = early_acks.pop(mid, None) if early_acks else None
+            if acked is not None and time.monotonic() - acked < EARLY_ACK_TTL:
+                self._remove(spool_id)
+            else:
+                self._inflight[broker][mid] = (spool_id, qos)
+
+    def ack(self, broker: str, mid: int):
+        """the message with mid was published. remove it from the spool"""
+        with self._lock:
+            entry = self._inflight[broker].pop(mid, None)
+            if entry:
+                self._remove(entry[0])
+                return
+            # an expired early ack leaves the message in the spool, it is
+            # published again after a reconnect instead of being lost
+            now = time.monotonic()
+            early_acks = self._early_acks[broker]
+            early_acks.pop(mid, None)
+            early_acks[mid] = now
+            while early_acks:
+                oldest, acked = next(iter(early_acks.items()))
+                if now - acked < EARLY_ACK_TTL:
+                    break
+                del early_acks[oldest]
+
+    def _remove(self, spool_id):
+        if self._inserts.pop(spool_id, None) is None:
+            self._deletes.append((spool_id,))
+            if len(self._deletes) >= self.batch_size:
+                self._flush_needed.set()
+
+    def pending(self, broker: str, batch_size=1000):
+        """
+        yield (spool id, topic, payload, qos, retain) of all messages of broker that
+        have to be published (again). qos>0 messages handed to the client are skipped,
+        the client sends them again itself after a reconnect. messages added
+        after the replay started are published by their sender and not replayed.
+        """
+        with self._lock:
+            last_spooled = self._next_id - 1
+            # qos 0 messages are dropped by the client on disconnect
+            inflight = self._inflight[broker]
+            for mid in [mid for mid, (_, qos) in inflight.items() if qos == 0]:
+                del inflight[mid]
+            skip = {spool_id for spool_id, _ in inflight.values()}
+        self.flush()
+        last_id = 0
+        while True:
+            with self._db_lock:
+                rows = self._db.execute(
+                    'SELECT id, topic, payload, qos, retain FROM spool '
+                    'WHERE broker = ? AND id > ? AND id <= ? ORDER BY id LIMIT ?',
+                    (broker, last_id, last_spooled, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                if row[0] not in skip:
+                    yield row[0], row[1], row[2], row[3], bool(row[4])
+            last_id = rows[-1][0]
+
+    def flush(self):
+        """commit pending changes"""
+        # hold the db lock while taking the changes, so batches are committed in order
+        with self._db_lock:
+            with self._lock:
+                inserts = list(self._inserts.values())
+                self._inserts = {}
+                deletes = self._deletes
+                self._deletes = []
+            if not inserts and not deletes:
+                return
+            self._db.execute('BEGIN')
+            try:
+                if inserts:
+                    self._db.executemany(
+                        'INSERT INTO spool (id, broker, topic, payload, qos, retain) VALUES (?, ?, ?, ?, ?, ?)',
+                        inserts)
+                if deletes:
+                    self._db.executemany('DELETE FROM spool WHERE id = ?', deletes)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                # keep the batch for the next flush, ahead of the newer changes
+                with self._lock:
+                    self._inserts = {**{row[0]: row for row in inserts}, **self._inserts}
+                    self._deletes = deletes + self._deletes
+                raise
+            with self._lock:
+                self._stored += len(inserts) - len(deletes)
+
+    def _flush_loop(self):
+        while self._running:
+            self._flush_needed.wait(self.flush_interval)
+            self._flush_needed.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception(f'failed to write spool {self.path}')
+
+    def close(self):
+        self._running = False
+        self._flush_needed.set()
+        self._thread.join()
+        self.flush()
+        self._db.close()
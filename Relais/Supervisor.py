@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+
+class Supervisor:
+    """
+    runs a number of worker processes and restarts them if they die.
+    target is called as target(index, count, health_queue) in each worker.
+    workers report their health by putting dicts with at least the key
+    'worker' (the index) on health_queue. a worker without a report for
+    heartbeat_timeout seconds is considered hung and restarted.
+    """
+
+    def __init__(self, target, count, heartbeat_timeout=60, restart_delay=5, report_interval=60):
+        self.target = target
+        self.count = count
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_delay = restart_delay
+        self.report_interval = report_interval
+        self.logger = logging.getLogger(__name__)
+        self._context = multiprocessing.get_context('fork')
+        self._health_queue = self._context.Queue()
+        self._processes = [None] * count
+        self._started_at = [0] * count
+        self._health = [None] * count
+        self._restarts = 0
+        self._running = False
+
+    def _start_worker(self, index):
+        process = self._context.Process(
+            target=self.target,
+            args=(index, self.count, self._health_queue),
+            name=f'relais-worker-{index}',
+            daemon=True)
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.time()
+        self._health[index] = None
+        self.logger.info(f'started worker {index} with pid {process.pid}')
+
+    def _check_workers(self):
+        now = time.time()
+        for index, process in enumerate(self._processes):
+            health = self._health[index]
+            last_seen = health['time'] if health else self._started_at[index]
+            if process.is_alive() and now - last_seen > self.heartbeat_timeout:
+                self.logger.error(
+                    f'worker {index} (pid {process.pid}) sent no heartbeat '
+                    f'for {int(now - last_seen)}s. terminating..')
+                process.terminate()
+                process.join(5)
+            if not process.is_alive():
+                if now - self._started_at[index] < self.restart_delay:
+                    continue
+                self.logger.error(
+                    f'worker {index} (pid {process.pid}) died with exit code {process.exitcode}. restarting..')
+                self._restarts += 1
+                self._start_worker(index)
+
+    def _read_health(self):
+        while True:
+            try:
+                health = self._health_queue.get_nowait()
+            except queue.Empty:
+                return
+            self._health[health['worker']] = health
+
+    def health(self) -> dict:
+        """aggregated health of all workers"""
+        alive = sum(1 for process in self._processes if process and process.is_alive())
+        brokers_connected = 0
+        brokers_total = 0
+        queued = 0
+        for health in self._health:
+            if not health:
+                continue
+            brokers = health.get('brokers', {})
+            brokers_total += len(brokers)
+            brokers_connected += sum(1 for connected in brokers.values() if connected)
+            queued += health.get('queued', 0)
+        return {
+            'workers': self.count,
+            'alive': alive,
+            'restarts': self._restarts,
+            'brokers_connected': brokers_connected,
+            'brokers_total': brokers_total,
+            'queued': queued
+        }
+
+    def run(self):
+        """start the workers and supervise them until stop() is called"""
+        self._running = True
+        for index in range(self.count):
+            self._start_worker(index)
+        last_report = time.time()
+        while self._running:
+            time.sleep(1)
+            self._read_health()
+            if not self._running:
+                break
+            self._check_workers()
+            if time.time() - last_report >= self.report_interval:
+                last_report = time.time()
+                health = self.health()
+                self.logger.info(
+                    f"workers alive: {health['alive']}/{health['workers']}, "
+                    f"restarts: {health['restarts']}, "
+                    f"brokers connected: {health['brokers_connected']}/{health['brokers_total']}, "
+                    f"queued messages: {health['queued']}")
+
+    def signal_workers(self, signum):
+        """send signal signum to all running workers, e.g. SIGHUP to reload"""
+        for process in self._processes:
+            if process and process.is_alive():
+                os.kill(process.pid, signum)
+
+    def stop(self, timeout=10):
+        """stop supervising and wait for the workers to exit"""
+        self._running = False
+        for process in self._processes:
+            if process and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process:
+                process.join(timeout)
+                if process.is_alive():
+                    process.kill()
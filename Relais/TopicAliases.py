@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import copy
+import threading
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+
+class TopicAliases:
+    """
+    topic aliases of the publishes of an mqtt v5 client. the first publish
+    on a topic sends the topic with a new alias, later publishes send the
+    alias only. aliases are handed out until the limit of the client and
+    the broker (TopicAliasMaximum of the connack) is reached and are
+    forgotten when the connection is closed.
+
+    only qos 0 messages use aliases: they are written in the order of the
+    publish calls, while qos>0 messages may wait for the inflight window
+    and could arrive after a message using their alias.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        # negotiated with the broker on connect
+        self.limit = 0
+        self._aliases = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._aliases)
+
+    def reset(self, broker_maximum=0):
+        """forget all aliases, called on connect and disconnect"""
+        with self._lock:
+            self._aliases = {}
+            self.limit = min(self.maximum, broker_maximum)
+
+    def publish(self, client: mqtt.Client, topic, payload, qos=0, retain=False, properties=None):
+        if qos or not self.limit:
+            return client.publish(topic, payload=payload, qos=qos, retain=retain, properties=properties)
+        # the lock keeps the message announcing an alias ahead of those using it
+        with self._lock:
+            alias = self._aliases.get(topic)
+            if alias is None:
+                if len(self._aliases) >= self.limit:
+                    return client.publish(topic, payload=payload, qos=qos, retain=retain, properties=properties)
+                alias = len(self._aliases) + 1
+                publish_topic = topic
+            else:
+                publish_topic = ''
+            # the properties may be shared by the messages of a route
+            properties = Properties(PacketTypes.PUBLISH) if properties is None else copy.copy(properties)
+            properties.TopicAlias = alias
+            result = client.publish(publish_topic, payload=payload, qos=qos, retain=retain, properties=properties)
+            if publish_topic and result.rc == mqtt.MQTT_ERR_SUCCESS:
+                self._aliases[topic] = alias
+            return result
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+
+class _TopicNode:
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicMatcher:
+    """
+    topic trie used to find the routes for an incoming message.
+    the filters are added once when the routes are loaded, a lookup then
+    only walks the levels of the topic instead of testing every filter.
+
+    wildcard semantics follow the mqtt spec:
+    '+' matches exactly one topic level (which may be empty),
+    '#' matches the parent level and any number of sub levels,
+    wildcards in the first level do not match topics starting with '$'.
+    shared subscriptions ($share/<group>/<filter>) are indexed by their
+    filter, the topics of the messages do not carry the prefix.
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, topic_filter: str, value):
+        """add value for topic_filter. values are returned in the order they were added."""
+        if topic_filter.startswith('$share/'):
+            topic_filter = topic_filter.split('/', 2)[2]
+        node = self._root
+        for level in topic_filter.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TopicNode()
+            node = child
+        node.values.append((self._count, value))
+        self._count += 1
+
+    def match(self, topic: str) -> list:
+        """return all values whose topic filter matches topic."""
+        matches = []
+        nodes = [self._root]
+        # wildcards on the first level must not match $SYS/... topics
+        wildcards = not topic.startswith('$')
+        for level in topic.split('/'):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if wildcards:
+                    multi_level = children.get('#')
+                    if multi_level is not None:
+                        matches.extend(multi_level.values)
+                    single_level = children.get('+')
+                    if single_level is not None:
+                        next_nodes.append(single_level)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            if not next_nodes:
+                break
+            nodes = next_nodes
+            wildcards = True
+        else:
+            for node in nodes:
+                matches.extend(node.values)
+                # 'a/#' also matches 'a'
+                multi_level = node.children.get('#')
+                if multi_level is not None:
+                    matches.extend(multi_level.values)
+        if len(matches) > 1:
+            matches.sort(key=lambda match: match[0])
+        return [value for _, value in matches]
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import re
+import string
+
+_TOPIC_LEVEL = re.compile(r'topic\[(-?\d+)\]$')
+# kinds of the placeholders
+_FIELD = 0
+_LEVEL = 1
+
+
+class TopicTemplate:
+    """
+    publish topic with placeholders, compiled once when the routes are loaded:
+        telemetry/{dev_eui}/{f_port}
+        {topic[0]}/{topic[3]}/decoded
+    {name} is a field of the converted message, looked up in the message,
+    then in its 'preconverted' (TTN_V3), 'values' (TB_V1) and
+    'uplink_message' (ttn v3, e.g. f_port and f_cnt) fields. fields the
+    converted message lacks are looked up in the same way in the message
+    the converters of the route started from, e.g. f_port after TB_V1.
+    {topic[n]} is level n of the incoming topic, negative n count from the end.
+    a format spec is applied to the value, e.g. {f_port:03d}.
+    rendering fails with ValueError if a value is missing or would not
+    fit into one topic level.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        # (literal, kind, key, format spec) per placeholder
+        self._parts = []
+        self._tail = ''
+        self.fields = []
+        self.uses_topic = False
+        try:
+            parsed = list(string.Formatter().parse(template))
+        except ValueError as err:
+            raise ValueError(f'invalid publish topic template {template}: {err}') from None
+        for literal, field_name, format_spec, conversion in parsed:
+            # escaped braces split the literal text into several parts
+            literal = self._tail + literal
+            self._tail = ''
+            if field_name is None:
+                self._tail = literal
+                continue
+            if conversion or not field_name:
+                raise ValueError(f'unsupported placeholder {{{field_name}}} in publish topic template {template}')
+            match = _TOPIC_LEVEL.match(field_name)
+            if match:
+                self.uses_topic = True
+                self._parts.append((literal, _LEVEL, int(match.group(1)), format_spec))
+            else:
+                self.fields.append(field_name)
+                self._parts.append((literal, _FIELD, field_name, format_spec))
+        self.static = not self._parts
+        if self.static:
+            self.template = self._tail
+
+    def __repr__(self):
+        return f'TopicTemplate({self.template!r})'
+
+    def render(self, topic: str, message=None, source=None) -> str:
+        """topic for a message received on topic, converted from source"""
+        if self.static:
+            return self.template
+        levels = topic.split('/') if self.uses_topic else None
+        result = []
+        for literal, kind, key, format_spec in self._parts:
+            result.append(literal)
+            if kind == _LEVEL:
+                try:
+                    value = levels[key]
+                except IndexError:
+                    raise ValueError(f'topic {topic} has no level {key} for template {self.template}') from None
+            else:
+                value = _field(message, key)
+                if value is None:
+                    value = _field(source, key)
+                if value is None:
+                    raise ValueError(f'message has no field {key} for template {self.template}')
+            value = format(value, format_spec) if format_spec else str(value)
+            if '/' in value or '+' in value or '#' in value:
+                raise ValueError(f'value {value!r} of {key} is not a topic level (template {self.template})')
+            result.append(value)
+        result.append(self._tail)
+        return ''.join(result)
+
+
+def _field(message, name):
+    if not isinstance(message, dict):
+        return None
+    value = message.get(name)
+    if value is not None:
+        return value
+    for source in ('preconverted', 'values', 'uplink_message'):
+        fields = message.get(source)
+        if isinstance(fields, dict):
+            value = fields.get(name)
+            if value is not None:
+                return value
+    return None
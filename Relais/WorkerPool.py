@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import logging
+import queue
+import threading
+import time
+
+
+class WorkerPool:
+    """
+    worker threads with a bounded queue per thread.
+    used to move message conversion off the network thread of a client.
+    tasks are assigned to a thread by hashing a key (e.g. the topic), so
+    tasks with the same key are processed in the order they were submitted.
+
+    backpressure policies if the queue of a thread is full:
+    block:       wait until there is space in the queue
+    drop-oldest: drop the oldest queued task to make room for the new one
+    drop-newest: drop the new task
+    tasks submitted after stop() are dropped.
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+    def __init__(self, name, threads=1, queue_size=1000, backpressure=BLOCK):
+        if backpressure not in self.POLICIES:
+            raise ValueError(
+                f'unknown backpressure policy {backpressure}. expected one of {self.POLICIES}')
+        if threads < 1:
+            raise ValueError(f'worker pool needs at least one thread, got {threads}')
+        self.name = name
+        self.backpressure = backpressure
+        self.dropped = 0
+        self.logger = logging.getLogger(__name__)
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(threads)]
+        self._threads = []
+        self._stopped = False
+
+    def __len__(self):
+        """number of queued tasks"""
+        return sum(task_queue.qsize() for task_queue in self._queues)
+
+    def start(self):
+        for num, task_queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._work,
+                args=(task_queue,),
+                name=f'{self.name}-worker-{num}',
+                daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self.logger.info(
+            f'started worker pool {self.name} with {len(self._queues)} threads '
+            f'(queue size: {self._queues[0].maxsize}, backpressure: {self.backpressure})')
+
+    def stop(self, timeout=None):
+        """process all queued tasks and stop the threads"""
+        self._stopped = True
+        for task_queue in self._queues:
+            task_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def join(self, timeout=None) -> bool:
+        """wait until all queued tasks are processed. returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while any(task_queue.unfinished_tasks for task_queue in self._queues):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def submit(self, key, func, *args) -> bool:
+        """queue func(*args). returns False if the task was dropped."""
+        task_queue = self._queues[hash(key) % len(self._queues)]
+        task = (func, args)
+        if self.backpressure == self.BLOCK:
+            # a blocked submit gives up when the pool is stopped
+            while not self._stopped:
+                try:
+                    task_queue.put(task, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            self._dropped()
+            return False
+        if self._stopped:
+            self._dropped()
+            return False
+        while True:
+            try:
+                task_queue.put_nowait(task)
+                return True
+            except queue.Full:
+                if self.backpressure == self.DROP_NEWEST:
+                    self._dropped()
+                    return False
+            try:
+                task_queue.get_nowait()
+                task_queue.task_done()
+                self._dropped()
+            except queue.Empty:
+                pass
+
+    def _dropped(self):
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            self.logger.warning(
+                f'worker pool {self.name} is full. {self.dropped} messages dropped so far '
+                f'(backpressure: {self.backpressure})')
+
+    def _work(self, task_queue):
+        while True:
+            task = task_queue.get()
+            try:
+                if task is None:
+                    return
+                func, args = task
+                func(*args)
+            except Exception:
+                self.logger.exception(f'task in worker pool {self.name} failed')
+            finally:
+                task_queue.task_done()
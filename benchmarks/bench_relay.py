@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+'''
+throughput and latency benchmark of the relay.
+
+replays synthetic ttn v3 uplinks (based on TTN_V3.EXAMPLE_PAYLOAD) through
+on_message of mqtt-relais.py and through every converter in MessageConverters.
+published messages go to an in-process fake client, or to a real broker
+with --broker (e.g. a local mosquitto).
+
+reported per scenario: msgs/sec, p50 / p99 latency and the peak memory
+allocated while processing one message (tracemalloc).
+
+usage:
+    python benchmarks/bench_relay.py
+    python benchmarks/bench_relay.py --messages 50000 --routes 500
+    python benchmarks/bench_relay.py --json results.json
+    python benchmarks/bench_relay.py --baseline results.json --tolerance 0.2
+    python benchmarks/bench_relay.py --broker localhost:1883 --scenario relay
+'''
+
+import argparse
+import base64
+import copy
+import fnmatch
+import importlib
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+from MessageConverters.TTN_V3 import EXAMPLE_PAYLOAD  # noqa: E402
+from MessageConverters.DeviceState import CachedStateStore, MemoryStateStore, RedisStateStore  # noqa: E402
+from Relais.DeviceRegistry import DeviceRegistry  # noqa: E402
+
+# milesight am107 frame from the example payload
+MS_AM3XX_FRAME = base64.b64decode('A2f2AARofQZlPQBgAV0ABWoBAAd9OQIIfSUACXPCJQ==')
+# elsys ers co2: temp, humidity, light, motion, co2, battery
+ELSYS_FRAME = bytes.fromhex('0100e6021f04004a05000601c1070e12')
+
+# PIOT badge event: type, seq no, device time, followed by the badge uuid
+PIOT_BADGE_EVENT = struct.Struct('<BHI')
+PIOT_BADGE_UUID = bytes.fromhex('04a1b2c3d4e5f6')
+
+# raw frames of the byte level converters: (converter, port, frame).
+# the mcf frames are measured at 2021-08-16 16:41:18
+DEVICE_FRAMES = [
+    ('MCF', 2, bytes.fromhex('0e3285102b3409 5a 8a8b01 2c01 6400 9001'.replace(' ', ''))),
+    ('UC11XX', 85, bytes.fromhex('0100 01' '0202 e803 6400 d007 dc05'.replace(' ', ''))),
+    ('LHT65', 2, bytes.fromhex('cbf60b0d037601 0add 7fff'.replace(' ', ''))),
+    ('KLAX', 3, base64.b64decode(
+        'AGoIEQMAAAAAAAAEak2DATEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABdQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA==')),
+    ('RAK7200', 1, bytes.fromhex('0267 00f5 0768 62 0673 2710 0802 0135'.replace(' ', ''))),
+    ('LAIRDRS1XX', 1, bytes.fromhex('0101262a5d180500000000')),
+    ('MCF88LW12CO2', 2, bytes.fromhex(
+        '0e' + '3285102b' + '3409' + '5a' + '8a8b01' + '2c01' + '6400' + '9001' +
+        '3285102b' + '3409' + '5a' + '8a8b01' + '2c01' + '6400' + '9001' + '64')),
+    ('MCF88LW12TER', 2, bytes.fromhex(
+        '04' + ('3285102b' + '3409' + '5a' + '8a8b01') * 3 + '64')),
+    ('PIOT', 1, bytes.fromhex('00' + '0000' + '64' + '11' + '04' + '0100' + '00000000')),
+]
+
+
+class FakeClient:
+    """stand in for a paho client used as publish target"""
+
+    def __init__(self):
+        self.published = 0
+        self.published_bytes = 0
+        self.last_payload = None
+        self._mid = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self._mid += 1
+        self.published += 1
+        self.published_bytes += len(payload or b'')
+        self.last_payload = payload
+        return mqtt.MQTTMessageInfo(self._mid)
+
+
+def load_relay():
+    spec = importlib.util.spec_from_file_location(
+        'mqtt_relais', os.path.join(ROOT_DIR, 'mqtt-relais.py'))
+    relay = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(relay)
+    return relay
+
+
+def synthetic_uplinks(count, frame=None, devices=0):
+    """
+    ttn v3 uplinks with increasing frame counters. every uplink comes from
+    another device, or with devices > 0 from one of that many devices with
+    zipf distributed traffic (a few devices send most of the messages).
+    """
+    template = json.loads(EXAMPLE_PAYLOAD)
+    if frame is not None:
+        template['uplink_message']['frm_payload'] = base64.b64encode(frame).decode('ascii')
+    if devices > 0:
+        senders = random.Random(1).choices(
+            range(devices), weights=[1 / rank for rank in range(1, devices + 1)], k=count)
+    else:
+        senders = range(count)
+    uplinks = []
+    for num, sender in enumerate(senders):
+        uplink = copy.deepcopy(template)
+        dev_eui = f'24E124128B{sender % 100000:06X}'
+        uplink['end_device_ids']['dev_eui'] = dev_eui
+        uplink['end_device_ids']['device_id'] = f'eui-{dev_eui.lower()}'
+        uplink['uplink_message']['f_cnt'] = num
+        topic = f"v3/lemt-raumsensoren@ttn/devices/eui-{dev_eui.lower()}/up"
+        uplinks.append((topic, json.dumps(uplink).encode('utf-8')))
+    return uplinks
+
+
+def _timed(func, inputs, latencies):
+    clock = time.perf_counter_ns
+    for item in inputs:
+        start = clock()
+        func(item)
+        latencies.append(clock() - start)
+
+
+def check_decodes(name, result, before=None):
+    """
+    stop if a scenario does not decode its input, e.g. because of a broken
+    frame: the result is empty or the input is returned unchanged, which
+    converters do on errors. the converter logs are turned off, so the
+    benchmark would otherwise only time the error path.
+    """
+    if not result or (before is not None and result == before):
+        sys.exit(f'{name}: the input of the scenario does not decode')
+
+
+def measure(name, func, inputs, alloc_samples=200, threads=1):
+    """
+    run func for every input, return throughput, latency and allocation stats.
+    with threads > 1 the inputs are shared out to that many threads calling
+    func at the same time.
+    """
+    for item in inputs[:100]:
+        func(item)
+    latencies = []
+    clock = time.perf_counter_ns
+    total_start = clock()
+    if threads > 1:
+        workers = [
+            threading.Thread(target=_timed, args=(func, inputs[num::threads], latencies))
+            for num in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        _timed(func, inputs, latencies)
+    total = clock() - total_start
+    allocations = []
+    tracemalloc.start()
+    for item in inputs[:alloc_samples]:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func(item)
+        allocations.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    latencies.sort()
+    return {
+        'scenario': name,
+        'messages': len(inputs),
+        'msgs_per_sec': round(len(inputs) / (total / 1e9), 1),
+        'p50_us': round(latencies[len(latencies) // 2] / 1000, 1),
+        'p99_us': round(latencies[int(len(latencies) * 0.99)] / 1000, 1),
+        'peak_alloc_bytes_per_msg': int(statistics.mean(allocations)) if allocations else 0
+    }
+
+
+def relay_scenarios(args):
+    relay = load_relay()
+    if args.broker:
+        host, _, port = args.broker.partition(':')
+        target = mqtt.Client('bench-relais-target')
+        target.connect(host, int(port or 1883))
+        target.loop_start()
+    else:
+        target = FakeClient()
+    gateway_batch = {'max-items': 100, 'max-delay': 100, 'format': 'gateway'}
+    chains = {
+        'relay:passthrough': (None, None, None, MS_AM3XX_FRAME, None),
+        'relay:ttn_v3-tb_v1': ('TTN_V3', None, 'TB_V1', MS_AM3XX_FRAME, None),
+        'relay:ttn_v3-tb_v1-batch': ('TTN_V3', None, 'TB_V1', MS_AM3XX_FRAME, gateway_batch),
+        'relay:ttn_v3-ms_am3xx-tb_v1': ('TTN_V3', 'MS_AM3XX', 'TB_V1', MS_AM3XX_FRAME, None),
+        'relay:ttn_v3-elsys-tb_v1': ('TTN_V3', 'ELSYS', 'TB_V1', ELSYS_FRAME, None),
+        'relay:ttn_v3-registry-tb_v1': ('TTN_V3', relay.DEVICE_REGISTRY, 'TB_V1', MS_AM3XX_FRAME, None),
+        'relay:ttn_v3-tb_v1-template': ('TTN_V3', None, 'TB_V1', MS_AM3XX_FRAME, None),
+    }
+    # publish topic templates, rendered per message
+    publish_topics = {'relay:ttn_v3-tb_v1-template': 'bench/{topic[1]}/{dev_eui}/{f_port}'}
+    # fields of a message without payload converter
+    ttn_v3_fields = set(_create_converter('TTN_V3').convert_message(json.loads(EXAMPLE_PAYLOAD))['preconverted'])
+    # every synthetic device is listed with its dev_eui
+    relay.device_registry = DeviceRegistry({
+        f'24E124128B{num % 100000:06X}': 'MS_AM3XX' for num in range(max(args.messages, args.devices))})
+    for name, (subscribe_converter, payload_converter, publish_converter, frame, batch) in chains.items():
+        if not fnmatch.fnmatch(name, args.scenario):
+            continue
+        routing = [{
+            'name': 'bench',
+            'subscribe-broker': 'source',
+            'subscribe-topic': 'v3/+/devices/+/up',
+            'publish-broker': 'target',
+            'publish_topic': publish_topics.get(name, 'bench/out'),
+            'payload-converter': payload_converter,
+            'batch': batch
+        }]
+        # routes that do not match, the topic index has to skip them
+        for num in range(args.routes - 1):
+            routing.append({
+                'name': f'other-{num}',
+                'subscribe-broker': 'source',
+                'subscribe-topic': f'v3/other-app-{num}@ttn/devices/+/up',
+                'publish-broker': 'target'
+            })
+        relay.configuration = {
+            'brokers': {
+                'source': {'subscribe-converter': subscribe_converter},
+                'target': {'publish-converter': publish_converter}
+            },
+            'routing': routing
+        }
+        relay.active_clients = {'target': target}
+        for broker_name, broker_conf in relay.configuration['brokers'].items():
+            routing_info = relay._create_routing_info(broker_name, broker_conf)
+            if broker_name == 'source':
+                userdata = routing_info
+        messages = []
+        for topic, payload in synthetic_uplinks(args.messages, frame, args.devices):
+            message = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+            message.payload = payload
+            messages.append(message)
+
+        def process(message):
+            message.timestamp = time.monotonic()
+            relay.on_message(None, userdata, message)
+
+        if not args.broker and not batch:
+            target.last_payload = None
+            process(messages[0])
+            check_decodes(name, target.last_payload)
+            if payload_converter:
+                values = json.loads(target.last_payload).get('values') or {}
+                check_decodes(name, set(values) - ttn_v3_fields)
+        published = getattr(target, 'published', 0)
+        result = measure(name, process, messages)
+        for batcher in relay.batchers.values():
+            batcher.stop()
+        relay.batchers.clear()
+        if not args.broker:
+            # batched routes publish less often than they receive
+            result['publishes'] = target.published - published
+        if args.broker:
+            # include the time to write everything to the broker
+            while getattr(target, '_out_packet', None):
+                time.sleep(0.01)
+        yield result
+    if args.broker:
+        target.loop_stop()
+        target.disconnect()
+
+
+def _create_converter(classname):
+    module = importlib.import_module(f'MessageConverters.{classname}')
+    converter_class = getattr(module, classname)
+    try:
+        return converter_class('bench_device')
+    except TypeError:
+        return converter_class()
+
+
+def converter_scenarios(args):
+    ttn_v3 = _create_converter('TTN_V3')
+    uplinks = synthetic_uplinks(args.messages, MS_AM3XX_FRAME)
+    preconverted = [ttn_v3.convert_message(json.loads(payload)) for _, payload in uplinks[:1000]]
+    elsys_preconverted = [
+        ttn_v3.convert_message(json.loads(payload))
+        for _, payload in synthetic_uplinks(1000, ELSYS_FRAME)]
+    json_cases = {
+        'converter:TTN_V3': ('TTN_V3', [payload for _, payload in uplinks]),
+        'converter:MS_AM3XX': ('MS_AM3XX', [json.dumps(message).encode('utf-8') for message in preconverted]),
+        'converter:ELSYS': ('ELSYS', [json.dumps(message).encode('utf-8') for message in elsys_preconverted]),
+        'converter:TB_V1': ('TB_V1', [json.dumps(message).encode('utf-8') for message in preconverted]),
+    }
+    for name, (classname, inputs) in json_cases.items():
+        if not fnmatch.fnmatch(name, args.scenario):
+            continue
+        converter = _create_converter(classname)
+        inputs = (inputs * (args.messages // len(inputs) + 1))[:args.messages]
+        check_decodes(name, converter.convert(inputs[0]), inputs[0])
+        yield measure(name, converter.convert, inputs)
+        # the same through the message api, without json decoding and encoding
+        decoded = [json.loads(payload) for payload in inputs]
+        check_decodes(name, converter.convert_message(json.loads(inputs[0])), json.loads(inputs[0]))
+        yield measure(f'{name}:message', converter.convert_message, decoded)
+        if args.threads > 1:
+            decoded = [json.loads(payload) for payload in inputs]
+            yield measure(f'{name}:threads', converter.convert_message, decoded, threads=args.threads)
+
+    for classname, port, frame in DEVICE_FRAMES:
+        name = f'converter:{classname}'
+        if not fnmatch.fnmatch(name, args.scenario):
+            continue
+        try:
+            converter = _create_converter(classname)
+        except Exception as err:
+            logging.warning(f'skipping {name}: {err}')
+            continue
+        if classname == 'PIOT':
+            try:
+                import fakeredis
+            except ImportError:
+                logging.warning(f'skipping {name}: needs fakeredis instead of a redis server')
+                continue
+            converter.state = RedisStateStore(fakeredis.FakeStrictRedis(decode_responses=True))
+        check_decodes(name, converter._convert(frame, port))
+        yield measure(name, lambda payload: converter._convert(payload, port), [frame] * args.messages)
+        if args.threads > 1:
+            # converters keep no per message state, one instance serves all threads
+            yield measure(
+                f'{name}:threads', lambda payload: converter._convert(payload, port),
+                [frame] * args.messages, threads=args.threads)
+
+    # badge events of one PIOT device with increasing sequence numbers per state store
+    for backend in ('memory', 'redis', 'redis-write-behind', 'redis-cached'):
+        name = f'converter:PIOT:badge_event:{backend}'
+        if not fnmatch.fnmatch(name, args.scenario):
+            continue
+        if backend == 'memory':
+            state = MemoryStateStore()
+        else:
+            try:
+                import fakeredis
+            except ImportError:
+                logging.warning(f'skipping {name}: needs fakeredis instead of a redis server')
+                continue
+            state = RedisStateStore(
+                fakeredis.FakeStrictRedis(decode_responses=True),
+                write_behind=1.0 if backend == 'redis-write-behind' else None)
+            if backend == 'redis-cached':
+                state = CachedStateStore(state)
+        converter = _create_converter('PIOT')
+        converter.state = state
+        sequence = itertools.count(1)
+
+        def badge_event(_):
+            return converter._convert(PIOT_BADGE_EVENT.pack(0x01, next(sequence) & 0xFFFF, 0) + PIOT_BADGE_UUID, 1)
+
+        check_decodes(name, badge_event(None))
+        yield measure(name, badge_event, [None] * args.messages)
+        state.close()
+
+
+def compare(results, baseline_path, tolerance):
+    """return the scenarios slower than the baseline by more than tolerance"""
+    with open(baseline_path) as baseline_file:
+        baseline = {result['scenario']: result for result in json.load(baseline_file)}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['scenario'])
+        if before and result['msgs_per_sec'] < before['msgs_per_sec'] * (1 - tolerance):
+            regressions.append((result['scenario'], before['msgs_per_sec'], result['msgs_per_sec']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='mqtt-relais benchmarks')
+    parser.add_argument('--messages', type=int, default=10000, help='messages per scenario')
+    parser.add_argument('--routes', type=int, default=200, help='routes of the subscribing broker')
+    parser.add_argument('--scenario', default='*', help='glob of the scenarios to run, e.g. "relay:*"')
+    parser.add_argument('--broker', help='host:port of a local broker used as publish target')
+    parser.add_argument(
+        '--devices', type=int, default=0,
+        help='devices sending the relay messages with zipf distributed traffic, 0 for one message per device')
+    parser.add_argument('--threads', type=int, default=4, help='threads sharing one converter, 1 to skip')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+    if '*' not in args.scenario and '?' not in args.scenario:
+        args.scenario += '*'
+    logging.basicConfig(level=logging.WARNING)
+    # converters log every unexpected byte, keep the output readable
+    logging.getLogger('MessageConverters').setLevel(logging.CRITICAL)
+
+    results = []
+    print(f"{'scenario':40} {'msgs/sec':>12} {'p50 us':>9} {'p99 us':>9} {'alloc B/msg':>12}")
+    for scenario in (relay_scenarios, converter_scenarios):
+        for result in scenario(args):
+            results.append(result)
+            print(
+                f"{result['scenario']:40} {result['msgs_per_sec']:>12} "
+                f"{result['p50_us']:>9} {result['p99_us']:>9} {result['peak_alloc_bytes_per_msg']:>12}")
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for scenario, before, after in regressions:
+            print(f'REGRESSION {scenario}: {before} -> {after} msgs/sec')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 # !/usr/bin/python3
 
 import string
+import copy
 import time
 import random
 import json
@@ -12,20 +13,240 @@ from logging.config import fileConfig
 import importlib
 import argparse
 import os
-import re
+import signal
+import threading
+import functools
+import collections
 from rich.logging import RichHandler
 
 
 from datetime import datetime
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 from MessageConverters.MessageConverter import MessageConverter
+from MessageConverters import DeviceState
+from MessageConverters.FrameConverter import FrameConverter, DOWNLINK, decodes_frames
+from MessageConverters import Timestamps
+from Relais.TopicMatcher import TopicMatcher
+from Relais.WorkerPool import WorkerPool
+from Relais.Supervisor import Supervisor
+from Relais.AsyncioEngine import AsyncioEngine
+from Relais.MessageLog import MessageLog, TRACE
+from Relais.Metrics import MetricsRegistry, start_http_server
+from Relais.Spool import Spool
+from Relais.Batcher import Batcher
+from Relais.DeviceRegistry import DeviceRegistry
+from Relais.LRUCache import LRUCache
+from Relais.TopicTemplate import TopicTemplate
+from Relais.TopicAliases import TopicAliases
+from Relais.Downlinks import DownlinkQueue
+from Relais.Deduplicator import Deduplicator
 
 LOGGING_CONFIG = 'logging.conf'
 CONVERTERS_DIR = 'MessageConverters'
+# payload-converter of routes that select the converter per device
+DEVICE_REGISTRY = 'device-registry'
+# downlink topic of the device on a ttn v3 broker, rendered with the uplink topic and converted message
+DOWNLINK_TOPIC = 'v3/{topic[1]}/devices/{device_id}/down/push'
+
+HEARTBEAT_INTERVAL = 5
+# protocol versions of the 'mqtt-version' broker setting
+MQTT_VERSIONS = {'3.1': mqtt.MQTTv31, '3.1.1': mqtt.MQTTv311, '5': mqtt.MQTTv5}
 
 # list to store all mqtt connection infos
 brokers = []
+# loaded configuration
+configuration = {}
+# list to store all active clients
+active_clients = {}
+# dictionary to store all dynamically loaded converters
+converters = {}
+# list to store all started worker pools
+worker_pools = []
+# batchers of the routes with 'batch' config by route name
+batchers = {}
+# downlink queues of the routes with 'downlink' config by route name
+downlinks = {}
+# shard of the routes handled by this process, None if not running as worker
+shard = None
+# event loop driving all clients if 'engine: asyncio' is configured
+engine = None
+# on-disk buffer of unpublished messages if 'spool' is configured
+spool = None
+# converter per device if 'device-registry' is configured
+device_registry = None
+# store of the converters keeping state per device (PIOT), see 'device-state'
+device_state = None
+# keys of the recently received uplinks and the function to get the key of a message, see _create_deduplicator
+deduplicator = None
+dedup_key = None
+# route plans per incoming topic by subscribe broker name
+route_plans = {}
+# incremented when the routing changes, cached route plans of older generations are outdated
+routing_generation = 0
+# worker pool of the brokers without their own 'worker-pool' config
+default_worker_pool = None
+# path of the configuration file, read again on reload
+config_path = None
+# set once the brokers are connected on startup, clients subscribe their routes from then on
+relay_ready = threading.Event()
+# set by SIGHUP or the configuration file watcher, handled by the main loop
+reload_requested = threading.Event()
+# broker settings which only change the routing, the connection is kept on reload
+ROUTING_KEYS = ('subscribe-converter', 'publish-converter', 'share-group', 'dedup')
+# settings which take effect on restart only
+RESTART_KEYS = ('engine', 'spool', 'metrics', 'worker-pool', 'device-state', 'dedup')
+# label of the publish result codes of paho, e.g. MQTT_ERR_QUEUE_SIZE -> queue_size
+PUBLISH_RESULTS = {
+    getattr(mqtt, name): name[len('MQTT_ERR_'):].lower() for name in dir(mqtt) if name.startswith('MQTT_ERR_')}
+# a route of the plan of an incoming topic with everything resolved, see _route_plan
+RouteStep = collections.namedtuple('RouteStep', (
+    'route', 'name', 'converters', 'device_registry', 'publish_converters',
+    'publish_broker', 'publish_client', 'publish_topic', 'topic_template', 'batcher', 'qos', 'retain',
+    'mqtt5', 'properties', 'downlinks', 'downlink_topic', 'timestamp'))
+logger = logging.getLogger(__name__)
+# sampling of the per message log lines
+message_log = MessageLog(logger)
+# level of the logger before tracing was enabled, None while it is disabled
+untraced_log_level = None
+
+# metrics of the relay, served over http if 'metrics' is configured
+metrics = MetricsRegistry()
+messages_received = metrics.counter(
+    'relais_messages_received_total',
+    'messages received per broker',
+    ('broker',))
+messages_unrouted = metrics.counter(
+    'relais_messages_unrouted_total',
+    'received messages without matching route per broker',
+    ('broker',))
+messages_duplicate = metrics.counter(
+    'relais_messages_duplicate_total',
+    'received messages dropped as duplicate of a recent uplink per broker',
+    ('broker',))
+messages_published = metrics.counter(
+    'relais_messages_published_total',
+    'messages published per target broker and route',
+    ('broker', 'route'))
+publish_errors = metrics.counter(
+    'relais_publish_errors_total',
+    'failed publishes per target broker and route',
+    ('broker', 'route'))
+message_latency = metrics.histogram(
+    'relais_message_duration_seconds',
+    'time from receiving a message to publishing it per route',
+    ('route',))
+converter_latency = metrics.histogram(
+    'relais_converter_duration_seconds',
+    'duration of converter calls. _count is the number of calls',
+    ('converter',))
+metrics.gauge(
+    'relais_converter_errors_total',
+    'failed conversions per converter',
+    ('converter',),
+    lambda: {(name,): converter.error_count for name, converter in converters.items()},
+    type='counter')
+publish_results = metrics.counter(
+    'relais_publish_failures_total',
+    'publishes rejected by the client per target broker and result code (no_conn, queue_size, ..)',
+    ('broker', 'result'))
+metrics.gauge(
+    'relais_publish_queue_depth',
+    'packets waiting to be written to the broker',
+    ('broker',),
+    lambda: {(name,): len(getattr(client, '_out_packet', ())) for name, client in active_clients.items()})
+metrics.gauge(
+    'relais_inflight_messages',
+    'qos>0 messages sent to the broker and not yet acknowledged',
+    ('broker',),
+    lambda: {(name,): getattr(client, '_inflight_messages', 0) for name, client in active_clients.items()})
+metrics.gauge(
+    'relais_queued_messages',
+    'qos>0 messages waiting for the inflight window of the client',
+    ('broker',),
+    lambda: {(name,): len(getattr(client, '_out_messages', ())) - getattr(client, '_inflight_messages', 0)
+             for name, client in active_clients.items()})
+metrics.gauge(
+    'relais_worker_pool_queue_depth',
+    'messages queued in the worker pool',
+    ('pool',),
+    lambda: {(worker_pool.name,): len(worker_pool) for worker_pool in worker_pools})
+metrics.gauge(
+    'relais_worker_pool_dropped_total',
+    'messages dropped by the backpressure policy of the worker pool',
+    ('pool',),
+    lambda: {(worker_pool.name,): worker_pool.dropped for worker_pool in worker_pools},
+    type='counter')
+metrics.gauge(
+    'relais_spool_pending_messages',
+    'messages in the spool waiting to be published',
+    (),
+    lambda: {(): len(spool)} if spool is not None else {})
+batches_published = metrics.counter(
+    'relais_batches_published_total',
+    'batched publishes per target broker and route',
+    ('broker', 'route'))
+metrics.gauge(
+    'relais_batcher_pending_messages',
+    'messages collected by the batcher of a route',
+    ('route',),
+    lambda: {(name,): len(batcher) for name, batcher in batchers.items()})
+downlinks_sent = metrics.counter(
+    'relais_downlinks_total',
+    'downlinks prepared by converters per route and result (published, failed)',
+    ('route', 'result'))
+metrics.gauge(
+    'relais_downlinks_pending',
+    'downlinks waiting for the rate limit of their device per route',
+    ('route',),
+    lambda: {(name,): len(queue) for name, queue in downlinks.items()})
+metrics.gauge(
+    'relais_downlinks_coalesced_total',
+    'pending downlinks replaced by a later downlink of the device per route',
+    ('route',),
+    lambda: {(name,): queue.coalesced for name, queue in downlinks.items()},
+    type='counter')
+metrics.gauge(
+    'relais_route_plan_cache_entries',
+    'incoming topics with a cached route plan per broker',
+    ('broker',),
+    lambda: {(name,): len(cache) for name, cache in route_plans.items()})
+metrics.gauge(
+    'relais_route_plan_cache_hits_total',
+    'messages routed with a cached route plan per broker',
+    ('broker',),
+    lambda: {(name,): cache.hits for name, cache in route_plans.items()},
+    type='counter')
+metrics.gauge(
+    'relais_route_plan_cache_misses_total',
+    'messages which needed a new route plan per broker',
+    ('broker',),
+    lambda: {(name,): cache.misses for name, cache in route_plans.items()},
+    type='counter')
+metrics.gauge(
+    'relais_broker_ready_seconds',
+    'time from starting the client to the first successful connect per broker',
+    ('broker',),
+    lambda: {(name,): client.ready_seconds for name, client in active_clients.items()
+             if client.ready_seconds is not None})
+metrics.gauge(
+    'relais_device_state_cache_lookups_total',
+    'device state reads served from the cache (hit) or the backend (miss)',
+    ('result',),
+    lambda: {('hit',): device_state.hits, ('miss',): device_state.misses}
+    if isinstance(device_state, DeviceState.CachedStateStore) else {},
+    type='counter')
+metrics.gauge(
+    'relais_dedup_keys',
+    'uplinks remembered by the deduplicator',
+    (),
+    lambda: {(): len(deduplicator)} if deduplicator is not None else {})
+device_lookups = metrics.counter(
+    'relais_device_registry_lookups_total',
+    'converter lookups in the device registry per result (hit, miss)',
+    ('result',))
 
 
 def _load_converter(converter_classname: string):
@@ -36,7 +257,11 @@ def _load_converter(converter_classname: string):
             m_name = f'{CONVERTERS_DIR}.{converter_classname}'
             module = importlib.import_module(m_name)
             device_class = getattr(module, converter_classname)
-            message_converter = device_class()
+            if decodes_frames(device_class):
+                # decodes the frames of one device, created per device
+                message_converter = FrameConverter(device_class)
+            else:
+                message_converter = device_class()
         except ImportError as err:
             logger.error(f'failed to load module: {converter_classname}. message: {err}')  
             return None
@@ -45,14 +270,57 @@ def _load_converter(converter_classname: string):
     
 
 
-def _convert_message(message: bytes, converter_classname: string) -> bytes:
-    # get corresponding decoder
-    message_converter = converters.get(converter_classname)
-    if message_converter:
-        return message_converter.convert(message)
-    else:
-        logger.error(f"can't find converter with name {converter_classname}. skipping..")
+def _encode_message(message) -> bytes:
+    """encode a decoded json message for publishing"""
+    if isinstance(message, (bytes, bytearray)):
         return message
+    return json.dumps(message).encode('utf-8')
+
+
+def _converter_chain(converter_classnames: list) -> tuple:
+    """resolve converter names to (name, converter) pairs, unknown converters are skipped"""
+    chain = []
+    for converter_classname in converter_classnames:
+        # get corresponding decoder
+        message_converter = converters.get(converter_classname)
+        if message_converter is None:
+            logger.error(f"can't find converter with name {converter_classname}. skipping..")
+            continue
+        chain.append((converter_classname, message_converter))
+    return tuple(chain)
+
+
+def _run_converters(message, chain: tuple, downlinks=None, timestamp=None):
+    """
+    run message through the converters of chain (see _converter_chain).
+    message is either the raw payload (bytes) or an already decoded json message.
+    converters implementing the message api get the decoded message, so the
+    document is parsed once for a whole chain of such converters.
+    legacy converters still get bytes. the result has to be encoded with
+    _encode_message before publishing.
+    downlinks prepared by the converters are appended to downlinks, they
+    are never published with the message. timestamp are the time settings
+    of the route for converters using them (see Timestamps.uplink_millis).
+    """
+    for converter_classname, message_converter in chain:
+        start = time.perf_counter()
+        if message_converter.accepts_message:
+            if isinstance(message, (bytes, bytearray)):
+                try:
+                    message = json.loads(message)
+                except ValueError:
+                    message_converter.error_count += 1
+                    logger.exception(
+                        f"can't decode message for converter {converter_classname}. skipping..")
+                    continue
+            message = message_converter.convert_message(message, timestamp)
+            downlink = message.pop(DOWNLINK, None) if isinstance(message, dict) else None
+            if downlink is not None and downlinks is not None:
+                downlinks.append(downlink)
+        else:
+            message = message_converter.convert(_encode_message(message))
+        converter_latency.observe(time.perf_counter() - start, converter_classname)
+    return message
 
 
 
@@ -70,105 +338,716 @@ def translate_to_tb_format(payload):
 '''
 
 
-def on_connect(client: mqtt.Client, userdata, flags, rc):
+def on_connect(client: mqtt.Client, userdata, flags, rc, properties=None):
+    # properties of the connack are passed by mqtt v5 clients only
     if rc == 0:
         client.connected_flag = True
         client.disconnect_flag = False
+        if client.topic_aliases is not None:
+            client.topic_aliases.reset(getattr(properties, 'TopicAliasMaximum', 0))
         logger.info(
             f'Connect for Client {userdata.get("name")} successful.')
-        for route in userdata.get('routes'):
-            topic = route.get(
-                "subscribe-topic")
-            if topic:
-                logger.info(
-                    f'Subscribing to topic {topic}')
-                client.subscribe(topic)
+        if client.ready_seconds is None:
+            client.ready_seconds = time.monotonic() - client.connect_started
+            logger.info(
+                f'broker {userdata.get("name")} ready after {client.ready_seconds * 1000:.0f}ms')
+        # on startup the relay subscribes once all brokers are connected
+        if relay_ready.is_set():
+            _subscribe_routes(client, userdata)
+        if spool is not None:
+            threading.Thread(
+                target=_replay_spool,
+                args=(client, userdata.get('name')),
+                name=f'spool-replay-{userdata.get("name")}',
+                daemon=True).start()
     else:
         logger.error(
             f"Connect for Client {userdata.get('name')} failed with result code: {str(rc)}")
 
 
-def on_disconnect(client, userdata, rc):
+def _subscribe_routes(client, userdata):
+    for topic, qos in _subscribe_topics(userdata).items():
+        logger.info(
+            f'Subscribing to topic {topic} with qos {qos}')
+        client.subscribe(topic, qos)
+
+
+def on_disconnect(client, userdata, rc, properties=None):
     client.connected_flag = False
     client.disconnect_flag = True
+    if client.topic_aliases is not None:
+        client.topic_aliases.reset()
     logger.info(
         "Disconnected client {} . Reason: {}".format(client, str(rc)))
 
 
 def on_publish(client, userdata, result):
-    # Todo after published data, remove from DB.
-    logger.info(
-        "data published to client {}. userdata: {} result: {}".format(
-            client._client_id, userdata, result))
+    if spool is not None:
+        spool.ack(userdata.get('name'), result)
+    if message_log.sampled():
+        message_log.trace(
+            "data published to client {}. userdata: {} result: {}".format(
+                client._client_id, userdata.get('name'), result))
 
 
 def on_message(client: mqtt.Client, userdata, message: mqtt.MQTTMessage):
-    logger.info(
-        f"**** new message received from broker '{userdata.get('name')}' on topic '{message.topic}'")
+    messages_received.inc(userdata.get('name'))
+    trace = message_log.sampled(message.topic)
+    if trace:
+        message_log.trace(
+            f"**** new message received from broker '{userdata.get('name')}' on topic '{message.topic}'")
+    worker_pool = userdata.get('worker-pool')
+    if worker_pool:
+        # keep the network thread free, messages of one topic stay in order
+        worker_pool.submit(message.topic, _process_message, userdata, message, trace)
+    else:
+        _process_message(userdata, message, trace)
+
+
+def _route_plan(userdata, topic: str) -> tuple:
+    """
+    subscribe converters and resolved routes of the messages on topic as
+    (subscribe chain, steps). steps is empty if no route matches. plans are
+    built once per topic and kept in the route plan cache of the broker.
+    """
+    route_plans = userdata.get('route-plans')
+    if route_plans is None:
+        return _build_route_plan(userdata, topic)
+    entry = route_plans.get(topic)
+    if entry is not None and entry[0] == routing_generation:
+        return entry[1]
+    generation = routing_generation
+    plan = _build_route_plan(userdata, topic)
+    # a publish broker without client may still connect, ask again next time
+    if all(step.publish_client is not None for step in plan[1]):
+        route_plans.put(topic, (generation, plan))
+    return plan
+
+
+def _build_route_plan(userdata, topic: str) -> tuple:
+    subscribe_converter = userdata.get('subscribe-converter')
+    subscribe_chain = _converter_chain([subscribe_converter]) if subscribe_converter else ()
+    publish_topics = userdata.get('publish-topics')
+    steps = []
+    for route in userdata.get('topic-matcher').match(topic):
+        # templates using only levels of the topic are rendered once per topic
+        publish_topic = topic
+        topic_template = publish_topics.get(route.get('name'))
+        if topic_template is not None and not topic_template.fields:
+            try:
+                publish_topic = topic_template.render(topic)
+                topic_template = None
+            except ValueError as error:
+                # fails again for every message and is counted as publish error
+                logger.error(error)
+        publish_broker = route.get('publish-broker')
+        publish_client = active_clients.get(publish_broker)
+        mqtt5 = _is_mqtt5(publish_client)
+        publish_converter = (configuration.get('brokers').get(publish_broker) or {}).get('publish-converter')
+        publish_chain = _converter_chain([publish_converter]) if publish_converter else ()
+        payload_converter = route.get('payload-converter')
+        if payload_converter and payload_converter != DEVICE_REGISTRY:
+            chain = _converter_chain([payload_converter]) + publish_chain
+        else:
+            chain = publish_chain
+        steps.append(RouteStep(
+            route=route,
+            name=route.get('name'),
+            converters=chain,
+            device_registry=payload_converter == DEVICE_REGISTRY,
+            publish_converters=publish_chain,
+            publish_broker=publish_broker,
+            publish_client=publish_client,
+            publish_topic=publish_topic,
+            topic_template=topic_template,
+            batcher=batchers.get(route.get('name')),
+            qos=route.get('qos', 0),
+            retain=route.get('retain', False),
+            mqtt5=mqtt5,
+            properties=_route_properties(route) if mqtt5 else None,
+            downlinks=downlinks.get(route.get('name')),
+            downlink_topic=userdata.get('downlink-topics').get(route.get('name')),
+            timestamp=_route_timestamp(route)))
+    return subscribe_chain, tuple(steps)
+
+
+def _invalidate_route_plans():
+    """drop all cached route plans, e.g. after the routing has changed"""
+    global routing_generation
+    # plans built while the caches are cleared are not used either
+    routing_generation += 1
+    for cache in route_plans.values():
+        cache.clear()
+
+
+def _process_message(userdata, message: mqtt.MQTTMessage, trace=False):
     message_payload = message.payload
-    logger.debug(
-        f"received message: {message_payload.decode('utf-8')}")
+    if trace:
+        message_log.trace(
+            f"received message: {message_payload.decode('utf-8', errors='replace')}")
     # find matching routing
-    routes_to_process = []
-    for route in userdata.get('routes'):
-        pattern = re.compile("^" + route.get('subscribe-topic').replace('+','.*').replace('#', '.*') +"$")
-        if pattern.match(message.topic):
-            routes_to_process.append(route)
-            
-    if routes_to_process:
-        for route in routes_to_process:
-            # convert with subscribe-converter if conigured
-            subscribe_converter = userdata.get('subscribe-converter')
-            if subscribe_converter:
-                logger.debug(
-                    f'converting message with subscribe-converter {subscribe_converter}')
-                message_payload = _convert_message(
-                    message_payload, subscribe_converter)
-            # convert with payload-converter if conigured
-            payload_converter = route.get('payload-converter')
-            if payload_converter:
-                logger.debug(
-                    f'converting message with payload-converter {payload_converter}')
-                message_payload = _convert_message(
-                    message_payload, payload_converter)
-            # convert with publish-converter if configured
-            publish_broker = route.get('publish-broker')
-            publish_client = active_clients.get(publish_broker)
-            publish_converter = configuration.get("brokers").get(
-                publish_broker).get('publish-converter')
-            if publish_converter:
-                logger.debug(
-                    f'converting message with publish_converter {publish_converter}')
-                message_payload = _convert_message(
-                    message_payload, publish_converter)
+    subscribe_chain, steps = _route_plan(userdata, message.topic)
+    if steps:
+        # convert with subscribe-converter if conigured
+        if subscribe_chain:
+            if trace:
+                message_log.trace(
+                    f'converting message with subscribe-converter {subscribe_chain[0][0]}')
+            message_payload = _run_converters(message_payload, subscribe_chain)
+        if deduplicator is not None and userdata.get('dedup') and _is_duplicate(message_payload):
+            messages_duplicate.inc(userdata.get('name'))
+            if trace:
+                message_log.trace(f'dropping duplicate uplink received on topic {message.topic}')
+            return
+        last_step = steps[-1]
+        for step in steps:
+            route_message = message_payload
+            if step is not last_step and not isinstance(route_message, (bytes, bytearray)):
+                # converters may change the decoded message in place
+                route_message = copy.deepcopy(route_message)
+            timestamp = None
+            if step.timestamp is not None:
+                # wall clock time the message was received
+                received = time.time() - (time.monotonic() - message.timestamp)
+                timestamp = dict(step.timestamp, received=received)
+            chain = step.converters
+            if step.device_registry:
+                payload_converter = _device_converter(route_message)
+                if trace:
+                    message_log.trace(f'device registry selected payload-converter {payload_converter}')
+                if payload_converter:
+                    chain = _converter_chain([payload_converter]) + step.publish_converters
+            if trace:
+                # payload-converter and publish-converter of the route
+                for converter_classname, _ in chain:
+                    message_log.trace(f'converting message with {converter_classname}')
+            publish_broker = step.publish_broker
             # publish message
             try:
-                publish_topic = route.get('publish_topic')
-
-                if not publish_topic:
-                    publish_topic = message.topic
-                    logger.info(f"retaining message topic")
-                
-                logger.info(
-                    f"publishing message to broker '{route.get('publish-broker')}' on topic '{publish_topic}'")
-                logger.debug(
-                    f"message: {message_payload.decode('utf-8')}")
-                publish_client.publish(
-                    publish_topic,
-                    payload=message_payload)
+                route_downlinks = [] if step.downlinks is not None else None
+                # fields of the uplink left out by the converters, for the topic template
+                source_message = route_message
+                route_message = _run_converters(route_message, chain, route_downlinks, timestamp)
+                if route_downlinks:
+                    _queue_downlinks(step, message.topic, route_message, route_downlinks)
+                publish_topic = step.publish_topic
+                if step.topic_template is not None:
+                    publish_topic = step.topic_template.render(
+                        message.topic,
+                        json.loads(route_message) if isinstance(route_message, (bytes, bytearray)) else route_message,
+                        source_message)
+
+                if step.batcher is not None:
+                    if trace:
+                        message_log.trace(
+                            f"adding message to batch of route '{step.name}' for topic '{publish_topic}'")
+                    step.batcher.add(publish_topic, (message.timestamp, route_message))
+                    continue
+                route_payload = _encode_message(route_message)
+                if trace:
+                    message_log.trace(
+                        f"publishing message to broker '{publish_broker}' on topic '{publish_topic}'")
+                    message_log.trace(
+                        f"message: {route_payload.decode('utf-8', errors='replace')}")
+                result = _publish(
+                    step.publish_client, publish_broker, publish_topic, route_payload, step.qos, step.retain,
+                    _publish_properties(step, message) if step.mqtt5 else None)
+                if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                    messages_published.inc(publish_broker, step.name)
+                else:
+                    publish_errors.inc(publish_broker, step.name)
+                message_latency.observe(time.monotonic() - message.timestamp, step.name)
             except Exception as error:
+                publish_errors.inc(publish_broker, step.name)
                 logger.exception(error)
     else:
-        logger.info(
-            f'no route found for topic {message.topic}')
+        messages_unrouted.inc(userdata.get('name'))
+        if trace:
+            message_log.trace(
+                f'no route found for topic {message.topic}')
+
+
+def _is_mqtt5(client) -> bool:
+    return getattr(client, '_protocol', None) == mqtt.MQTTv5
+
+
+def _route_properties(route):
+    """
+    mqtt v5 properties of the messages published by a route, None if it has
+    none. config example:
+    message-expiry: 3600    # seconds
+    user-properties:
+      source: relais
+    """
+    expiry = route.get('message-expiry')
+    user_properties = route.get('user-properties')
+    if not expiry and not user_properties:
+        return None
+    properties = Properties(PacketTypes.PUBLISH)
+    if expiry:
+        properties.MessageExpiryInterval = expiry
+    if user_properties:
+        properties.UserProperty = [(str(key), str(value)) for key, value in user_properties.items()]
+    return properties
+
+
+def _publish_properties(step, message: mqtt.MQTTMessage):
+    """
+    properties of a message published by step. the expiry and user
+    properties of a message received with mqtt v5 are passed on, the
+    received expiry replaces message-expiry of the route.
+    """
+    received = getattr(message, 'properties', None)
+    expiry = getattr(received, 'MessageExpiryInterval', None)
+    user_properties = getattr(received, 'UserProperty', None)
+    if expiry is None and not user_properties:
+        return step.properties
+    properties = Properties(PacketTypes.PUBLISH)
+    route_properties = step.properties
+    if expiry is None:
+        expiry = getattr(route_properties, 'MessageExpiryInterval', None)
+    if expiry is not None:
+        properties.MessageExpiryInterval = expiry
+    if hasattr(route_properties, 'UserProperty'):
+        properties.UserProperty = route_properties.UserProperty
+    if user_properties:
+        properties.UserProperty = user_properties
+    return properties
+
+
+def _device_converter(message):
+    """payload converter of the device that sent message, None if unknown"""
+    converter = None
+    if device_registry is None:
+        logger.error(f"route uses '{DEVICE_REGISTRY}' but no device registry is configured")
+    elif isinstance(message, dict):
+        # needs the fields of a subscribe-converter like TTN_V3
+        converter = device_registry.lookup(message)
+    device_lookups.inc('hit' if converter else 'miss')
+    return converter
+
+
+def _uplink_key(message):
+    dev_eui = (message.get('preconverted') or {}).get('dev_eui')
+    f_cnt = (message.get('uplink_message') or {}).get('f_cnt')
+    if dev_eui is None or f_cnt is None:
+        return None
+    return dev_eui.lower(), f_cnt
+
+
+def _correlation_key(message):
+    correlation_ids = message.get('correlation_ids')
+    if not correlation_ids:
+        return None
+    # the application server id is the same in all deliveries of an uplink
+    for correlation_id in correlation_ids:
+        if correlation_id.startswith('as:up:'):
+            return correlation_id
+    return tuple(correlation_ids)
+
+
+# key of an uplink for the deduplicator by 'key' setting
+DEDUP_KEYS = {'dev_eui+f_cnt': _uplink_key, 'correlation-ids': _correlation_key}
+
+
+def _create_deduplicator(dedup_conf):
+    """
+    drop uplinks received again within ttl seconds, e.g. from several
+    integrations of the same application. the key is taken from the
+    message of the subscribe-converter (TTN_V3), before the payload and
+    publish converters run. brokers with 'dedup: false' are not checked.
+    config example:
+    dedup:
+      key: dev_eui+f_cnt     # or correlation-ids
+      ttl: 60                # seconds
+      max-keys: 100000
+    """
+    global dedup_key
+    if not dedup_conf:
+        return None
+    key = dedup_conf.get('key', 'dev_eui+f_cnt')
+    if key not in DEDUP_KEYS:
+        raise ValueError(f"unknown dedup key {key}, use {' or '.join(DEDUP_KEYS)}")
+    dedup_key = DEDUP_KEYS[key]
+    logger.info(f'dropping duplicate uplinks by {key}')
+    return Deduplicator(ttl=dedup_conf.get('ttl', 60), maxsize=dedup_conf.get('max-keys', 100000))
+
+
+def _is_duplicate(message) -> bool:
+    """True if the uplink was received before, see _create_deduplicator"""
+    if not isinstance(message, dict):
+        # needs a subscribe-converter implementing the message api
+        return False
+    key = dedup_key(message)
+    return key is not None and deduplicator.seen(key)
+
+
+def _create_device_registry(registry_conf):
+    """
+    load the device registry. relative paths are taken from the conf
+    directory. config example:
+    device-registry:
+      path: devices.yaml
+      auto-models: true
+    """
+    if not registry_conf:
+        return None
+    path = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'conf', registry_conf.get('path', 'devices.yaml'))
+    registry = DeviceRegistry.load(path, auto_models=registry_conf.get('auto-models', False))
+    logger.info(f'loaded {len(registry)} devices and models from device registry {path}')
+    return registry
+
+
+def _create_device_state(state_conf):
+    """
+    create the store of the per device state of converters like PIOT,
+    redis on localhost if not configured. config example:
+    device-state:
+      backend: redis        # memory (this process only) or none (cache only)
+      host: 127.0.0.1
+      port: 6379
+      db: 0
+      max-connections: 10
+      write-behind: 1.0     # seconds, the debug payload key is written every second
+      # serve the state from memory and write changes through to the backend
+      cache:
+        size: 10000               # devices
+        write-interval: 0.1       # seconds
+        snapshot: device-state.json
+        snapshot-interval: 60     # seconds
+    the cache has to be the only writer of the state of its devices. with
+    shared subscriptions (shard mode 'shared', share-group or $share/
+    topics) several processes get uplinks of the same device, the backend
+    is used without cache then. several relays with a cache must not share
+    a redis either, which can't be detected here.
+    """
+    if not state_conf:
+        return None
+    backend = state_conf.get('backend', 'redis')
+    cache_conf = state_conf.get('cache')
+    if cache_conf and _shares_devices():
+        if backend == 'none':
+            raise ValueError("device-state backend 'none' can't be used with shared subscriptions")
+        # the cache would serve sequence numbers changed by the other processes
+        logger.warning('device-state cache disabled, other processes receive uplinks of the same devices')
+        cache_conf = None
+    if backend == 'none':
+        if not cache_conf:
+            raise ValueError("device-state backend 'none' needs a cache")
+        store = None
+    elif backend == 'memory':
+        store = DeviceState.MemoryStateStore()
+    elif backend == 'redis':
+        store = DeviceState.RedisStateStore(
+            host=state_conf.get('host', '127.0.0.1'),
+            port=state_conf.get('port', 6379),
+            db=state_conf.get('db', 0),
+            password=state_conf.get('password'),
+            max_connections=state_conf.get('max-connections', 10),
+            write_behind=state_conf.get('write-behind'))
+    else:
+        raise ValueError(f'unknown device-state backend {backend}')
+    if cache_conf:
+        snapshot_path = cache_conf.get('snapshot')
+        if snapshot_path and shard:
+            # every worker process has its own snapshot
+            snapshot_path = f'{snapshot_path}.w{shard.get("index")}'
+        store = DeviceState.CachedStateStore(
+            store,
+            maxsize=cache_conf.get('size', 10000),
+            write_interval=cache_conf.get('write-interval', 0.1),
+            snapshot_path=snapshot_path,
+            snapshot_interval=cache_conf.get('snapshot-interval', 60))
+    DeviceState.set_default_store(store)
+    logger.info(f"using {backend} device state store{' with cache' if cache_conf else ''}")
+    return store
+
+
+def _shares_devices() -> bool:
+    """True if other processes may receive the uplinks of the same devices"""
+    if shard and shard.get('mode') == 'shared':
+        return True
+    if any((broker_conf or {}).get('share-group') for broker_conf in configuration.get('brokers', {}).values()):
+        return True
+    return any(
+        str(route.get('subscribe-topic', '')).startswith('$share/') for route in configuration.get('routing') or ())
+
+
+def _create_batcher(route):
+    """
+    create the batcher of a route. messages are collected per publish topic
+    and published as one message. config example:
+    batch:
+      max-items: 100
+      max-delay: 100     # milliseconds
+      format: gateway    # 'array' (default) or thingsboard gateway api
+      device-key: device_id
+    """
+    batch_conf = route.get('batch')
+    if not batch_conf:
+        return None
+    batch_format = batch_conf.get('format', 'array')
+    if batch_format not in ('array', 'gateway'):
+        raise ValueError(f"unknown batch format {batch_format} in route {route.get('name')}")
+    batcher = Batcher(
+        route.get('name'),
+        functools.partial(_publish_batch, route),
+        max_items=batch_conf.get('max-items', 100),
+        max_delay=batch_conf.get('max-delay', 100) / 1000)
+    batcher.start()
+    return batcher
+
+
+def _create_downlinks(broker, route):
+    """
+    create the downlink queue of a route. downlinks prepared by the
+    converters (acks, time sync, ..) are published to the device on the
+    subscribe broker, at most one per device and min-interval. config example:
+    downlink:
+      topic: v3/{topic[1]}/devices/{device_id}/down/push    # default
+      min-interval: 10     # seconds
+      f-port: 2            # default: port of the uplink
+      priority: NORMAL
+      qos: 0
+    """
+    if not route.get('downlink'):
+        return None
+    downlink_conf = _downlink_conf(route)
+    if downlink_conf.get('qos', 0) not in (0, 1, 2):
+        raise ValueError(f"downlink qos of route {route.get('name')} must be 0, 1 or 2, got {downlink_conf.get('qos')}")
+    queue = DownlinkQueue(
+        route.get('name'),
+        functools.partial(_publish_downlink, broker, route),
+        min_interval=downlink_conf.get('min-interval', 10))
+    queue.start()
+    return queue
+
+
+def _downlink_conf(route) -> dict:
+    # 'downlink: true' uses the defaults
+    downlink_conf = route.get('downlink')
+    return downlink_conf if isinstance(downlink_conf, dict) else {}
+
+
+def _queue_downlinks(step, topic: str, message, route_downlinks: list):
+    """queue the downlinks prepared while converting a message received on topic"""
+    try:
+        downlink_topic = step.downlink_topic.render(
+            topic, json.loads(message) if isinstance(message, (bytes, bytearray)) else message)
+    except ValueError as error:
+        downlinks_sent.inc(step.name, 'failed', amount=len(route_downlinks))
+        logger.error(error)
+        return
+    for downlink in route_downlinks:
+        step.downlinks.add(downlink_topic, downlink)
+
+
+def _publish_downlink(broker: str, route, topic: str, downlink: dict):
+    """publish a downlink to a device with the ttn v3 downlink api"""
+    downlink_conf = _downlink_conf(route)
+    payload = json.dumps({'downlinks': [{
+        'f_port': downlink_conf.get('f-port', downlink.get('f_port')),
+        'frm_payload': downlink.get('frm_payload'),
+        'priority': downlink_conf.get('priority', 'NORMAL')}]}).encode('utf-8')
+    client = active_clients.get(broker)
+    if client is None:
+        downlinks_sent.inc(route.get('name'), 'failed')
+        return
+    result = _publish(client, broker, topic, payload, downlink_conf.get('qos', 0))
+    downlinks_sent.inc(route.get('name'), 'published' if result.rc == mqtt.MQTT_ERR_SUCCESS else 'failed')
+    if message_log.sampled(topic):
+        message_log.trace(f"published downlink of route '{route.get('name')}' on topic '{topic}': {payload}")
+
+
+def _batch_payload(route, messages: list) -> tuple:
+    """
+    combine converted messages into one payload. returns the payload and
+    the number of messages in it.
+    array:   [message, message, ..]
+    gateway: {"device": [message, ..], ..} for the thingsboard gateway api
+             (v1/gateway/telemetry). the device is taken from the message
+             or its values, e.g. TB_V1 results with preconverted device_id.
+    """
+    batch_conf = route.get('batch')
+    messages = [
+        json.loads(message) if isinstance(message, (bytes, bytearray)) else message
+        for message in messages]
+    if batch_conf.get('format', 'array') == 'array':
+        return json.dumps(messages).encode('utf-8'), len(messages)
+    device_key = batch_conf.get('device-key', 'device_id')
+    devices = {}
+    count = 0
+    for message in messages:
+        device = message.get(device_key) or (message.get('values') or {}).get(device_key)
+        if device is None:
+            publish_errors.inc(route.get('publish-broker'), route.get('name'))
+            logger.error(f"no {device_key} in message of route {route.get('name')}. skipping..")
+            continue
+        devices.setdefault(device, []).append(message)
+        count += 1
+    return json.dumps(devices).encode('utf-8'), count
+
+
+def _publish_batch(route, publish_topic: str, items: list):
+    """publish a batch of (receive time, converted message) collected for a route"""
+    publish_broker = route.get('publish-broker')
+    route_name = route.get('name')
+    try:
+        payload, count = _batch_payload(route, [converted for _, converted in items])
+        if not count:
+            return
+        client = active_clients.get(publish_broker)
+        result = _publish(
+            client, publish_broker, publish_topic, payload, route.get('qos', 0), route.get('retain', False),
+            _route_properties(route) if _is_mqtt5(client) else None)
+    except Exception as error:
+        publish_errors.inc(publish_broker, route_name, amount=len(items))
+        logger.exception(error)
+        return
+    if result.rc == mqtt.MQTT_ERR_SUCCESS:
+        batches_published.inc(publish_broker, route_name)
+        messages_published.inc(publish_broker, route_name, amount=count)
+    else:
+        publish_errors.inc(publish_broker, route_name, amount=count)
+    now = time.monotonic()
+    for timestamp, _ in items:
+        message_latency.observe(now - timestamp, route_name)
+
+
+def _publish(client: mqtt.Client, broker: str, topic: str, payload: bytes, qos=0, retain=False, properties=None):
+    """
+    publish a message, keep it in the spool until the client reports it as
+    published. the mqtt v5 properties are not kept in the spool.
+    """
+    if spool is None:
+        result = _client_publish(client, topic, payload, qos, retain, properties)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            _publish_failed(broker, topic, result.rc)
+        return result
+    spool_id = spool.add(broker, topic, payload, qos, retain)
+    if client is None:
+        # broker was not reachable at startup, keep the message for the next start
+        result = mqtt.MQTTMessageInfo(0)
+        result.rc = mqtt.MQTT_ERR_NO_CONN
+        _publish_failed(broker, topic, result.rc)
+        return result
+    result = _client_publish(client, topic, payload, qos, retain, properties)
+    # qos>0 messages are queued by the client while it is disconnected
+    if result.rc == mqtt.MQTT_ERR_SUCCESS or (qos > 0 and result.rc == mqtt.MQTT_ERR_NO_CONN):
+        spool.track(broker, result.mid, spool_id, qos)
+    if result.rc != mqtt.MQTT_ERR_SUCCESS:
+        _publish_failed(broker, topic, result.rc)
+    return result
+
+
+def _client_publish(client: mqtt.Client, topic: str, payload: bytes, qos, retain, properties):
+    topic_aliases = getattr(client, 'topic_aliases', None)
+    if topic_aliases is not None:
+        return topic_aliases.publish(client, topic, payload, qos, retain, properties)
+    return client.publish(topic, payload=payload, qos=qos, retain=retain, properties=properties)
+
+
+def _publish_failed(broker: str, topic: str, rc: int):
+    publish_results.inc(broker, PUBLISH_RESULTS.get(rc, str(rc)))
+    if message_log.sampled(topic):
+        message_log.trace(f'publish to broker {broker} on topic {topic} failed: {mqtt.error_string(rc)}')
+
+
+def _replay_spool(client: mqtt.Client, broker: str):
+    """publish the messages left in the spool after (re)connecting to broker"""
+    count = 0
+    for spool_id, topic, payload, qos, retain in spool.pending(broker):
+        if not client.connected_flag:
+            logger.warning(f'connection to {broker} lost while publishing spooled messages')
+            return
+        result = client.publish(topic, payload=payload, qos=qos, retain=retain)
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            spool.track(broker, result.mid, spool_id, qos)
+            count += 1
+    if count:
+        logger.info(f'published {count} spooled messages to broker {broker}')
+
+
+def _create_spool(spool_conf):
+    """
+    create the store-and-forward buffer. config example:
+    spool:
+      path: /var/lib/mqtt-relais/spool.db
+      flush-interval: 0.2
+      batch-size: 500
+    """
+    if not spool_conf:
+        return None
+    path = spool_conf.get('path', 'spool.db')
+    if shard:
+        # every worker process has its own spool
+        path = f'{path}.w{shard.get("index")}'
+    return Spool(
+        path,
+        flush_interval=spool_conf.get('flush-interval', 0.2),
+        batch_size=spool_conf.get('batch-size', 500))
 
 
 def on_log(client, userdata, level, buf):
-    logger.info('Loglevel: {}. message: {}, userdata: {}'.format(
-        level, buf, userdata))
+    # paho logs every packet, keep it out of the hot path
+    if message_log.sampled():
+        message_log.trace('Loglevel: {}. message: {}, userdata: {}'.format(
+            level, buf, userdata.get('name') if userdata else None))
+
+
+def _configure_message_log(trace_conf):
+    """
+    enable the sampled per message log lines. without trace config (e.g.
+    removed on reload) nothing is traced. config example:
+    trace:
+      sample-rate: 0.01     # messages on other topics and packet logs, default 0
+      topics:
+        'v3/+/devices/+/up': 0.1
+    """
+    global message_log, untraced_log_level
+    if not trace_conf:
+        message_log = MessageLog(logger)
+        if untraced_log_level is not None:
+            logger.setLevel(untraced_log_level)
+            untraced_log_level = None
+        return
+    if untraced_log_level is None:
+        untraced_log_level = logger.level
+    message_log = MessageLog(
+        logger,
+        sample_rate=trace_conf.get('sample-rate', 0.0),
+        topic_sample_rates=trace_conf.get('topics'))
+    logger.setLevel(TRACE)
 
 
 def connect_mqtt(name, broker_info):
+    """
+    create the client of broker name. the connection is made by the network
+    loop, so all brokers connect in parallel. config example:
+    brokers:
+      ttn:
+        host: eu1.cloud.thethings.network
+        port: 1883
+        client-id: relais-ttn
+        # false keeps subscriptions and queued qos>0 messages of the
+        # client id on the broker over restarts
+        clean-session: true
+        # qos>0 messages sent and not yet acknowledged, paho default 20
+        max-inflight: 100
+        # qos>0 messages waiting for the inflight window, 0 is unbounded.
+        # publishing to a full queue fails with queue_size
+        max-queued: 10000
+        # 3.1, 3.1.1 (default) or 5
+        mqtt-version: 5
+        # mqtt v5: seconds the broker keeps the session if clean-session is false
+        session-expiry: 3600
+        # mqtt v5: topic aliases used for qos 0 publishes to this broker
+        topic-aliases: 100
+        # subscribe the routes as $share/<group>/<topic>, the broker
+        # balances the messages between the relays of the group
+        share-group: relais
+    """
     try:
         ssl.match_hostname = lambda cert, hostname: True
         auth_conf = broker_info.get("auth")
@@ -184,13 +1063,39 @@ def connect_mqtt(name, broker_info):
             client_id = "{}-{}".format(
                 name,
                 random.randint(150, 205))
+        if shard:
+            # every worker process needs its own session
+            client_id = f"{client_id}-w{shard.get('index')}"
 
+        protocol = MQTT_VERSIONS.get(str(broker_info.get('mqtt-version', '3.1.1')))
+        if protocol is None:
+            raise ValueError(f"unknown mqtt-version {broker_info.get('mqtt-version')}")
+        clean_session = broker_info.get('clean-session', True)
+        connect_properties = None
         # create client object
-        client = mqtt.Client(
-            client_id,
-            clean_session=False)
+        if protocol == mqtt.MQTTv5:
+            # v5 has clean start on connect instead of clean session
+            client = mqtt.Client(client_id, protocol=protocol)
+            if not clean_session:
+                connect_properties = Properties(PacketTypes.CONNECT)
+                connect_properties.SessionExpiryInterval = broker_info.get('session-expiry', 3600)
+        else:
+            client = mqtt.Client(
+                client_id,
+                clean_session=clean_session,
+                protocol=protocol)
+        client.topic_aliases = None
+        if protocol == mqtt.MQTTv5 and broker_info.get('topic-aliases'):
+            client.topic_aliases = TopicAliases(broker_info.get('topic-aliases'))
         client.connected_flag = False
         client.disconnect_flag = True
+        # time to ready is measured from here to the first connack
+        client.connect_started = time.monotonic()
+        client.ready_seconds = None
+        if broker_info.get('max-inflight') is not None:
+            client.max_inflight_messages_set(broker_info.get('max-inflight'))
+        if broker_info.get('max-queued') is not None:
+            client.max_queued_messages_set(broker_info.get('max-queued'))
 
         # configure authentication
         if (auth_type == "password"):
@@ -206,21 +1111,18 @@ def connect_mqtt(name, broker_info):
             client.tls_insecure_set(True)
         logger.info(
             f'connecting to broker {name} on host {broker_info.get("host")}')
-        client.connect(
-            host=broker_info.get("host"),
-            port=broker_info.get("port"),
-            keepalive=60)
-
-        # workaround to make sure the session is clean on startup but remains on automatic reconnect
-        client.disconnect()
-        while client.connected_flag:
-            logger.warning("waiting for client to disconnect..")
-            time.sleep(1)
-        client.clean_session = True
-        client.connect(
-            host=broker_info.get("host"),
-            port=broker_info.get("port"),
-            keepalive=60)
+        if protocol == mqtt.MQTTv5:
+            client.connect_async(
+                host=broker_info.get("host"),
+                port=broker_info.get("port"),
+                keepalive=60,
+                clean_start=clean_session,
+                properties=connect_properties)
+        else:
+            client.connect_async(
+                host=broker_info.get("host"),
+                port=broker_info.get("port"),
+                keepalive=60)
         return client
     except Exception:
         logger.exception(f"connection for broker {name} failed. skipping this one..")
@@ -228,11 +1130,517 @@ def connect_mqtt(name, broker_info):
     
 
 
+def _create_worker_pool(name, pool_conf):
+    if not pool_conf:
+        return None
+    worker_pool = WorkerPool(
+        name,
+        threads=pool_conf.get('threads', 1),
+        queue_size=pool_conf.get('queue-size', 1000),
+        backpressure=pool_conf.get('backpressure', WorkerPool.BLOCK))
+    worker_pool.start()
+    return worker_pool
+
+
 def disconnect_mqtt(client):
     client.loop_stop()
     client.disconnect()
 
 
+def _in_shard(route_num) -> bool:
+    """True if the route with index route_num is handled by this process"""
+    if not shard or shard.get('mode') == 'shared':
+        return True
+    return route_num % shard.get('count') == shard.get('index')
+
+
+def _subscribe_topic(topic: str, share_group=None) -> str:
+    """
+    topic to subscribe, shared between the relays of the share-group of the
+    broker or the workers in shard mode 'shared'
+    """
+    if topic.startswith('$share/'):
+        return topic
+    if not share_group and shard and shard.get('mode') == 'shared':
+        share_group = shard.get('group')
+    if share_group:
+        return f"$share/{share_group}/{topic}"
+    return topic
+
+
+def _create_routing_info(name, conf, worker_pool=None) -> dict:
+    """
+    create converter and routing info of a broker. it is passed as userdata
+    to the callbacks of the client. all converters used by the routes are loaded.
+    """
+    converter_and_routing_info = {}
+    converter_and_routing_info['name'] = name
+    subscribe_converter = conf.get('subscribe-converter')
+    converter_and_routing_info['subscribe-converter'] = subscribe_converter
+    if subscribe_converter:
+        _load_converter(subscribe_converter)
+    publish_converter = conf.get('publish-converter')
+    converter_and_routing_info['publish-converter'] = publish_converter
+    converter_and_routing_info['share-group'] = conf.get('share-group')
+    converter_and_routing_info['dedup'] = conf.get('dedup', True)
+    if publish_converter:
+        _load_converter(publish_converter)
+    converter_and_routing_info['routes'] = []
+    # topic index, built once for all routes of this broker
+    topic_matcher = TopicMatcher()
+    # compiled publish_topic templates by route name
+    publish_topics = {}
+    # compiled downlink topic templates by route name
+    downlink_topics = {}
+    for route_num, route in enumerate(configuration.get("routing")):
+        if route["subscribe-broker"] == name and _in_shard(route_num):
+            _check_route_qos(route)
+            _check_route_timestamp(route)
+            converter_and_routing_info['routes'].append(route)
+            if route.get('subscribe-topic'):
+                topic_matcher.add(route.get('subscribe-topic'), route)
+            if route.get('publish_topic'):
+                publish_topics[route['name']] = TopicTemplate(route['publish_topic'])
+            payload_converter = route.get('payload-converter')
+            if payload_converter == DEVICE_REGISTRY:
+                if device_registry is not None:
+                    for converter_classname in device_registry.converters():
+                        _load_converter(converter_classname)
+            elif payload_converter:
+                _load_converter(
+                    payload_converter)
+            batcher = _create_batcher(route)
+            if batcher is not None:
+                batchers[route['name']] = batcher
+            downlink_queue = _create_downlinks(name, route)
+            if downlink_queue is not None:
+                downlinks[route['name']] = downlink_queue
+                downlink_topics[route['name']] = TopicTemplate(
+                    _downlink_conf(route).get('topic', DOWNLINK_TOPIC))
+            logger.debug(f"added route {route['name']}")
+    converter_and_routing_info['topic-matcher'] = topic_matcher
+    converter_and_routing_info['publish-topics'] = publish_topics
+    converter_and_routing_info['downlink-topics'] = downlink_topics
+    converter_and_routing_info['worker-pool'] = worker_pool
+    route_cache = _create_route_cache(configuration.get('route-cache'))
+    if route_cache is not None:
+        route_plans[name] = route_cache
+    converter_and_routing_info['route-plans'] = route_cache
+    return converter_and_routing_info
+
+
+def _check_route_qos(route):
+    """
+    validate the delivery settings of a route. config example:
+    subscribe-qos: 1    # qos of the subscription, default 0
+    qos: 1              # qos of the published messages, default 0
+    retain: false
+    """
+    for key in ('subscribe-qos', 'qos'):
+        if route.get(key, 0) not in (0, 1, 2):
+            raise ValueError(f"{key} of route {route.get('name')} must be 0, 1 or 2, got {route.get(key)}")
+    if not isinstance(route.get('retain', False), bool):
+        raise ValueError(f"retain of route {route.get('name')} must be true or false, got {route.get('retain')}")
+
+
+def _check_route_timestamp(route):
+    """
+    validate the time source of the messages of a route, used by publish
+    converters like TB_V1. config example:
+    timestamp: gateway     # network (default), gateway, device or relay
+    timestamp-field: ts    # field of the decoded payload with the device time
+    """
+    source = route.get('timestamp', 'network')
+    if source not in Timestamps.SOURCES:
+        raise ValueError(
+            f"timestamp of route {route.get('name')} must be one of {', '.join(Timestamps.SOURCES)}, got {source}")
+
+
+def _route_timestamp(route):
+    """timestamp settings passed to the converters of a route, None for the network time"""
+    source = route.get('timestamp', 'network')
+    if source == 'network':
+        return None
+    return {'source': source, 'field': route.get('timestamp-field', 'ts')}
+
+
+def _create_route_cache(cache_conf):
+    """
+    create the cache of the route plans per incoming topic, enabled by
+    default. size 0 disables it. config example:
+    route-cache:
+      size: 65536
+    """
+    size = (cache_conf or {}).get('size', 65536)
+    if not size:
+        return None
+    return LRUCache(size)
+
+
+def start_relay():
+    """
+    connect all brokers of the configuration and set up converters and
+    routing. the brokers connect in parallel, the routes are subscribed
+    when all are connected or ready-timeout has passed. config example:
+    startup:
+      ready-timeout: 30
+    """
+    global engine, spool, device_registry, device_state, deduplicator, default_worker_pool
+    metrics_conf = configuration.get('metrics')
+    if metrics_conf:
+        port = metrics_conf.get('port', 9108)
+        if shard:
+            # every worker process serves its own metrics
+            port += shard.get('index')
+        start_http_server(metrics, metrics_conf.get('host', '0.0.0.0'), port)
+    if configuration.get('engine', 'thread') == 'asyncio':
+        # one event loop for all brokers instead of a network thread per broker
+        engine = AsyncioEngine()
+        engine.start()
+    # messages have to survive a restart while a broker is unreachable
+    spool = _create_spool(configuration.get('spool'))
+    device_registry = _create_device_registry(configuration.get('device-registry'))
+    # converters loaded from here on use it
+    device_state = _create_device_state(configuration.get('device-state'))
+    deduplicator = _create_deduplicator(configuration.get('dedup'))
+    # start all mqtt connections
+    logger.info('starting mqtt connections...')
+    # worker pools to convert messages outside of the network threads.
+    # a broker with its own 'worker-pool' config gets a dedicated pool.
+    default_worker_pool = _create_worker_pool('global', configuration.get('worker-pool'))
+    if default_worker_pool:
+        worker_pools.append(default_worker_pool)
+    started = time.monotonic()
+    for name, conf in configuration.get("brokers").items():
+        _start_client(name, conf)
+    startup_conf = configuration.get('startup') or {}
+    waiting = _wait_connected(active_clients, startup_conf.get('ready-timeout', 30))
+    if waiting:
+        logger.warning(
+            f'brokers {", ".join(waiting)} not connected yet, relaying without them until they connect')
+    # clients connecting from now on subscribe in on_connect
+    relay_ready.set()
+    for client in list(active_clients.values()):
+        if client.connected_flag:
+            _subscribe_routes(client, client._userdata)
+    logger.info(
+        f'relay ready after {(time.monotonic() - started) * 1000:.0f}ms. '
+        f'{len(active_clients) - len(waiting)} of {len(configuration.get("brokers"))} brokers connected')
+    _start_config_watch(configuration.get('reload'))
+
+
+def _wait_connected(clients: dict, timeout) -> list:
+    """wait until the clients by name are connected, returns the names of those which are not"""
+    deadline = time.monotonic() + timeout
+    while True:
+        waiting = [name for name, client in clients.items() if not client.connected_flag]
+        if not waiting or time.monotonic() >= deadline:
+            return waiting
+        time.sleep(0.01)
+
+
+def _start_client(name, conf, routing_info=None, wait=None):
+    """
+    connect broker name and start handling its messages. with wait the
+    client replaces the active client of the broker once it is connected
+    or wait seconds have passed.
+    """
+    logger.info(
+        f'starting client for broker {name}, connecting to host {conf.get("host")}')
+    client = connect_mqtt(name, conf)
+    if client:
+        worker_pool = _create_worker_pool(name, conf.get('worker-pool'))
+        if worker_pool:
+            worker_pools.append(worker_pool)
+        else:
+            worker_pool = default_worker_pool
+        if routing_info is None:
+            routing_info = _create_routing_info(name, conf, worker_pool)
+        routing_info['worker-pool'] = worker_pool
+        # routing info has to be set before the network loop calls on_connect
+        client.user_data_set(routing_info)
+        # Bind function to callback
+        client.on_publish = on_publish
+        client.on_log = on_log
+        client.on_message = on_message
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+        if engine:
+            engine.add_client(client, name)
+        else:
+            client.loop_start()
+        client.enable_logger(logger)
+        if wait and _wait_connected({name: client}, wait):
+            logger.warning(f'broker {name} not connected after {wait}s')
+        active_clients[name] = client
+        # plans without a client for this broker are outdated
+        _invalidate_route_plans()
+    return client
+
+
+def _flush_client(client, timeout):
+    """wait until the network loop has written the queued packets of client"""
+    deadline = time.monotonic() + timeout
+    while getattr(client, '_out_packet', None) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def _pause_client(client, timeout=1):
+    """stop the network loop of client, e.g. before its client id is reused"""
+    _flush_client(client, timeout)
+    if engine:
+        engine.remove_client(client)
+    else:
+        client.loop_stop()
+
+
+def _retire_client(name, client, timeout=10):
+    """
+    disconnect a client which is no longer in active_clients after the
+    messages it received are processed and sent
+    """
+    # stop receiving before the worker pool is stopped
+    _pause_client(client, timeout)
+    worker_pool = client._userdata.get('worker-pool')
+    if worker_pool is not None:
+        worker_pool.join(timeout)
+        if worker_pool is not default_worker_pool:
+            worker_pool.stop(timeout)
+            worker_pools.remove(worker_pool)
+    _flush_client(client, timeout)
+    disconnect_mqtt(client)
+    logger.info(f'stopped client for broker {name}')
+
+
+def _subscribe_topics(routing_info) -> dict:
+    """qos by subscribed topic, the highest subscribe-qos of the routes of a topic"""
+    topics = {}
+    for route in routing_info.get('routes'):
+        if route.get('subscribe-topic'):
+            topic = _subscribe_topic(route.get('subscribe-topic'), routing_info.get('share-group'))
+            topics[topic] = max(topics.get(topic, 0), route.get('subscribe-qos', 0))
+    return topics
+
+
+def _connection_settings(conf) -> dict:
+    return {key: value for key, value in (conf or {}).items() if key not in ROUTING_KEYS}
+
+
+def reload_relay(new_configuration: dict):
+    """
+    apply a changed configuration while the relay is running. brokers with
+    unchanged connection settings keep their connection, their routing is
+    swapped in one step. brokers with changed settings are reconnected,
+    removed brokers are disconnected after their messages are processed.
+    if the new routing can not be set up, the old one stays active.
+    """
+    global configuration, device_registry
+    old_configuration = configuration
+    for key in RESTART_KEYS:
+        if old_configuration.get(key) != new_configuration.get(key):
+            logger.warning(f"changed setting '{key}' takes effect after a restart")
+    old_brokers = old_configuration.get('brokers') or {}
+    new_brokers = new_configuration.get('brokers') or {}
+    kept = [
+        name for name in new_brokers
+        if name in active_clients
+        and _connection_settings(new_brokers[name]) == _connection_settings(old_brokers.get(name))]
+    stopped = [name for name in active_clients if name not in kept]
+    started = [name for name in new_brokers if name not in kept]
+    old_registry = device_registry
+    old_batchers = dict(batchers)
+    batchers.clear()
+    old_downlinks = dict(downlinks)
+    downlinks.clear()
+    routing_infos = {}
+    try:
+        device_registry = _create_device_registry(new_configuration.get('device-registry'))
+        configuration = new_configuration
+        # the routing of all brokers is set up before anything is changed
+        for name in new_brokers:
+            worker_pool = active_clients[name]._userdata.get('worker-pool') if name in kept else None
+            routing_infos[name] = _create_routing_info(name, new_brokers[name], worker_pool)
+    except Exception:
+        logger.exception('failed to set up the new configuration, keeping the old one')
+        for batcher in batchers.values():
+            batcher.stop()
+        batchers.clear()
+        batchers.update(old_batchers)
+        for downlink_queue in downlinks.values():
+            downlink_queue.stop()
+        downlinks.clear()
+        downlinks.update(old_downlinks)
+        configuration = old_configuration
+        device_registry = old_registry
+        return False
+    _configure_message_log(configuration.get('trace'))
+    # swap the routing of the kept connections
+    for name in kept:
+        routing_info = routing_infos[name]
+        client = active_clients[name]
+        old_topics = _subscribe_topics(client._userdata)
+        client.user_data_set(routing_info)
+        new_topics = _subscribe_topics(routing_info)
+        for topic, qos in new_topics.items():
+            if old_topics.get(topic) != qos:
+                logger.info(f'Subscribing to topic {topic} with qos {qos}')
+                client.subscribe(topic, qos)
+        for topic in old_topics.keys() - new_topics.keys():
+            logger.info(f'Unsubscribing from topic {topic}')
+            client.unsubscribe(topic)
+    _invalidate_route_plans()
+    for name in stopped:
+        if name not in new_brokers:
+            client = active_clients.pop(name)
+            route_plans.pop(name, None)
+            # no new plans publishing to the removed broker
+            _invalidate_route_plans()
+            _retire_client(name, client)
+    for name in started:
+        # the old connection is used until the new one is up
+        old_client = active_clients.get(name)
+        client_id = new_brokers[name].get('client-id')
+        if old_client is not None and client_id and client_id == old_brokers[name].get('client-id'):
+            # the broker allows one connection per client id
+            _pause_client(old_client)
+        if not _start_client(name, new_brokers[name], routing_infos[name], wait=10):
+            active_clients.pop(name, None)
+            _invalidate_route_plans()
+        if old_client is not None:
+            _retire_client(name, old_client)
+    # messages queued with the old routing may still add to the old batchers
+    for worker_pool in worker_pools:
+        worker_pool.join(10)
+    for name, batcher in old_batchers.items():
+        batcher.stop()
+    for downlink_queue in old_downlinks.values():
+        downlink_queue.stop()
+    logger.info(
+        f'configuration reloaded. kept {len(kept)}, stopped {len(stopped)}, started {len(started)} broker connections')
+    return True
+
+
+def _reload_configuration():
+    """read the configuration file again and apply it"""
+    try:
+        with open(config_path) as yaml_conf_file:
+            new_configuration = yaml.full_load(yaml_conf_file)
+    except Exception:
+        logger.exception(f'failed to read configuration {config_path}, keeping the old one')
+        return
+    logger.info(f'reloading configuration {config_path}')
+    start = time.monotonic()
+    if reload_relay(new_configuration):
+        logger.info(f'reload took {(time.monotonic() - start) * 1000:.0f}ms')
+
+
+def _request_reload(signum=None, frame=None):
+    reload_requested.set()
+
+
+def _start_config_watch(reload_conf):
+    """
+    reload the configuration when its file changes. config example:
+    reload:
+      watch: true
+      interval: 2    # seconds between checks of the file
+    """
+    if not reload_conf or not reload_conf.get('watch') or not config_path:
+        return
+    interval = reload_conf.get('interval', 2)
+
+    def watch():
+        last_modified = os.stat(config_path).st_mtime
+        while True:
+            time.sleep(interval)
+            try:
+                modified = os.stat(config_path).st_mtime
+            except OSError:
+                continue
+            if modified != last_modified:
+                last_modified = modified
+                _request_reload()
+
+    threading.Thread(target=watch, name='config-watch', daemon=True).start()
+
+
+def stop_relay():
+    """process queued messages and disconnect all brokers"""
+    # no new messages while the queued ones are processed, publishing still works
+    for client in active_clients.values():
+        _pause_client(client)
+    for worker_pool in worker_pools:
+        worker_pool.stop(timeout=10)
+    # publish the collected messages while the clients are still connected
+    for batcher in batchers.values():
+        batcher.stop()
+    for downlink_queue in downlinks.values():
+        downlink_queue.stop()
+    for name, client in active_clients.items():
+        disconnect_mqtt(client)
+    if engine:
+        # the disconnect packets are written by the engine
+        for client in active_clients.values():
+            _flush_client(client, 2)
+        engine.stop()
+    if spool is not None:
+        # unacknowledged messages stay in the spool for the next start
+        spool.close()
+    if device_state is not None:
+        device_state.close()
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    # ignore further signals while shutting down
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt()
+
+
+def _run_worker(index, count, health_queue):
+    """entry point of a worker process started by the supervisor"""
+    global shard
+    # the supervisor handles ctrl+c and stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    # forwarded by the supervisor
+    signal.signal(signal.SIGHUP, _request_reload)
+    shard = dict(shard, index=index, count=count)
+    logger.info(f'worker {index}/{count} started (shard mode: {shard.get("mode")})')
+    try:
+        start_relay()
+        while True:
+            health_queue.put({
+                'worker': index,
+                'pid': os.getpid(),
+                'time': time.time(),
+                'brokers': {
+                    name: client.connected_flag for name, client in active_clients.items()},
+                'queued': sum(len(worker_pool) for worker_pool in worker_pools)
+            })
+            if reload_requested.wait(HEARTBEAT_INTERVAL):
+                reload_requested.clear()
+                _reload_configuration()
+    except KeyboardInterrupt:
+        logger.info(f'worker {index} stopping..')
+        stop_relay()
+
+
+def run_supervisor(workers: int):
+    """run the relay in several worker processes"""
+    supervisor = Supervisor(
+        _run_worker,
+        workers,
+        heartbeat_timeout=HEARTBEAT_INTERVAL * 6)
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    # every worker reloads the configuration on its own
+    signal.signal(signal.SIGHUP, lambda signum, frame: supervisor.signal_workers(signum))
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        logger.info('interrupted! stopping workers..')
+        supervisor.stop()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -245,12 +1653,28 @@ if __name__ == "__main__":
         help="configuration file",
         type=str,
         default="config.yaml")
+    parser.add_argument(
+        "--workers",
+        help="number of worker processes. 0 runs the relay in this process",
+        type=int,
+        default=0)
+    parser.add_argument(
+        "--shard-mode",
+        help="'routes': every worker handles a part of the routes. "
+             "'shared': every worker subscribes to all routes with a shared subscription",
+        choices=['routes', 'shared'],
+        default='routes')
+    parser.add_argument(
+        "--share-group",
+        help="group name for shared subscriptions",
+        type=str,
+        default="mqtt-relais")
 
     args = parser.parse_args()
     path_log_config_file = os.path.join(os.path.dirname(
         os.path.realpath(__file__)), 'conf', LOGGING_CONFIG)
     print(f'logging config file: {path_log_config_file}')
-    fileConfig(path_log_config_file)
+    fileConfig(path_log_config_file, disable_existing_loggers=False)
     logger = logging.getLogger(__name__)
     logger.info("using logging conf from {}".format(path_log_config_file))
     if args.verbose:
@@ -260,57 +1684,24 @@ if __name__ == "__main__":
     # load config
     path_config_file = os.path.join(os.path.dirname(
         os.path.realpath(__file__)), 'conf', args.conf_file)
+    config_path = path_config_file
     with open(path_config_file) as yaml_conf_file:
         configuration = yaml.full_load(yaml_conf_file)
 
     logger.info("loaded config: {}".format(configuration))
+    _configure_message_log(configuration.get('trace'))
 
-    
-    # start all mqtt connections
-    logger.info('starting mqtt connections...')
-    # list to stor all active vlients
-    active_clients = {}
-    # dictionary to store all dynamically loaded converters
-    converters = {}
-    for name, conf in configuration.get("brokers").items():
-        logger.info(
-            f'starting client for broker {name}, connecting to host {conf.get("host")}')
-        client = connect_mqtt(name, conf)
-        if client:
-            # Bind function to callback
-            client.on_publish = on_publish
-            client.on_log = on_log
-            client.on_message = on_message
-            client.on_connect = on_connect
-            client.on_disconnect = on_disconnect
-            client.loop_start()
-            client.enable_logger(logger)
-            # create converter and routing info
-            converter_and_routing_info = {}
-            converter_and_routing_info['name'] = name
-            subscribe_converter = conf.get('subscribe-converter')
-            converter_and_routing_info['subscribe-converter'] = subscribe_converter
-            if subscribe_converter:
-                _load_converter(subscribe_converter)
-            publish_converter = conf.get('publish-converter')
-            converter_and_routing_info['publish-converter'] = publish_converter
-            if publish_converter:
-                _load_converter(publish_converter)
-            converter_and_routing_info['routes'] = []
-            for route in configuration.get("routing"):
-                if route["subscribe-broker"] == name:
-                    converter_and_routing_info['routes'].append(route)
-                    payload_converter = route.get('payload-converter')
-                    if payload_converter:
-                        _load_converter(
-                            payload_converter)
-                    logger.debug(f"added route {route['name']}")
-            client.user_data_set(converter_and_routing_info)
-            active_clients[name] = client
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        logger.info('interrupted!')
-        for name, client in active_clients.items():
-            disconnect_mqtt(client)
+    if args.workers > 0:
+        shard = {'mode': args.shard_mode, 'group': args.share_group}
+        run_supervisor(args.workers)
+    else:
+        signal.signal(signal.SIGHUP, _request_reload)
+        start_relay()
+        try:
+            while True:
+                if reload_requested.wait(1):
+                    reload_requested.clear()
+                    _reload_configuration()
+        except KeyboardInterrupt:
+            logger.info('interrupted!')
+            stop_relay()
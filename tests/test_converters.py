@@ -0,0 +1,167 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from MessageConverters.DeviceState import MemoryStateStore, RedisStateStore
+from MessageConverters.ELSYS import ELSYS
+from MessageConverters.LHT65 import LHT65
+from MessageConverters.MCF import MCF
+from MessageConverters.MS_AM3XX import MS_AM3XX
+from MessageConverters.PIOT import PIOT
+from MessageConverters.TB_V1 import TB_V1
+from MessageConverters.TTN_V3 import EXAMPLE_PAYLOAD, TTN_V3
+from MessageConverters.UC11XX import UC11XX
+
+# the expected values are the output of the converters before the
+# PayloadReader and TLVDecoder ports (ELSYS returned its fields as one entry)
+
+# 2021-08-16 16:41:18, the mcf devices send their local time
+MCF_TIME = '3285102b'
+MCF_TS = int(datetime(2021, 8, 16, 16, 41, 18).timestamp())
+
+TLV_CASES = [
+    (ELSYS, '0100e6021f04004a05000601c1070e12', {
+        'temperature': 23.0, 'humidity': 31, 'light': 74, 'motion': 0, 'co2': 449, 'battery': 3.602}),
+    (ELSYS, '03010203' '0a0010' '0b00000100' '0c00e6' '0d01' '0e0200' '0f05' '1000e600f0' '14000f4240'
+            '153c32' '160003' '180bb8' '1900c8', {
+        'acceleration_x': -61, 'acceleration_y': -60, 'acceleration_z': -59,
+        'pulse_count': 16, 'pulse_count_abs': 256, 'external_temp1': 23.0, 'external_digital': 1,
+        'external_distance': 0.512, 'motion_am': 5, 'external_ir_int': 23.0, 'external_ir_ext': 24.0,
+        'pressure': 1000.0, 'sound_peak': 60, 'sound_avg': 50, 'pulse_count2': 3, 'analog2': 3000,
+        'external_temp2': 20.0}),
+    # frame of TTN_V3.EXAMPLE_PAYLOAD
+    (MS_AM3XX, '0367f60004687d06653d0060015d00056a0100077d3902087d25000973c225', {
+        'temperature': 24.6, 'humidity': 62.5, 'light': 61, 'battery': 0, 'PIR': 1}),
+    # am319
+    (MS_AM3XX, '017564' '0367f600' '04687d' '050001' '06cb02' '077d3902' '087d2500' '0973c225' '0a7d0500'
+               '0b7d0a00' '0c7d0c00' '0d7d0100' '0e0100', {
+        'battery': 100, 'temperature': 24.6, 'humidity': 62.5, 'PIR': 1, 'light': 2, 'CO2': 569, 'tVOC': 37,
+        'pressure': 966.6, 'HCHO': 0.05, 'PM2_5': 10, 'PM10': 12, 'O3': 1, 'beep': 0}),
+]
+
+FRAME_CASES = [
+    (MCF, 2, '04' + MCF_TIME + '34095a8a8b01', [{
+        'fields': {'time': MCF_TS, 'temperature': 23.56, 'humidity': 45.0, 'pressure': 101258},
+        'tags': {'devicename': 'dev_in', 'messagetype': 't_p_rh'}}]),
+    (MCF, 2, '09' + MCF_TIME + '10270000' '20030000' '30040000' '40050000' '50060000', [{
+        'fields': {
+            'time': MCF_TS, 'active_energy': 800, 'reactive_energy': 1072, 'apparent_energy': 1344,
+            'running_time': 1616},
+        'tags': {'devicename': 'dev_in', 'messagetype': 'power'}}]),
+    (MCF, 2, '0a' + MCF_TIME + '01000000' '02000000' '03000000', [{
+        'fields': {'time': MCF_TS, 'inputs': '1', 'outputs': '10', 'events': '11'},
+        'tags': {'devicename': 'dev_in', 'messagetype': 'io'}}]),
+    (MCF, 2, '0e' + MCF_TIME + '34095a8a8b012c0164009001', [{
+        'fields': {
+            'time': MCF_TS, 'temperature': 23.56, 'humidity': 45.0, 'pressure': 101258, 'illuminance': 300,
+            'voc': 100, 'co2': 400},
+        'tags': {'devicename': 'dev_in', 'messagetype': 't_p_rh_lux_voc_co2'}}]),
+    (MCF, 2, '01' '78563412' '010203' '0500' '01', [{
+        'fields': {'sync_id': 305419896, 'sync version': 197121, 'app_type': 5, 'option': 1},
+        'tags': {'devicename': 'dev_in', 'messagetype': 'time_sync_request'}}]),
+    (UC11XX, 85, '010001' '0202e8036400d007dc05', [
+        {'fields': {'digital_in_1': 1}},
+        {'fields': {
+            'analog_in_act_2': 10.0, 'analog_in_min_2': 1.0, 'analog_in_max_2': 20.0, 'analog_in_avg_2': 15.0}}]),
+    (LHT65, 2, 'cbf60b0d037601' '0add7fff', [
+        {'fields': {'batV': 3.062, 'temp_SHT': 28.29, 'hum_SHT': 88.6, 'temp_ds': 27.81}}]),
+]
+
+BADGE_UUID = '04a1b2c3d4e5f6'
+BADGE_TAGS = {'uuid': BADGE_UUID, 'messagetype': 'badge_event', 'inout': 'in', 'devicename': 'piot_in'}
+
+# frames of one PIOT device in order: (frame, entries, downlink)
+PIOT_FRAMES = [
+    # first badge event, acknowledged
+    ('01' '0100' '00e1f55f' + BADGE_UUID,
+     [{'fields': {'seq no': 1, 'ts': 1609949440}, 'tags': BADGE_TAGS}], 'a20100'),
+    ('01' '0200' '10e1f55f' + BADGE_UUID,
+     [{'fields': {'seq no': 2, 'ts': 1609949456}, 'tags': BADGE_TAGS}], None),
+    # duplicate
+    ('01' '0200' '10e1f55f' + BADGE_UUID, [], None),
+    # badge events were lost, the device is told the current seq no
+    ('01' '0500' '20e1f55f' + BADGE_UUID, [], 'a20200'),
+    ('07' '0700' '0800' '0200', [{
+        'fields': {'curr seq no': 7, 'next seq no': 8, 'last_ack_no': 2},
+        'tags': {'messagetype': 'ack_not_found', 'inout': 'in', 'devicename': 'piot_in'}}], 'a20700'),
+    ('01' '0800' '30e1f55f' + BADGE_UUID,
+     [{'fields': {'seq no': 8, 'ts': 1609949488}, 'tags': BADGE_TAGS}], None),
+    ('00' '0000' '64' '11', [{
+        'fields': {'batt_level': '100', 'hwfw': '17'},
+        'tags': {'messagetype': 'status', 'inout': 'in', 'devicename': 'piot_in'}}], None),
+]
+
+
+# TB_V1 message of TTN_V3.EXAMPLE_PAYLOAD
+TB_V1_EXAMPLE = {
+    'values': {
+        'received_at': '2021-08-16T16:41:18.188927828Z',
+        'device_id': 'eui-24e124128b100001',
+        'dev_eui': '24E124128B100001',
+        'payload': 'A2f2AARofQZlPQBgAV0ABWoBAAd9OQIIfSUACXPCJQ==',
+        'decoded_payload': {
+            'activity': 1, 'co2': 569, 'humidity': 62.5, 'illumination': 61, 'infrared': 93,
+            'infrared_and_visible': 352, 'pressure': 966.6, 'temperature': 24.6, 'tvoc': 37},
+        'gateway_id': 'eui-0015fcc23d0dd9be',
+        'rssi': -111,
+        'snr': -2.8,
+        'location_lat': 47.18154548,
+        'location_long': 9.46131912,
+        'location_alt': 465},
+    'ts': 1629132078188}
+
+
+def _decode(entries):
+    # MCF adds the current time to its entries
+    for entry in entries:
+        if isinstance(entry.get('ts'), str):
+            del entry['ts']
+    return entries
+
+
+def test_ttn_v3_to_tb_v1():
+    converted = TB_V1().convert(TTN_V3().convert(EXAMPLE_PAYLOAD.encode('utf-8')))
+    assert json.loads(converted) == TB_V1_EXAMPLE
+    message = TTN_V3().convert_message(json.loads(EXAMPLE_PAYLOAD))
+    assert TB_V1().convert_message(message) == TB_V1_EXAMPLE
+
+
+@pytest.mark.parametrize('converter_class, frame, expected', TLV_CASES)
+def test_tlv_converters(converter_class, frame, expected):
+    payload = base64.b64encode(bytes.fromhex(frame)).decode('ascii')
+    message = {'preconverted': {'payload': payload}}
+    converter = converter_class()
+    converted = json.loads(converter.convert(json.dumps(message).encode('utf-8')))
+    assert converted['preconverted'] == dict(expected, payload=payload)
+    assert converter.convert_message(message)['preconverted'] == dict(expected, payload=payload)
+
+
+@pytest.mark.parametrize('converter_class, port, frame, expected', FRAME_CASES)
+def test_frame_converters(converter_class, port, frame, expected):
+    converter = converter_class('dev_in')
+    assert _decode(converter._convert(bytes.fromhex(frame), port)) == expected
+
+
+def _redis_store():
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisStateStore(fakeredis.FakeStrictRedis(decode_responses=True))
+
+
+@pytest.mark.parametrize('create_store', [MemoryStateStore, _redis_store], ids=['memory', 'redis'])
+def test_piot_sequence(create_store):
+    store = create_store()
+    converter = PIOT('piot_in', store)
+    for frame, entries, downlink in PIOT_FRAMES:
+        decoded, prepared = converter.decode_frame(bytes.fromhex(frame), 1)
+        assert decoded == entries
+        assert (bytes(prepared).hex() if prepared is not None else None) == downlink
+    store.close()
+
+
+def test_piot_payload_key():
+    store = _redis_store()
+    PIOT('piot_in', store).decode_frame(bytes.fromhex('0000006411'), 1)
+    # written like earlier versions did
+    assert store.client.get('piot_in:payload') == '[0, 0, 0, 100, 17]'
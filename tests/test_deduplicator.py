@@ -0,0 +1,36 @@
+import time
+
+import pytest
+
+from Relais.Deduplicator import Deduplicator
+
+
+def test_seen():
+    deduplicator = Deduplicator(ttl=60)
+    assert not deduplicator.seen(('24e124128b100001', 1))
+    assert deduplicator.seen(('24e124128b100001', 1))
+    assert not deduplicator.seen(('24e124128b100001', 2))
+    assert deduplicator.duplicates == 1
+
+
+def test_keys_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    deduplicator = Deduplicator(ttl=10)
+    deduplicator.seen('a')
+    now[0] += 9
+    assert deduplicator.seen('a')
+    now[0] += 2
+    assert not deduplicator.seen('a')
+    assert len(deduplicator) == 1
+
+
+def test_maxsize():
+    deduplicator = Deduplicator(maxsize=2)
+    for key in ('a', 'b', 'c'):
+        deduplicator.seen(key)
+    assert len(deduplicator) == 2
+    # the oldest key was forgotten
+    assert not deduplicator.seen('a')
+    with pytest.raises(ValueError):
+        Deduplicator(maxsize=0)
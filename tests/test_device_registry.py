@@ -0,0 +1,27 @@
+from Relais.DeviceRegistry import DeviceRegistry
+
+
+def _message(dev_eui='24E124128B100001', device_id='eui-24e124128b100001', brand_id=None, model_id=None):
+    return {
+        'preconverted': {'dev_eui': dev_eui, 'device_id': device_id},
+        'uplink_message': {'version_ids': {'brand_id': brand_id, 'model_id': model_id}}}
+
+
+def test_lookup_order():
+    registry = DeviceRegistry(
+        devices={'24e124128b100001': 'MS_AM3XX', 'Room-1': 'ELSYS'}, models={'ers-co2': 'ELSYS'})
+    # dev_euis are case insensitive
+    assert registry.lookup(_message()) == 'MS_AM3XX'
+    # device ids are matched exactly
+    assert registry.lookup(_message(dev_eui=None, device_id='Room-1')) == 'ELSYS'
+    assert registry.lookup(_message(dev_eui=None, device_id='room-1')) is None
+    assert registry.lookup(_message(dev_eui='a81758fffe0312ab', model_id='ers-co2')) == 'ELSYS'
+    assert registry.lookup(_message(dev_eui='a81758fffe0312ab')) is None
+    assert len(registry) == 3
+
+
+def test_auto_models():
+    message = _message(dev_eui='a81758fffe0312ab', brand_id='milesight-iot', model_id='am307')
+    assert DeviceRegistry(auto_models=True).lookup(message) == 'MS_AM3XX'
+    assert DeviceRegistry().lookup(message) is None
+    assert DeviceRegistry(auto_models=True).converters() == {'ELSYS', 'MS_AM3XX'}
@@ -0,0 +1,53 @@
+import base64
+import json
+
+import pytest
+
+from MessageConverters import DeviceState
+from MessageConverters.FrameConverter import DOWNLINK, ENTRIES, FrameConverter
+from MessageConverters.PIOT import PIOT
+from MessageConverters.TTN_V3 import EXAMPLE_PAYLOAD, TTN_V3
+
+# status (seq 1, battery 90, hw/fw 18), time sync (seq 5, device time)
+# and a badge event (seq 1, time, uuid) in one frame
+PIOT_FRAME = bytes.fromhex('0001005a12' '040500002d5e5f' '0101000010a55f' 'c0ffee0102030405')
+
+
+@pytest.fixture
+def state():
+    store = DeviceState.MemoryStateStore()
+    DeviceState.set_default_store(store)
+    yield store
+    DeviceState.set_default_store(None)
+
+
+def _uplink(frame, port=1, device_id='piot_in'):
+    message = json.loads(EXAMPLE_PAYLOAD)
+    message['end_device_ids']['device_id'] = device_id
+    message['uplink_message']['frm_payload'] = base64.b64encode(frame).decode('ascii')
+    message['uplink_message']['f_port'] = port
+    return TTN_V3().convert_message(message)
+
+
+def test_piot_frame_with_several_records(state):
+    converted = FrameConverter(PIOT).convert_message(_uplink(PIOT_FRAME))
+    entries = converted['preconverted'][ENTRIES]
+    assert [entry['tags']['messagetype'] for entry in entries] == ['status', 'time_sync', 'badge_event']
+    status, time_sync, badge_event = entries
+    assert status['fields'] == {'batt_level': '90', 'hwfw': '18'}
+    assert time_sync['fields']['seq no'] == 5
+    assert time_sync['fields']['ts'] == 0x5f5e2d00
+    assert badge_event['fields'] == {'seq no': 1, 'ts': 0x5fa51000}
+    assert badge_event['tags'] == {
+        'uuid': 'c0ffee0102030405', 'messagetype': 'badge_event', 'inout': 'in', 'devicename': 'piot_in'}
+    # the first badge event is acknowledged
+    assert base64.b64decode(converted[DOWNLINK]['frm_payload']) == bytes.fromhex('a20100')
+    json.dumps(converted)
+
+
+def test_records_are_kept_per_device(state):
+    converter = FrameConverter(PIOT)
+    converter.convert_message(_uplink(PIOT_FRAME, device_id='piot_a_in'))
+    converted = converter.convert_message(_uplink(PIOT_FRAME, device_id='piot_b_in'))
+    assert converted['preconverted'][ENTRIES][2]['fields']['seq no'] == 1
+    assert len(converter) == 2
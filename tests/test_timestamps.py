@@ -0,0 +1,73 @@
+import json
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from MessageConverters.Timestamps import parse_rfc3339, to_millis, uplink_millis
+from MessageConverters.TTN_V3 import EXAMPLE_PAYLOAD, TTN_V3
+
+
+def _strptime(value):
+    # how TB_V1 parsed received_at before: fraction cut to microseconds
+    return datetime.strptime(value[0:26] + value[-1], '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+
+
+def test_parse_rfc3339_matches_strptime():
+    rand = random.Random(1)
+    start = datetime(1971, 1, 1, tzinfo=timezone.utc)
+    for _ in range(20000):
+        moment = start + timedelta(seconds=rand.randrange(0, 4000000000), microseconds=rand.randrange(1000000))
+        # ttn sends nanoseconds
+        value = moment.strftime('%Y-%m-%dT%H:%M:%S.%f') + f'{rand.randrange(1000):03d}Z'
+        assert parse_rfc3339(value) == pytest.approx(_strptime(value), abs=1e-6), value
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2021-08-16T16:41:18.188927828Z', 1629132078.188927),
+    ('2021-08-16T16:41:18Z', 1629132078),
+    ('2021-08-16T18:41:18.5+02:00', 1629132078.5),
+    ('2021-08-16t16:41:18z', 1629132078),
+    ('2024-02-29T00:00:00Z', 1709164800),
+    # other iso 8601 layouts go through fromisoformat
+    ('2021-08-16T16:41+00:00', 1629132060),
+])
+def test_parse_rfc3339(value, expected):
+    assert parse_rfc3339(value) == pytest.approx(expected, abs=1e-6)
+
+
+@pytest.mark.parametrize('value', [
+    '2021-02-31T00:00:00Z', '2023-02-29T00:00:00Z', '2021-13-01T00:00:00Z', '2021-01-01T24:00:00Z',
+    '2021-01-01T00:60:00Z', '2021-08-16T16:41:18', 'yesterday',
+])
+def test_parse_rfc3339_rejects(value):
+    with pytest.raises(ValueError):
+        parse_rfc3339(value)
+
+
+def test_to_millis():
+    assert to_millis('2021-08-16T16:41:18.188927828Z') == 1629132078188
+    assert to_millis(1629132078) == 1629132078000
+    assert to_millis(1629132078188) == 1629132078188
+    with pytest.raises(TypeError):
+        to_millis(True)
+
+
+def _uplink(gateway_time=None):
+    message = json.loads(EXAMPLE_PAYLOAD)
+    if gateway_time:
+        message['uplink_message']['rx_metadata'][0]['time'] = gateway_time
+    return TTN_V3().convert_message(message)
+
+
+def test_uplink_millis_sources():
+    network = 1629132078188
+    assert uplink_millis(_uplink()) == network
+    assert uplink_millis(_uplink('2021-08-16T16:41:17.5Z'), {'source': 'gateway'}) == 1629132077500
+    # without gateway time the route falls back to the network time
+    assert uplink_millis(_uplink(), {'source': 'gateway'}) == network
+    message = _uplink()
+    message['preconverted']['ts'] = 1629132000
+    assert uplink_millis(message, {'source': 'device', 'field': 'ts'}) == 1629132000000
+    assert uplink_millis(message, {'source': 'relay', 'received': 1629132079.25}) == 1629132079250
+    assert uplink_millis({}, {'received': 5}) == 5000
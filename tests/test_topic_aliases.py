@@ -0,0 +1,30 @@
+import paho.mqtt.client as mqtt
+
+from Relais.TopicAliases import TopicAliases
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        alias = getattr(properties, 'TopicAlias', None) if properties is not None else None
+        self.published.append((topic, alias))
+        info = mqtt.MQTTMessageInfo(len(self.published))
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        return info
+
+
+def test_aliases():
+    aliases = TopicAliases(2)
+    aliases.reset(broker_maximum=10)
+    client = FakeClient()
+    for topic in ('a', 'a', 'b', 'c', 'b'):
+        aliases.publish(client, topic, b'')
+    # qos > 0 messages send the topic
+    aliases.publish(client, 'a', b'', qos=1)
+    assert client.published == [('a', 1), ('', 1), ('b', 2), ('c', None), ('', 2), ('a', None)]
+    assert len(aliases) == 2
+    aliases.reset()
+    aliases.publish(client, 'a', b'')
+    assert client.published[-1] == ('a', None)
@@ -0,0 +1,38 @@
+import itertools
+import random
+
+import paho.mqtt.client as mqtt
+
+from Relais.TopicMatcher import TopicMatcher
+
+
+def test_wildcards():
+    matcher = TopicMatcher()
+    for topic_filter in ('a/b', 'a/+', 'a/#', '#', '+/+', 'a/+/c', '$share/group/a/b', '+/b/#'):
+        matcher.add(topic_filter, topic_filter)
+    assert matcher.match('a/b') == ['a/b', 'a/+', 'a/#', '#', '+/+', '$share/group/a/b', '+/b/#']
+    assert matcher.match('a') == ['a/#', '#']
+    assert matcher.match('a/x/c') == ['a/#', '#', 'a/+/c']
+    assert matcher.match('a/') == ['a/+', 'a/#', '#', '+/+']
+    assert matcher.match('$SYS/b') == []
+    assert len(matcher) == 8
+
+
+def test_matches_like_paho():
+    # the relay matched every route with topic_matches_sub before
+    rand = random.Random(1)
+    levels = ['a', 'b', '', '+', '#']
+    filters = set()
+    for length in range(1, 4):
+        for combination in itertools.product(levels, repeat=length):
+            if '#' in combination[:-1]:
+                continue
+            filters.add('/'.join(combination))
+    filters = sorted(filters)
+    matcher = TopicMatcher()
+    for topic_filter in filters:
+        matcher.add(topic_filter, topic_filter)
+    for _ in range(2000):
+        topic = '/'.join(rand.choice(['a', 'b', 'c', '', '$x']) for _ in range(rand.randint(1, 4)))
+        expected = [topic_filter for topic_filter in filters if mqtt.topic_matches_sub(topic_filter, topic)]
+        assert matcher.match(topic) == expected, topic
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from Relais.WorkerPool import WorkerPool
+
+
+def test_tasks_of_a_key_keep_their_order():
+    pool = WorkerPool('test', threads=4)
+    pool.start()
+    results = {}
+    for num in range(1000):
+        key = f'topic/{num % 10}'
+        pool.submit(key, lambda key, num: results.setdefault(key, []).append(num), key, num)
+    assert pool.join(5)
+    pool.stop()
+    assert all(nums == sorted(nums) for nums in results.values())
+    assert sum(len(nums) for nums in results.values()) == 1000
+
+
+@pytest.mark.parametrize('backpressure, kept', [('drop-newest', [0, 1]), ('drop-oldest', [2, 3])])
+def test_backpressure(backpressure, kept):
+    pool = WorkerPool('test', queue_size=2, backpressure=backpressure)
+    pool.start()
+    release = threading.Event()
+    done = []
+    pool.submit('key', release.wait)
+    pool.join(0.1)
+    for num in range(4):
+        pool.submit('key', done.append, num)
+    release.set()
+    assert pool.join(5)
+    pool.stop()
+    assert done == kept
+    assert pool.dropped == 2
+
+
+def test_blocked_submit_gives_up_on_stop():
+    pool = WorkerPool('test', queue_size=1)
+    pool.start()
+    release = threading.Event()
+    pool.submit('key', release.wait)
+    pool.join(0.1)
+    pool.submit('key', lambda: None)
+    results = []
+    submitter = threading.Thread(target=lambda: results.append(pool.submit('key', lambda: None)))
+    submitter.start()
+    submitter.join(0.2)
+    assert submitter.is_alive()
+    stopper = threading.Thread(target=pool.stop)
+    stopper.start()
+    submitter.join(5)
+    assert results == [False]
+    release.set()
+    stopper.join(5)
+    assert not stopper.is_alive()